@@ -0,0 +1,210 @@
+#!/usr/bin/python
+#
+# Times the hot paths of expected_depth_for_run.py and ccbg.depth on
+# synthetic inputs and writes the results as json, so runs of
+# different versions can be compared with --compare.
+#
+#
+
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "resources", "usr", "bin"))
+
+import pysam
+
+import ccbg
+import ccbg.depth as depth
+import expected_depth_for_run
+
+import synthetic
+
+
+
+def time_function(function, repeat):
+    """ Runs a function a number of times and records the wall time of each run
+
+    Args:
+      function (callable): function to run, without arguments
+      repeat (int): number of runs
+
+    Returns:
+      list of seconds (float)
+
+    """
+
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        function()
+        timings.append(time.time() - start)
+
+    return timings
+
+
+def summarise(timings, items):
+    """ Summarises the timings of a benchmark
+
+    Args:
+      timings (list of float): seconds per run
+      items (int): number of items (regions, samples, ...) handled per run
+
+    Returns:
+      dict
+
+    """
+
+    best = min(timings)
+    return {'seconds': timings,
+            'best': best,
+            'mean': sum(timings) / len(timings),
+            'items': items,
+            'items_per_second': items / best if best > 0 else None}
+
+
+def run_benchmarks(args, workdir):
+    """ Generates the inputs and runs every benchmark
+
+    Args:
+      args (Namespace): command line arguments
+      workdir (str): directory for the synthetic files
+
+    Returns:
+      dict of benchmark name: summary
+
+    """
+
+    regions = synthetic.make_regions(args.regions, args.seed)
+    bed_file = synthetic.write_bed(regions, os.path.join(workdir, "regions.bed"))
+    coverage_files, flagstat_files = synthetic.write_coverage_files(regions, args.samples, workdir, args.seed)
+    block_file = synthetic.write_block_depth_file(regions, os.path.join(workdir, "blocks.gz"), args.seed)
+
+    bam_regions = regions[:args.bam_regions]
+    bam_file = synthetic.write_bam(bam_regions, os.path.join(workdir, "reads.bam"), args.reads_per_region, args.seed)
+
+    devnull = open(os.devnull, 'w')
+    results = {}
+
+    flagstats = expected_depth_for_run.readin_flagstats(flagstat_files)
+    outfile = os.path.join(workdir, "expected_depth")
+    results['calculate_exp_depth'] = summarise(
+        time_function(lambda: expected_depth_for_run.calculate_exp_depth(flagstats, coverage_files, outfile, force=True), args.repeat),
+        len(regions) * args.samples)
+
+    results['readin_flagstats'] = summarise(
+        time_function(lambda: expected_depth_for_run.readin_flagstats(flagstat_files), args.repeat),
+        len(flagstat_files))
+
+    def coverage_each_region():
+        for chrom, start, end in regions:
+            depth.coverage_region(block_file, chrom, start, end)
+
+    results['coverage_region'] = summarise(time_function(coverage_each_region, args.repeat), len(regions))
+
+    results['coverage_regions_from_bedfile'] = summarise(
+        time_function(lambda: depth.coverage_regions_from_bedfile(block_file, bed_file), args.repeat),
+        len(regions))
+
+    # neighbouring single bases, every third one breaking the run
+    merge_input = ["1:{}-{}".format(pos, pos) for pos in range(1, args.merge_regions * 3 + 1) if pos % 3]
+    results['_merge_regions'] = summarise(
+        time_function(lambda: depth._merge_regions(merge_input), args.repeat),
+        len(merge_input))
+
+    bamfile = pysam.Samfile(bam_file, 'rb')
+
+    def blocks_each_region():
+        for chrom, start, end in bam_regions:
+            depth.make_region_in_blocks(bamfile, chrom, start, end, devnull)
+
+    def bases_each_region():
+        for chrom, start, end in bam_regions:
+            depth.make_region(bamfile, chrom, start, end, devnull)
+
+    bases = sum([end - start + 1 for chrom, start, end in bam_regions])
+    results['make_region_in_blocks'] = summarise(time_function(blocks_each_region, args.repeat), bases)
+    results['make_region'] = summarise(time_function(bases_each_region, args.repeat), bases)
+
+    bamfile.close()
+    devnull.close()
+
+    return results
+
+
+def compare(results, previous_file):
+    """ Prints how the best times compare to a previous results file
+
+    Args:
+      results (dict): benchmark name: summary
+      previous_file (str): json written by an earlier run
+
+    Returns:
+      None
+
+    """
+
+    fh = open(previous_file)
+    previous = json.load(fh)['results']
+    fh.close()
+
+    for name in sorted(results):
+        if (name not in previous):
+            continue
+
+        ratio = results[name]['best'] / previous[name]['best'] if previous[name]['best'] > 0 else float('nan')
+        print("{:32s} {:10.4f}s  was {:10.4f}s  ({:.2f}x)".format(name, results[name]['best'], previous[name]['best'], ratio))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmarks the expected depth and ccbg depth functions on synthetic data')
+
+    parser.add_argument('--samples', type=int, default=24, help="coverage files to generate, default 24")
+    parser.add_argument('--regions', type=int, default=20000, help="regions per coverage and block file, default 20000")
+    parser.add_argument('--bam-regions', type=int, default=500, help="regions covered by the BAM, default 500")
+    parser.add_argument('--reads-per-region', type=int, default=50, help="reads per BAM region, default 50")
+    parser.add_argument('--merge-regions', type=int, default=100000, help="region strings given to _merge_regions, default 100000")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per benchmark, default 3")
+    parser.add_argument('--seed', type=int, default=1, help="seed for the synthetic data, default 1")
+    parser.add_argument('--workdir', help="directory for the synthetic files, default a temporary directory that is removed afterwards")
+    parser.add_argument('-o', '--output', default='bench_output.json', help="json file to write the results to, default bench_output.json")
+    parser.add_argument('--compare', help="results json of an earlier run to compare against")
+
+    args = parser.parse_args()
+
+    workdir = args.workdir
+    if (workdir is None):
+        workdir = tempfile.mkdtemp(prefix="ccbg_bench_")
+    elif (not os.path.isdir(workdir)):
+        os.makedirs(workdir)
+
+    try:
+        results = run_benchmarks(args, workdir)
+    finally:
+        if (args.workdir is None):
+            shutil.rmtree(workdir)
+
+    report = {'ccbg_version': ccbg.__version__,
+              'python': platform.python_version(),
+              'pysam': pysam.__version__,
+              'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+              'parameters': vars(args),
+              'results': results}
+
+    fh = open(args.output, 'w')
+    json.dump(report, fh, indent=2, sort_keys=True)
+    fh.close()
+
+    for name in sorted(results):
+        print("{:32s} {:10.4f}s  {:12.1f} items/s".format(name, results[name]['best'], results[name]['items_per_second'] or 0))
+
+    if (args.compare is not None):
+        compare(results, args.compare)
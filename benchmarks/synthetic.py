@@ -0,0 +1,217 @@
+#!/usr/bin/python
+#
+# Deterministic synthetic inputs for the benchmarks: region coverage
+# files in the *5bp.gz layout with flagstats, block depth files, and a
+# small coordinate sorted BAM with a matching bed file.
+#
+# The same seed and sizes always give the same files.
+#
+
+
+from __future__ import print_function
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "resources", "usr", "bin"))
+
+import pysam
+
+import ccbg.bgzf as bgzf
+
+
+CHROMS = ['1', '2', 'X']
+
+# length of the synthetic reference sequences
+CHROM_LENGTH = 50000000
+
+READ_LENGTH = 100
+
+
+
+def make_regions(n_regions, seed=1, min_length=50, max_length=400):
+    """ Generates sorted, non-overlapping regions spread over the chromosomes
+
+    Args:
+      n_regions (int): total number of regions
+      seed (int): random seed
+      min_length (int): shortest region
+      max_length (int): longest region
+
+    Returns:
+      list of (chrom, start, end), 1-based inclusive
+
+    """
+
+    rand = random.Random(seed)
+
+    regions = []
+    per_chrom = n_regions // len(CHROMS) + 1
+    for chrom in CHROMS:
+        pos = 1000
+        for i in range(per_chrom):
+            if (len(regions) == n_regions):
+                break
+
+            start = pos + rand.randint(10, 500)
+            end = start + rand.randint(min_length, max_length)
+            regions.append((chrom, start, end))
+            pos = end
+
+    return regions
+
+
+def write_bed(regions, filename):
+    """ Writes regions as a bed file, 0-based half open with a name column
+
+    Args:
+      regions (list): (chrom, start, end), 1-based inclusive
+      filename (str): bed file to write
+
+    Returns:
+      filename (str)
+
+    """
+
+    fh = open(filename, 'w')
+    for index, (chrom, start, end) in enumerate(regions):
+        fh.write("{}\t{}\t{}\tREGION{}\n".format(chrom, start - 1, end, index))
+    fh.close()
+
+    return filename
+
+
+def write_coverage_files(regions, n_samples, directory, seed=1):
+    """ Writes a bgzipped and indexed region coverage file and a flagstat file per sample
+
+    Args:
+      regions (list): (chrom, start, end)
+      n_samples (int): number of samples
+      directory (str): directory to write to
+      seed (int): random seed
+
+    Returns:
+      coverage files (list of str)
+      flagstat files (list of str)
+
+    """
+
+    rand = random.Random(seed)
+
+    coverage_files = []
+    flagstat_files = []
+    for sample in range(n_samples):
+        sample_name = "SAMPLE{:03d}".format(sample)
+
+        filename = os.path.join(directory, "{}.refseq_nirvana_5bp.gz".format(sample_name))
+        fh = bgzf.BgzfWriter(filename, index=bgzf.TabixIndex(seq_col=0, start_col=1, end_col=2))
+        fh.write("#chrom\tstart\tend\tgene\tmean\n")
+        for chrom, start, end in regions:
+            fh.write_line("{}\t{}\t{}\tGENE\t{:.3f}\n".format(chrom, start, end, rand.uniform(0, 500)))
+        fh.close()
+        coverage_files.append(filename)
+
+        mapped = rand.randint(50000000, 90000000)
+        dups = rand.randint(1000000, 5000000)
+        filename = os.path.join(directory, "{}.flagstat".format(sample_name))
+        fh = open(filename, 'w')
+        fh.write("{} + 0 in total (QC-passed reads + QC-failed reads)\n".format(mapped + 1000))
+        fh.write("0 + 0 secondary\n")
+        fh.write("0 + 0 supplementary\n")
+        fh.write("{} + 0 duplicates\n".format(dups))
+        fh.write("{} + 0 mapped (99.00% : N/A)\n".format(mapped))
+        fh.write("{} + 0 paired in sequencing\n".format(mapped))
+        fh.write("{} + 0 properly paired (98.00% : N/A)\n".format(mapped - 5000))
+        fh.write("{} + 0 with itself and mate mapped\n".format(mapped - 100))
+        fh.write("100 + 0 singletons (0.10% : N/A)\n")
+        fh.close()
+        flagstat_files.append(filename)
+
+    return coverage_files, flagstat_files
+
+
+def write_block_depth_file(regions, filename, seed=1, max_depth=60):
+    """ Writes a bgzipped and indexed block depth file covering the regions
+
+    Every region is split into blocks of random length and depth, with
+    some low and zero depth blocks so all the coverage buckets are hit.
+
+    Args:
+      regions (list): (chrom, start, end), 1-based inclusive
+      filename (str): file to write
+      seed (int): random seed
+      max_depth (int): highest block depth
+
+    Returns:
+      filename (str)
+
+    """
+
+    rand = random.Random(seed)
+
+    fh = bgzf.BgzfWriter(filename, index=bgzf.TabixIndex(seq_col=0, start_col=1, end_col=2))
+    for chrom, start, end in regions:
+        block_start = start
+        while (block_start <= end):
+            block_end = min(end, block_start + rand.randint(0, 40))
+            depth = rand.choice([0, rand.randint(1, 19), rand.randint(20, max_depth), rand.randint(20, max_depth)])
+            fh.write_line("{}\t{}\t{}\t{}\n".format(chrom, block_start, block_end, depth))
+            block_start = block_end + 1
+    fh.close()
+
+    return filename
+
+
+def write_bam(regions, filename, reads_per_region=50, seed=1):
+    """ Writes a coordinate sorted and indexed BAM with reads piled over the regions
+
+    Args:
+      regions (list): (chrom, start, end), 1-based inclusive
+      filename (str): BAM file to write
+      reads_per_region (int): reads started in and around every region
+      seed (int): random seed
+
+    Returns:
+      filename (str)
+
+    """
+
+    rand = random.Random(seed)
+
+    # pysam renamed these, keep working with the old and the new names
+    alignment_file = getattr(pysam, 'AlignmentFile', None) or pysam.Samfile
+    aligned_read = getattr(pysam, 'AlignedSegment', None) or pysam.AlignedRead
+
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'SN': chrom, 'LN': CHROM_LENGTH} for chrom in CHROMS]}
+
+    reads = []
+    for chrom, start, end in regions:
+        tid = CHROMS.index(chrom)
+        for i in range(reads_per_region):
+            pos = rand.randint(max(0, start - READ_LENGTH), end)
+            if (rand.random() < 0.1):
+                cigar = [(0, 40), (2, 5), (0, READ_LENGTH - 40)]
+            else:
+                cigar = [(0, READ_LENGTH)]
+            reads.append((tid, pos, cigar))
+
+    reads.sort()
+
+    fh = alignment_file(filename, 'wb', header=header)
+    for index, (tid, pos, cigar) in enumerate(reads):
+        read = aligned_read()
+        read.qname = "read{}".format(index)
+        read.seq = "A" * READ_LENGTH
+        read.qual = "I" * READ_LENGTH
+        read.flag = 0
+        read.tid = tid
+        read.pos = pos
+        read.mapq = 60
+        read.cigar = cigar
+        fh.write(read)
+    fh.close()
+
+    pysam.index(filename)
+
+    return filename
@@ -0,0 +1,573 @@
+#!/usr/bin/python
+#
+# Writing of BGZF files, with the tabix index built while the data is
+# written so the file never has to be read back in for indexing.
+#
+#
+#
+
+
+from __future__ import print_function
+import os
+import struct
+import zlib
+from multiprocessing.pool import ThreadPool
+
+
+# uncompressed bytes per block, same as htslib so a block always fits in 64KB compressed
+BLOCK_SIZE = 65280
+
+# the empty block marking the end of a bgzf file
+EOF_BLOCK = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+# tabix format flags
+TBX_GENERIC = 0
+TBX_UCSC    = 0x10000
+
+# size of a linear index window
+LINEAR_SHIFT = 14
+
+# blocks handed to the compression pool at a time by compress_file
+BATCH_BLOCKS = 64
+
+
+
+def _to_bytes( data ):
+    """ returns data as bytes, encoding text if needed
+
+    Args:
+      data (str/bytes): data to convert
+
+    Returns:
+      bytes
+
+    """
+
+    if ( isinstance( data, bytes )):
+        return data
+
+    return data.encode( 'ascii' )
+
+
+def compress_block( data, level=6 ):
+    """ compresses data into a single bgzf block
+
+    Args:
+      data (bytes): at most BLOCK_SIZE bytes to compress
+      level (int): zlib compression level
+
+    Returns:
+      block (bytes)
+
+    """
+
+    compressor = zlib.compressobj( level, zlib.DEFLATED, -15 )
+    compressed = compressor.compress( data ) + compressor.flush()
+
+    # BSIZE is the total block size minus 1: 18 bytes header + 8 bytes footer
+    header = struct.pack( "<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len( compressed ) + 25 )
+    footer = struct.pack( "<II", zlib.crc32( data ) & 0xffffffff, len( data ) & 0xffffffff )
+
+    return header + compressed + footer
+
+
+def reg2bin( beg, end ):
+    """ finds the smallest UCSC bin containing a 0-based, half open region
+
+    Args:
+      beg (int): start position
+      end (int): end position
+
+    Returns:
+      bin (int)
+
+    """
+
+    end -= 1
+    if ( beg >> 14 == end >> 14 ): return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if ( beg >> 17 == end >> 17 ): return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if ( beg >> 20 == end >> 20 ): return ((1 <<  9) - 1) // 7 + (beg >> 20)
+    if ( beg >> 23 == end >> 23 ): return ((1 <<  6) - 1) // 7 + (beg >> 23)
+    if ( beg >> 26 == end >> 26 ): return ((1 <<  3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+
+class TabixIndex( object ):
+    """ Builds a tabix index from the virtual offsets of the lines as they are written
+
+    Lines must be added sorted, with each sequence in one contiguous run,
+    just as tabix requires.
+    """
+
+    def __init__( self, seq_col=0, start_col=1, end_col=2, meta_char='#', zerobased=False ):
+        """ columns are 0-based, as for pysam.tabix_index
+
+        Args:
+          seq_col (int): column with the sequence name
+          start_col (int): column with the start position
+          end_col (int): column with the end position
+          meta_char (str): lines starting with this are not indexed
+          zerobased (bool): start positions are 0-based
+        """
+
+        self.seq_col   = seq_col
+        self.start_col = start_col
+        self.end_col   = end_col
+        self.meta_char = meta_char
+        self.zerobased = zerobased
+
+        self.names   = []
+        self.bins    = []
+        self.linear  = []
+
+        self._names = {}
+
+
+    def add_line( self, line, offset_start, offset_end ):
+        """ indexes a line of the file
+
+        Args:
+          line (str): the line, with or without newline
+          offset_start (int): virtual offset of the start of the line
+          offset_end (int): virtual offset just past the end of the line
+
+        Returns:
+          None
+
+        """
+
+        if ( line.startswith( self.meta_char )):
+            return None
+
+        fields = line.rstrip("\n").split("\t")
+
+        beg = int( fields[ self.start_col ])
+        if ( not self.zerobased ):
+            beg -= 1
+
+        end = int( fields[ self.end_col ])
+        if ( end <= beg ):
+            end = beg + 1
+
+        self.add( fields[ self.seq_col ], beg, end, offset_start, offset_end )
+
+        return None
+
+
+    def add( self, chrom, beg, end, offset_start, offset_end ):
+        """ indexes a 0-based, half open region stored between two virtual offsets
+
+        Args:
+          chrom (str): sequence name
+          beg (int): start position
+          end (int): end position
+          offset_start (int): virtual offset of the start of the record
+          offset_end (int): virtual offset just past the end of the record
+
+        Returns:
+          None
+
+        """
+
+        if ( chrom not in self._names ):
+            self._names[ chrom ] = len( self.names )
+            self.names.append( chrom )
+            self.bins.append( {} )
+            self.linear.append( [] )
+
+        tid = self._names[ chrom ]
+
+        chunks = self.bins[ tid ].setdefault( reg2bin( beg, end ), [])
+        if ( chunks and chunks[-1][1] == offset_start ):
+            chunks[-1][1] = offset_end
+        else:
+            chunks.append( [offset_start, offset_end] )
+
+        linear = self.linear[ tid ]
+        last_window = (end - 1) >> LINEAR_SHIFT
+        if ( len( linear ) <= last_window ):
+            linear.extend( [None] * (last_window + 1 - len( linear )))
+
+        for window in range( beg >> LINEAR_SHIFT, last_window + 1 ):
+            if ( linear[ window ] is None ):
+                linear[ window ] = offset_start
+
+        return None
+
+
+    def merge( self, other, offset ):
+        """ adds the lines indexed in another index, of a file stored from a compressed offset on
+
+        The sequences of other must follow on from those already indexed,
+        as when joining BGZF parts in order with join_files.
+
+        Args:
+          other (TabixIndex): index of the file stored from offset
+          offset (int): compressed offset the file starts at
+
+        Returns:
+          None
+
+        """
+
+        shift = offset << 16
+
+        for chrom, bins, linear in zip( other.names, other.bins, other.linear ):
+            if ( chrom not in self._names ):
+                self._names[ chrom ] = len( self.names )
+                self.names.append( chrom )
+                self.bins.append( {} )
+                self.linear.append( [] )
+
+            tid = self._names[ chrom ]
+
+            for bin_id, other_chunks in bins.items():
+                chunks = self.bins[ tid ].setdefault( bin_id, [])
+                for chunk_start, chunk_end in other_chunks:
+                    if ( chunks and chunks[-1][1] == chunk_start + shift ):
+                        chunks[-1][1] = chunk_end + shift
+                    else:
+                        chunks.append( [chunk_start + shift, chunk_end + shift] )
+
+            own_linear = self.linear[ tid ]
+            if ( len( own_linear ) < len( linear )):
+                own_linear.extend( [None] * (len( linear ) - len( own_linear )))
+
+            for window, window_offset in enumerate( linear ):
+                if ( window_offset is not None and own_linear[ window ] is None ):
+                    own_linear[ window ] = window_offset + shift
+
+        return None
+
+
+    def to_bytes( self ):
+        """ serialises the index in the uncompressed tabix format
+
+        Returns:
+          index (bytes)
+
+        """
+
+        names = b"".join( [_to_bytes( name ) + b"\0" for name in self.names] )
+
+        flags = TBX_GENERIC
+        if ( self.zerobased ):
+            flags |= TBX_UCSC
+
+        data = [ b"TBI\1",
+                 struct.pack( "<8i", len( self.names ), flags,
+                              self.seq_col + 1, self.start_col + 1, self.end_col + 1,
+                              ord( self.meta_char ), 0, len( names )),
+                 names ]
+
+        for bins, linear in zip( self.bins, self.linear ):
+            data.append( struct.pack( "<i", len( bins )))
+            for bin_id in sorted( bins ):
+                chunks = bins[ bin_id ]
+                data.append( struct.pack( "<Ii", bin_id, len( chunks )))
+                for chunk_start, chunk_end in chunks:
+                    data.append( struct.pack( "<QQ", chunk_start, chunk_end ))
+
+            # windows without records get the offset of the window before them
+            offsets = []
+            prev_offset = 0
+            for offset in linear:
+                if ( offset is None ):
+                    offset = prev_offset
+                offsets.append( offset )
+                prev_offset = offset
+
+            data.append( struct.pack( "<i", len( offsets )))
+            data.append( struct.pack( "<{}Q".format( len( offsets )), *offsets ))
+
+        return b"".join( data )
+
+
+    def write( self, filename ):
+        """ writes the index as a bgzf compressed .tbi file
+
+        Args:
+          filename (str): name of the index file
+
+        Returns:
+          None
+
+        """
+
+        fh = BgzfWriter( filename )
+        fh.write( self.to_bytes())
+        fh.close()
+
+        return None
+
+
+
+class BgzfWriter( object ):
+    """ Streams data into a BGZF file a block at a time
+
+    If given a TabixIndex the lines written with write_line are indexed
+    as they go, and the index is written to [filename].tbi on close.
+    Without the EOF marker the file is a part, to be joined to others with
+    join_files, and its index is kept for that rather than written.
+    """
+
+    def __init__( self, filename, index=None, level=6, eof=True ):
+        """
+        Args:
+          filename (str): file to write
+          index (TabixIndex): index to fill, default None
+          level (int): zlib compression level
+          eof (bool): end the file with the EOF marker, default True
+        """
+
+        self.filename = filename
+        self.index    = index
+        self.level    = level
+        self.eof      = eof
+
+        self._fh      = open( filename, 'wb' )
+        self._buffer  = []
+        self._length  = 0
+        self._offset  = 0
+
+
+    def tell( self ):
+        """ virtual offset of the next byte to be written
+
+        Returns:
+          virtual offset (int)
+
+        """
+
+        return ( self._offset << 16 ) | self._length
+
+
+    def write( self, data ):
+        """ writes data, compressing every full block
+
+        Args:
+          data (str/bytes): data to write
+
+        Returns:
+          None
+
+        """
+
+        data = _to_bytes( data )
+        self._buffer.append( data )
+        self._length += len( data )
+
+        if ( self._length >= BLOCK_SIZE ):
+            data = b"".join( self._buffer )
+            while ( len( data ) >= BLOCK_SIZE ):
+                self._write_block( data[:BLOCK_SIZE] )
+                data = data[BLOCK_SIZE:]
+
+            self._buffer = [data]
+            self._length = len( data )
+
+        return None
+
+
+    def write_line( self, line ):
+        """ writes a line and adds it to the index
+
+        Args:
+          line (str): line, including the newline
+
+        Returns:
+          None
+
+        """
+
+        offset_start = self.tell()
+        self.write( line )
+
+        if ( self.index is not None ):
+            self.index.add_line( line, offset_start, self.tell() )
+
+        return None
+
+
+    def _write_block( self, data ):
+        block = compress_block( data, self.level )
+        self._fh.write( block )
+        self._offset += len( block )
+
+
+    def close( self ):
+        """ flushes the last block, writes the EOF marker and the index, unless the file is a part
+
+        Returns:
+          None
+
+        """
+
+        if ( self._length ):
+            self._write_block( b"".join( self._buffer ))
+            self._buffer = []
+            self._length = 0
+
+        if ( not self.eof ):
+            self._fh.close()
+            return None
+
+        self._fh.write( EOF_BLOCK )
+        self._fh.close()
+
+        if ( self.index is not None ):
+            self.index.write( "{}.tbi".format( self.filename ))
+
+        return None
+
+
+
+def compress_file( filename, outfile, index=None, processes=4, level=6, batch_blocks=BATCH_BLOCKS ):
+    """ compresses a file into BGZF, deflating the blocks in a pool of threads
+
+    The input is cut into BLOCK_SIZE blocks, exactly as BgzfWriter does,
+    and batches of blocks are compressed in parallel (zlib releases the
+    GIL) and written in order. If given a TabixIndex every line is
+    indexed from the compressed block offsets as the batches are written,
+    so the file never has to be read back in for indexing.
+
+    Args:
+      filename (str): file to compress
+      outfile (str): BGZF file to write
+      index (TabixIndex): index to fill and write to [outfile].tbi, default None
+      processes (int): compression threads, default 4
+      level (int): zlib compression level
+      batch_blocks (int): blocks compressed per batch
+
+    Returns:
+      outfile (str)
+
+    """
+
+    in_fh  = open( filename, 'rb' )
+    out_fh = open( outfile, 'wb' )
+    pool   = ThreadPool( processes )
+
+    # compressed offset of every block written, and of the next one
+    block_offsets = [0]
+    # uncompressed position of the first line not indexed yet, and the data from there on
+    line_start = 0
+    pending    = b""
+
+    try:
+        while ( True ):
+            blocks = []
+            for i in range( batch_blocks ):
+                data = in_fh.read( BLOCK_SIZE )
+                if ( not data ):
+                    break
+                blocks.append( data )
+
+            if ( not blocks ):
+                break
+
+            for block in pool.map( lambda data: compress_block( data, level ), blocks ):
+                out_fh.write( block )
+                block_offsets.append( block_offsets[-1] + len( block ))
+
+            if ( index is not None ):
+                pending = b"".join( [pending] + blocks )
+                line_start, pending = _index_lines( index, pending, line_start, block_offsets )
+    finally:
+        pool.close()
+        in_fh.close()
+
+    if ( index is not None ):
+        _index_lines( index, pending, line_start, block_offsets, final=True )
+
+    out_fh.write( EOF_BLOCK )
+    out_fh.close()
+
+    if ( index is not None ):
+        index.write( "{}.tbi".format( outfile ))
+
+    return outfile
+
+
+def join_files( parts, outfile, index=None, delete=False ):
+    """ joins BGZF parts, written without the EOF marker, into one BGZF file
+
+    The compressed blocks are copied as they are, so nothing is inflated
+    or deflated again. If given a TabixIndex the index of every part is
+    merged into it at the offset the part is copied to.
+
+    Args:
+      parts (iterable): (part file, TabixIndex of the part or None) tuples, in file order
+      outfile (str): BGZF file to write
+      index (TabixIndex): index to fill and write to [outfile].tbi, default None
+      delete (bool): delete the parts once copied, default False
+
+    Returns:
+      outfile (str)
+
+    """
+
+    out_fh = open( outfile, 'wb' )
+    offset = 0
+
+    for part_file, part_index in parts:
+        if ( index is not None and part_index is not None ):
+            index.merge( part_index, offset )
+
+        part_fh = open( part_file, 'rb' )
+        while ( True ):
+            data = part_fh.read( BLOCK_SIZE * 16 )
+            if ( not data ):
+                break
+            out_fh.write( data )
+            offset += len( data )
+        part_fh.close()
+
+        if ( delete ):
+            os.unlink( part_file )
+
+    out_fh.write( EOF_BLOCK )
+    out_fh.close()
+
+    if ( index is not None ):
+        index.write( "{}.tbi".format( outfile ))
+
+    return outfile
+
+
+def _index_lines( index, data, position, block_offsets, final=False ):
+    """ indexes the complete lines in data, starting at an uncompressed position in the file
+
+    Args:
+      index (TabixIndex): index to fill
+      data (bytes): data from the start of a line
+      position (int): uncompressed position of data in the file
+      block_offsets (list of int): compressed offset of every block written, and of the next one
+      final (bool): data runs to the end of the file, so a last line without newline is indexed as well
+
+    Returns:
+      position (int) and data (bytes) of the last, incomplete, line
+
+    """
+
+    def virtual_offset( position ):
+        return ( block_offsets[ position // BLOCK_SIZE ] << 16 ) | ( position % BLOCK_SIZE )
+
+    line_begin = 0
+    while ( line_begin < len( data )):
+        line_end = data.find( b"\n", line_begin ) + 1
+        if ( line_end == 0 ):
+            if ( not final ):
+                break
+            line_end = len( data )
+
+        line = data[ line_begin:line_end ]
+        if ( line.strip() ):
+            if ( not isinstance( line, str )):
+                line = line.decode( 'ascii' )
+            index.add_line( line, virtual_offset( position + line_begin ), virtual_offset( position + line_end ))
+
+        line_begin = line_end
+
+    return position + line_begin, data[ line_begin: ]
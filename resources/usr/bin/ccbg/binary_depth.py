@@ -0,0 +1,227 @@
+#!/usr/bin/python
+#
+# Compact binary expected depth files, memory mapped and queried by
+# binary search without any decompression or string parsing.
+#
+# Layout, all little endian:
+#   magic "EXPDEPTH", uint32 version, uint32 number of chromosomes, uint64 number of rows
+#   per chromosome: uint32 name length, name, uint64 first row, uint64 number of rows
+#   zero padding to a multiple of 8 bytes
+#   columns of n rows: uint32 starts, uint32 ends, float32 means, float32 stddevs,
+#   uint32 reaches, the running maximum of the ends within each chromosome
+#
+# Regions may overlap or nest, so ends are not ordered; the reaches are,
+# and are what a lookup searches for the first row that can overlap it.
+#
+
+
+from __future__ import print_function
+import array
+import struct
+
+import numpy
+
+
+MAGIC   = b"EXPDEPTH"
+VERSION = 1
+
+COLUMNS = [('starts', '<u4'), ('ends', '<u4'), ('means', '<f4'), ('stddevs', '<f4')]
+
+REACH_COLUMN = ('reaches', '<u4')
+
+
+
+class BinaryDepthWriter( object ):
+    """ Collects expected depth rows and writes them as a binary depth file on close
+
+    Rows must be sorted on start, with each chromosome in one contiguous
+    run. Regions may overlap.
+    """
+
+    def __init__( self, filename ):
+        """
+        Args:
+          filename (str): file to write
+        """
+
+        self.filename = filename
+
+        self._chroms  = []
+        self._starts  = array.array( 'I' )
+        self._ends    = array.array( 'I' )
+        self._means   = array.array( 'f' )
+        self._stddevs = array.array( 'f' )
+
+
+    def add( self, chrom, start, end, mean, stddev ):
+        """ adds a row
+
+        Args:
+          chrom (str): chromosome
+          start (int): region start
+          end (int): region end
+          mean (float): expected depth
+          stddev (float): standard deviation
+
+        Returns:
+          None
+
+        Raises:
+          ValueError if the row is not sorted after the rows before it
+        """
+
+        if ( not self._chroms or self._chroms[-1][0] != chrom ):
+            if ( chrom in [ name for name, first_row, n_rows in self._chroms ] ):
+                raise ValueError( "{}: rows of chromosome {} are not in one run".format( self.filename, chrom ))
+
+            self._chroms.append( [chrom, len( self._starts ), 0] )
+
+        elif ( int( start ) < self._starts[-1] ):
+            raise ValueError( "{}: {}:{} comes after {}:{}, rows must be sorted".format( self.filename, chrom, start, chrom, self._starts[-1] ))
+
+        self._chroms[-1][2] += 1
+
+        self._starts.append( int( start ))
+        self._ends.append( int( end ))
+        self._means.append( float( mean ))
+        self._stddevs.append( float( stddev ))
+
+        return None
+
+
+    def close( self ):
+        """ writes the file
+
+        Returns:
+          None
+
+        """
+
+        header = [ MAGIC, struct.pack( "<IIQ", VERSION, len( self._chroms ), len( self._starts )) ]
+        for chrom, first_row, n_rows in self._chroms:
+            name = chrom.encode( 'ascii' ) if not isinstance( chrom, bytes ) else chrom
+            header.append( struct.pack( "<I", len( name )))
+            header.append( name )
+            header.append( struct.pack( "<QQ", first_row, n_rows ))
+
+        header = b"".join( header )
+        header += b"\0" * ( -len( header ) % 8 )
+
+        fh = open( self.filename, 'wb' )
+        fh.write( header )
+        for column, (column_name, dtype) in zip([self._starts, self._ends, self._means, self._stddevs], COLUMNS):
+            fh.write( numpy.frombuffer( column, dtype=column.typecode ).astype( dtype ).tobytes())
+
+        ends = numpy.frombuffer( self._ends, dtype=self._ends.typecode )
+        fh.write( _reaches( ends, self._chroms ).astype( REACH_COLUMN[1] ).tobytes())
+        fh.close()
+
+        return None
+
+
+
+def _reaches( ends, chroms ):
+    """ running maximum of the ends, restarted at each chromosome
+
+    Args:
+      ends (numpy array): region ends
+      chroms (list): (chrom, first row, number of rows) of each chromosome
+
+    Returns:
+      numpy array
+    """
+
+    reaches = numpy.array( ends, copy=True )
+    for chrom, first_row, n_rows in chroms:
+        if ( n_rows ):
+            rows = slice( first_row, first_row + n_rows )
+            reaches[ rows ] = numpy.maximum.accumulate( ends[ rows ] )
+
+    return reaches
+
+
+def open_binary_depth( filename ):
+    """ memory maps a binary depth file
+
+    Args:
+      filename (str): binary depth file
+
+    Returns:
+      dict with 'chroms', chrom: (first row, number of rows), and
+      the 'starts', 'ends', 'means', 'stddevs' and 'reaches' columns as memory mapped arrays
+
+    Raises:
+      ValueError if the file is not a binary depth file
+    """
+
+    fh = open( filename, 'rb' )
+    magic = fh.read( len( MAGIC ))
+    if ( magic != MAGIC ):
+        fh.close()
+        raise ValueError( "{} is not a binary depth file".format( filename ))
+
+    version, n_chroms, n_rows = struct.unpack( "<IIQ", fh.read( 16 ))
+    if ( version != VERSION ):
+        fh.close()
+        raise ValueError( "{} has unsupported version {}".format( filename, version ))
+
+    chroms = {}
+    for i in range( n_chroms ):
+        name_length, = struct.unpack( "<I", fh.read( 4 ))
+        name = fh.read( name_length ).decode( 'ascii' )
+        chroms[ name ] = struct.unpack( "<QQ", fh.read( 16 ))
+
+    offset = fh.tell()
+    offset += -offset % 8
+    fh.close()
+
+    table = { 'chroms': chroms }
+    for name, dtype in COLUMNS + [ REACH_COLUMN ]:
+        # an empty file cannot be memory mapped
+        if ( n_rows == 0 ):
+            table[ name ] = numpy.zeros( 0, dtype=dtype )
+            continue
+
+        table[ name ] = numpy.memmap( filename, dtype=dtype, mode='r', offset=offset, shape=(n_rows,))
+        offset += n_rows * numpy.dtype( dtype ).itemsize
+
+    return table
+
+
+def lookup_binary_depth( table, chrom, start, end ):
+    """ finds the rows overlapping a region by binary search
+
+    Args:
+      table (dict): binary depth file opened with open_binary_depth
+      chrom (str): chromosome
+      start (int): start position (included)
+      end (int): end position (included)
+
+    Returns:
+      dict of 'starts', 'ends', 'means' and 'stddevs' arrays, None if the chromosome is not in the file
+
+    """
+
+    if ( chrom not in table[ 'chroms' ] ):
+        return None
+
+    first_row, n_rows = table[ 'chroms' ][ chrom ]
+    rows = slice( first_row, first_row + n_rows )
+
+    # starts and reaches are ordered, ends are not when regions overlap
+    first = numpy.searchsorted( table[ 'reaches' ][ rows ], int( start ), side='left' )
+    last  = numpy.searchsorted( table[ 'starts' ][ rows ], int( end ), side='right' )
+    if ( last < first ):
+        last = first
+
+    found = {}
+    for name, dtype in COLUMNS:
+        found[ name ] = table[ name ][ first_row + first:first_row + last ]
+
+    # only regions nested in an earlier one can end before start within the slice
+    reaching = found[ 'ends' ] >= int( start )
+    if ( not reaching.all() ):
+        for name, dtype in COLUMNS:
+            found[ name ] = found[ name ][ reaching ]
+
+    return found
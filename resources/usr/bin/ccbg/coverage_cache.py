@@ -0,0 +1,219 @@
+#!/usr/bin/python
+#
+# An on disk cache of coverage reports in sqlite, so reports over the same
+# regions of the same depth files are looked up rather than recomputed.
+#
+# Reports are keyed by depth file path, region, min_coverage and
+# thresholds. A depth file whose size, mtime or inode, or those of its
+# tabix index, have changed has its reports dropped, and the least recently used reports are dropped once the cache
+# holds more than its size limit.
+#
+
+
+from __future__ import print_function
+import os
+import sqlite3
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import ccbg.toolbox as toolbox
+
+
+# default most bytes of pickled reports kept
+MAX_BYTES = 256 * 1024 * 1024
+
+# version of the cached reports, bump if the reports change so old caches are ignored
+CACHE_VERSION = 2
+
+SCHEMA = [ "CREATE TABLE IF NOT EXISTS info ( name TEXT PRIMARY KEY, value TEXT )",
+           "CREATE TABLE IF NOT EXISTS files ( path TEXT PRIMARY KEY, identity TEXT )",
+           "CREATE TABLE IF NOT EXISTS reports ( path TEXT, chrom TEXT, start INTEGER, end INTEGER, min_coverage INTEGER, thresholds TEXT, "
+           "report BLOB, bytes INTEGER, used REAL, PRIMARY KEY ( path, chrom, start, end, min_coverage, thresholds ))",
+           "CREATE INDEX IF NOT EXISTS reports_used ON reports ( used )" ]
+
+
+
+def _thresholds_key( thresholds ):
+    """ the thresholds as they are stored in the key, '' for none """
+
+    if ( not thresholds ):
+        return ''
+
+    return ",".join([ str( int( threshold )) for threshold in thresholds ])
+
+
+
+class CoverageCache( object ):
+    """ Coverage reports of depth file regions, in a sqlite file """
+
+    def __init__( self, filename, max_bytes=MAX_BYTES ):
+        """
+        Args:
+          filename (str): sqlite file, made if it does not exist
+          max_bytes (int): most bytes of pickled reports kept, default MAX_BYTES
+        """
+
+        self.filename  = filename
+        self.max_bytes = max_bytes
+
+        # a busy cache used by other processes is waited for, rather than failed on
+        self._db = sqlite3.connect( filename, timeout=60 )
+
+        with self._db:
+            self._db.execute( SCHEMA[0] )
+
+            version = self._db.execute( "SELECT value FROM info WHERE name = 'version'" ).fetchone()
+            if ( version is None or version[0] != str( CACHE_VERSION )):
+                # the tables of other versions may not have the same columns
+                self._db.execute( "DROP TABLE IF EXISTS reports" )
+                self._db.execute( "DROP TABLE IF EXISTS files" )
+                self._db.execute( "INSERT OR REPLACE INTO info VALUES ( 'version', ? )", ( str( CACHE_VERSION ), ))
+
+            for statement in SCHEMA[1:]:
+                self._db.execute( statement )
+
+
+    def _check_file( self, depth_file ):
+        """ the cache path of a depth file, dropping its reports if the file or its index has changed since they were cached
+
+        The reports are then made again from the new file, as ccbg.depth
+        reopens its pooled handle of a file that has changed.
+
+        Args:
+          depth_file (str): depth file
+
+        Returns:
+          path (str)
+
+        """
+
+        path = os.path.abspath( depth_file )
+        if ( not os.path.isfile( path )):
+            raise IOError( "{} does not exist".format( depth_file ))
+
+        identity = repr( toolbox.tabix_identity( path ))
+
+        cached = self._db.execute( "SELECT identity FROM files WHERE path = ?", ( path, )).fetchone()
+        if ( cached is None or cached[0] != identity ):
+            self._db.execute( "DELETE FROM reports WHERE path = ?", ( path, ))
+            self._db.execute( "INSERT OR REPLACE INTO files VALUES ( ?, ? )", ( path, identity ))
+
+        return path
+
+
+    def lookup( self, depth_file, regions, min_coverage, thresholds=None ):
+        """ the cached reports of regions of a depth file
+
+        Args:
+          depth_file (str): depth file
+          regions (list): (chrom, start, end) tuples, start and end included
+          min_coverage (int): depth cutoff the reports were made with
+          thresholds (list of int): thresholds the reports were made with, default none
+
+        Returns:
+          dict of (chrom, start, end): report, for the regions in the cache
+
+        """
+
+        found = {}
+        now = time.time()
+        thresholds = _thresholds_key( thresholds )
+
+        with self._db:
+            path = self._check_file( depth_file )
+
+            for chrom, start, end in regions:
+                key = ( path, chrom, int( start ), int( end ), int( min_coverage ), thresholds )
+                row = self._db.execute( "SELECT report FROM reports WHERE path = ? AND chrom = ? AND start = ? AND end = ? "
+                                        "AND min_coverage = ? AND thresholds = ?", key ).fetchone()
+                if ( row is None ):
+                    continue
+
+                found[( chrom, start, end )] = pickle.loads( bytes( row[0] ))
+                self._db.execute( "UPDATE reports SET used = ? WHERE path = ? AND chrom = ? AND start = ? AND end = ? "
+                                  "AND min_coverage = ? AND thresholds = ?", ( now, ) + key )
+
+        return found
+
+
+    def store( self, depth_file, reports, min_coverage, thresholds=None ):
+        """ adds reports of regions of a depth file, then drops the least recently used reports while the cache is too big
+
+        Args:
+          depth_file (str): depth file
+          reports (list): ((chrom, start, end), report) tuples
+          min_coverage (int): depth cutoff the reports were made with
+          thresholds (list of int): thresholds the reports were made with, default none
+
+        Returns:
+          None
+
+        """
+
+        now = time.time()
+        thresholds = _thresholds_key( thresholds )
+
+        with self._db:
+            path = self._check_file( depth_file )
+
+            for ( chrom, start, end ), report in reports:
+                report = pickle.dumps( report, pickle.HIGHEST_PROTOCOL )
+                self._db.execute( "INSERT OR REPLACE INTO reports VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ? )",
+                                  ( path, chrom, int( start ), int( end ), int( min_coverage ), thresholds,
+                                    sqlite3.Binary( report ), len( report ), now ))
+
+            self._evict()
+
+        return None
+
+
+    def _evict( self ):
+        """ drops the least recently used reports until the cache is within max_bytes """
+
+        total = self._db.execute( "SELECT COALESCE( SUM( bytes ), 0 ) FROM reports" ).fetchone()[0]
+        if ( total <= self.max_bytes ):
+            return None
+
+        dropped = []
+        for rowid, size in self._db.execute( "SELECT rowid, bytes FROM reports ORDER BY used" ):
+            if ( total <= self.max_bytes ):
+                break
+
+            dropped.append(( rowid, ))
+            total -= size
+
+        self._db.executemany( "DELETE FROM reports WHERE rowid = ?", dropped )
+
+        return None
+
+
+    def size( self ):
+        """ bytes of pickled reports in the cache
+
+        Returns:
+          int
+
+        """
+
+        return self._db.execute( "SELECT COALESCE( SUM( bytes ), 0 ) FROM reports" ).fetchone()[0]
+
+
+    def __len__( self ):
+        return self._db.execute( "SELECT COUNT(*) FROM reports" ).fetchone()[0]
+
+
+    def close( self ):
+        """ closes the sqlite file
+
+        Returns:
+          None
+
+        """
+
+        self._db.close()
+
+        return None
@@ -1,21 +1,177 @@
 
 import sys
-import re
 import os 
+import tempfile
+import collections
+import multiprocessing
 import pprint as pp
 
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import numpy
 import pysam
 
 import ccbg.toolbox as toolbox
+import ccbg.bgzf as bgzf
+import ccbg.intervals as intervals
 
 
 
 # ============== Generate depth functions =========================
 
+# the standard bin floors for binned depths
 INTERVALS = [20, 10, 5, 1, 0]
-binned_depth = False
 
-def make_region( bamfile, chrom=None, start=None, end=None, fh=None):
+# unmapped, secondary, qc-failed and duplicate reads, the reads pileup skips
+PILEUP_SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+
+# cigar operations that cover the reference: M, D, N, = and X
+REFERENCE_OPERATIONS = set([0, 2, 3, 7, 8])
+
+# most tabix handles the reporting functions keep open at once
+TABIX_POOL_SIZE = 16
+
+# depth buckets of the coverage reports, the lowest depth of each and whether their blocks are listed
+COVERAGE_BUCKETS = [ ('0x', 0, True), ('1-5x', 1, True), ('6-9x', 6, True), ('10-19x', 10, True), ('20x', 20, False) ]
+
+# depths the summary index counts the bases at or above by default
+SUMMARY_THRESHOLDS = [1, 6, 10, 20, 30, 50, 100]
+
+# most summary indexes kept loaded at once
+SUMMARY_POOL_SIZE = 16
+
+def region_depths( bamfile, chrom, start, end ):
+    """Counts the depth of every base in a region from the aligned blocks of the reads
+
+    Every read adds one at the start, and removes one past the end, of each
+    block it covers in a difference array, and the cumulative sum gives the
+    depth. Bases without reads simply stay 0. Reads are filtered and counted
+    as by pileup: unmapped, secondary, qc-failed and duplicate reads are
+    skipped, and deletions and reference skips count towards the depth. Unlike
+    pileup the depth is not capped.
+
+    Args:
+        bamfile: pysam bamfile handle
+        chrom (str): chromosome
+        start (int): start position (included)
+        end (int): end position (included)
+
+    Returns:
+        numpy int32 array with the depth of every base from start to end
+
+    Raises:
+        No exceptions are caught by the function
+    """
+
+    start = int( start )
+    end   = int( end   )
+
+    block_starts = []
+    block_ends   = []
+
+    for read in bamfile.fetch( chrom, start - 1, end ):
+        if ( read.flag & PILEUP_SKIP_FLAGS ):
+            continue
+
+        for block_start, block_end in _reference_blocks( read ):
+            block_starts.append( block_start )
+            block_ends.append( block_end )
+
+    return _depths_from_blocks( block_starts, block_ends, start, end )
+
+
+def _reference_blocks( read ):
+    """the blocks of the reference a read covers, the ones counted by pileup
+
+    Args:
+        read: pysam aligned read
+
+    Returns:
+        list of (start, end), 0-based half open
+    """
+
+    blocks = []
+    pos = read.pos
+    for operation, operation_length in read.cigar:
+        if ( operation in REFERENCE_OPERATIONS ):
+            blocks.append(( pos, pos + operation_length ))
+            pos += operation_length
+
+    return blocks
+
+
+def _depths_from_blocks( block_starts, block_ends, start, end ):
+    """turns the read blocks over a region into the depth of every base in it
+
+    Args:
+        block_starts (list of int): 0-based block starts
+        block_ends (list of int): 0-based, excluded, block ends
+        start (int): region start position (included)
+        end (int): region end position (included)
+
+    Returns:
+        numpy int32 array with the depth of every base from start to end
+    """
+
+    offset = start - 1
+    length = end - offset
+
+    block_starts = numpy.clip( numpy.array( block_starts, dtype=numpy.int64 ) - offset, 0, length )
+    block_ends   = numpy.clip( numpy.array( block_ends,   dtype=numpy.int64 ) - offset, 0, length )
+
+    differences  = numpy.bincount( block_starts, minlength=length + 1 )
+    differences -= numpy.bincount( block_ends,   minlength=length + 1 )
+
+    return numpy.cumsum( differences[:length] ).astype( numpy.int32 )
+
+
+def bin_depths( depths, bins=None ):
+    """Maps every depth to the highest bin floor it reaches
+
+    Depths below the lowest floor are left as they are.
+
+    Args:
+        depths (numpy array): depth per base
+        bins (list of int): bin floors, in any order, None to leave the depths as they are
+
+    Returns:
+        numpy array of binned depths
+    """
+
+    if ( bins is None ):
+        return depths
+
+    floors = numpy.array( sorted( bins ), dtype=depths.dtype )
+    bin_index = numpy.searchsorted( floors, depths, side='right' ) - 1
+
+    return numpy.where( bin_index >= 0, floors[ numpy.maximum( bin_index, 0 )], depths )
+
+
+def depth_blocks( depths ):
+    """Run length encodes a depth array into blocks of equal depth
+
+    Args:
+        depths (numpy array): depth per base
+
+    Returns:
+        block starts, block ends (included) and depths as numpy arrays, positions are indexes into depths
+    """
+
+    if ( len( depths ) == 0 ):
+        return numpy.array([], dtype=numpy.int64), numpy.array([], dtype=numpy.int64), depths
+
+    changes = numpy.flatnonzero( numpy.diff( depths )) + 1
+
+    block_starts = numpy.concatenate(([0], changes ))
+    block_ends   = numpy.concatenate(( changes, [len( depths )] )) - 1
+
+    return block_starts, block_ends, depths[ block_starts ]
+
+
+def make_region( bamfile, chrom=None, start=None, end=None, fh=None, bins=None):
     """Finds the depth for a region in a bamfile defined by chrom, start and end
     
     
@@ -25,6 +181,7 @@ def make_region( bamfile, chrom=None, start=None, end=None, fh=None):
         start (int): start position (included)
         end (int): end position (included)
         fh(file-handle): filehandle to write to, otherwise stdout
+        bins(list of int): report depths as the bin floor they fall in, eg INTERVALS, default unbinned
 
     Returns:
         print depths to stdout, but returns nothing
@@ -38,55 +195,28 @@ def make_region( bamfile, chrom=None, start=None, end=None, fh=None):
     start = int( start )
     end   = int( end   ) 
 
-    first_entry = True
-
-    prev_end = None
-
-    for rec in bamfile.pileup(chrom, start, end):
-        # if the first position is after the wanted start position, pad with 0's
-        if first_entry and rec.pos + 1 > start:
-            for i in range( start, rec.pos + 1):
-                toolbox.print_stdout_or_file( "\t".join(map(str, [bamfile.getrname(rec.tid), i, 0]))+"\n", fh)
-        
-        first_entry = False
-
-        # old code, that might be useful later
-        # If we are doing binned depths, iterate through the values to we find the correc bin.
-        if ( binned_depth ):
-            for bin_depth in sorted( bins, reverse=True ):
-                if ( rec.n >= bin_depth ):
-                    rec.n = bin_depth
-                    break
-
+    _write_depths( chrom, start, bin_depths( region_depths( bamfile, chrom, start, end ), bins ), fh )
 
 
-        # check positions as we get reads spanning the region and thus would get depths outside the wanted region.
-        if rec.pos + 1 < start:
-            continue
-        if rec.pos + 1 > end:
-            return
+def _write_depths( chrom, start, depths, fh=None ):
+    """writes a depth array one base per line
 
-        # there is an area in the wanted region that does not have any reads, fill in with 0's
-        if ( prev_end is not None and prev_end < rec.pos + 1 ):
-            for i in range( prev_end+1, rec.pos + 1):
-                toolbox.print_stdout_or_file( "\t".join(map(str, [bamfile.getrname(rec.tid), i, 0]))+"\n", fh)
-
-        toolbox.print_stdout_or_file( "\t".join(map(str, [bamfile.getrname(rec.tid), rec.pos + 1, rec.n]))+"\n", fh)
-        prev_end = rec.pos + 1
+    Args:
+        chrom (str): chromosome
+        start (int): position of the first base in the array
+        depths (numpy array): depth per base
+        fh(file-handle): filehandle to write to, otherwise stdout
 
-    # No reads in the region, so make a lot of 0's
-    if ( prev_end is None):
-        for i in range( start, end +1):
-            toolbox.print_stdout_or_file( "\t".join(map(str, [chrom, i, 0]))+"\n", fh)
+    Returns:
+        None
+    """
 
-    # if the past position is before the wanted endpos, pad with 0's
-    elif ( prev_end < end ):
-        for i in range( prev_end+1, end +1):
-            toolbox.print_stdout_or_file( "\t".join(map(str, [bamfile.getrname(rec.tid), i, 0]))+"\n", fh)
+    lines = [ "{}\t{}\t{}\n".format( chrom, pos, depth ) for pos, depth in zip( range( start, start + len( depths )), depths.tolist()) ]
+    toolbox.print_stdout_or_file( "".join( lines ), fh )
 
 
 
-def make_region_in_blocks(bamfile, chrom=None, start=None, end=None, fh=None):
+def make_region_in_blocks(bamfile, chrom=None, start=None, end=None, fh=None, bins=None):
     """Print the depth, in blocks, for a region in a bamfile defined by chrom, start and end
     
     Args:
@@ -95,6 +225,8 @@ def make_region_in_blocks(bamfile, chrom=None, start=None, end=None, fh=None):
         start (int): start position (included)
         end (int): end position (included)
         fh(file-handle): filehandle to write to, otherwise stdout
+        bins(list of int): report depths as the bin floor they fall in, eg INTERVALS, default unbinned.
+                           Neighbouring bases in the same bin are merged into one block
     
     Returns:
         print depths to stdout, but returns nothing
@@ -106,59 +238,29 @@ def make_region_in_blocks(bamfile, chrom=None, start=None, end=None, fh=None):
     start = int( start )
     end   = int( end   ) 
 
-    ( prev_chrom, prev_start, prev_ref, prev_end, prev_depth) = ( None, None, None, None, None)
-    prev_printed = None
-    for rec in bamfile.pileup(chrom, start, end):
-        # if the first position is after the wanted start position, pad with 0's
-        if prev_start is  None and rec.pos + 1 > start:
-            toolbox.print_stdout_or_file( "\t".join(map(str, [bamfile.getrname(rec.tid), start, rec.pos, 0]))+"\n", fh)
+    _write_depth_blocks( chrom, start, bin_depths( region_depths( bamfile, chrom, start, end ), bins ), fh )
 
-        # check positions as we get reads spanning the region and thus would get depths outside the wanted region.
-        if rec.pos + 1 < start:
-            continue
-        if rec.pos + 1 > end:
-            break
-
-        # old code, that might be useful later
-        # If we are doing binned depths, iterate through the values to we find the correc bin.
-        if ( binned_depth ):
-            for bin_depth in sorted( bins, reverse=True ):
-                if ( rec.n >= bin_depth ):
-                    rec.n = bin_depth
-                    break
-
-
-        # there is an area in the wanted region that does not have any reads.
-        # Print prev region and print a new 0 reads block
-        if ( prev_end is not None and prev_end + 1 < rec.pos ):
-            toolbox.print_stdout_or_file( "\t".join(map(str, [prev_chrom, prev_start, prev_end, prev_depth]))+"\n", fh)
-            toolbox.print_stdout_or_file( "\t".join(map(str, [prev_chrom, prev_end+1, rec.pos , 0]))+"\n", fh)
-            ( prev_chrom, prev_start, prev_end, prev_depth) = ( bamfile.getrname(rec.tid), rec.pos+1, rec.pos+1, rec.n)
-        
-        # first data set the counters
-        if ( prev_depth is None):
-            ( prev_chrom, prev_start, prev_end, prev_depth) = ( bamfile.getrname(rec.tid), rec.pos+1, rec.pos+1, rec.n)
-        # Same depth as the prev base increase prev_endpos with one
-        elif (  prev_depth == rec.n ):
-            prev_end = rec.pos + 1
-        else:
-            toolbox.print_stdout_or_file( "\t".join(map(str, [prev_chrom, prev_start, prev_end, prev_depth]))+"\n", fh)
-            prev_printed =  rec.pos 
-            ( prev_chrom, prev_start, prev_end, prev_depth) = ( bamfile.getrname(rec.tid), rec.pos+1, rec.pos+1, rec.n)
 
-    # print the last block seen
-    if ( prev_chrom is not None):
-        toolbox.print_stdout_or_file( "\t".join(map(str, [prev_chrom, prev_start, prev_end, prev_depth]))+"\n", fh)
+def _write_depth_blocks( chrom, start, depths, fh=None ):
+    """writes a depth array as blocks of equal depth
 
-    if ( prev_end is None):
-        toolbox.print_stdout_or_file( "\t".join(map(str, [chrom, start, end, 0]))+"\n", fh)
+    Args:
+        chrom (str): chromosome
+        start (int): position of the first base in the array
+        depths (numpy array): depth per base
+        fh(file-handle): filehandle to write to, otherwise stdout
+
+    Returns:
+        None
+    """
 
+    block_starts, block_ends, block_depths = depth_blocks( depths )
 
-    # if the past position is before the wanted endpos, pad with a 0 block
-    if ( prev_end is not None and prev_end < end ):
-        toolbox.print_stdout_or_file( "\t".join(map(str, [prev_chrom, prev_end+1, end, 0]))+"\n", fh)
+    lines = [ "{}\t{}\t{}\t{}\n".format( chrom, block_start + start, block_end + start, depth )
+              for block_start, block_end, depth in zip( block_starts.tolist(), block_ends.tolist(), block_depths.tolist()) ]
+    toolbox.print_stdout_or_file( "".join( lines ), fh )
 
-def make_regions_from_bedfile( bamfile, bedfile, block = False, fh=None):
+def make_regions_from_bedfile( bamfile, bedfile, block = False, fh=None, sweep=False, bins=None):
     """Calculates depths based on entries in a bedfile
     
     
@@ -167,6 +269,9 @@ def make_regions_from_bedfile( bamfile, bedfile, block = False, fh=None):
         bedfile(str): name of the bedfile to read regions from
         block(bool): report as blocks or single base resolution, default false
         fh(file-handle): filehandle to write to, otherwise stdout
+        sweep(bool): read the bamfile once per chromosome instead of once per region,
+                     regions are then reported sorted within each chromosome
+        bins(list of int): report depths as the bin floor they fall in, eg INTERVALS, default unbinned
 
     Returns:
         print depths to stdout, but returns nothing
@@ -176,6 +281,12 @@ def make_regions_from_bedfile( bamfile, bedfile, block = False, fh=None):
         No exceptions are caught by the function
     """
 
+    if ( sweep ):
+        for chrom, regions in _read_bed_by_chrom( bedfile ):
+            _sweep_chromosome( bamfile, chrom, regions, block, fh, bins )
+
+        return
+
     bed_fh = open( bedfile, 'r')
     for line in bed_fh.readlines():
         line = line.strip("\n")
@@ -187,174 +298,1191 @@ def make_regions_from_bedfile( bamfile, bedfile, block = False, fh=None):
         end   = int( end  )
 
         if block and block is not None:
-            make_region_in_blocks(bamfile, chrom, start + 1, end , fh)
+            make_region_in_blocks(bamfile, chrom, start + 1, end , fh, bins)
         else:
-            make_region(bamfile, chrom, start + 1, end, fh)
+            make_region(bamfile, chrom, start + 1, end, fh, bins)
 
 
 
 
-def compress_depth_file( filename, outfile=None, delete_file=True):
-    """compresses a tab file.
+def make_regions_from_bedfile_parallel( bam_file, bedfile, outfile, block=False, processes=None, partition='bases', chunks=None, bins=None ):
+    """Calculates depths based on entries in a bedfile, spread over a pool of processes
+
+    The bed regions are split, keeping their order, into chunks of about the
+    same number of bases or into runs of regions on the same chromosome. Each
+    worker opens its own handle on the bamfile and compresses and indexes
+    its chunk as a BGZF part, and the parts are joined in bed order into one
+    bgzipped file with bgzf.join_files, merging their indexes, so nothing is
+    compressed or read back in by the parent. The depths are the same as a
+    serial make_regions_from_bedfile run.
 
     Args:
-        filename (str): file to compress
-        outfile ( str): name of compressed file, default is [filename].gz
-        delete_file (bool): delete original file after compression, default is True
+        bam_file(str): name of the bamfile
+        bedfile(str): name of the bedfile to read regions from
+        outfile(str): bgzipped depth file to write
+        block(bool): report as blocks or single base resolution, default false
+        processes(int): size of the process pool, default one per core
+        partition(str): 'bases' for chunks of balanced base counts, 'chrom' for one chunk per chromosome run
+        chunks(int): number of chunks for 'bases', default four per process
+        bins(list of int): report depths as the bin floor they fall in, eg INTERVALS, default unbinned
 
     Returns:
-        filename (str): filename of compressed file
+        outfile (str)
 
-    
+    Raises:
+        No exceptions are caught by the function
     """
 
-    if ( outfile is None):
-        outfile = "{}.gz".format( filename )
+    regions = []
+    bed_fh = open( bedfile, 'r')
+    for line in bed_fh.readlines():
+        fields = line.strip("\n").split("\t")
+        regions.append(( fields[0], int( fields[1] ) + 1, int( fields[2] )))
+    bed_fh.close()
 
-    pysam.tabix_compress( filename, outfile , force=True )
+    if ( processes is None ):
+        processes = multiprocessing.cpu_count()
 
-    if ( delete_file ):
-        os.unlink( filename )
+    if ( partition == 'chrom' ):
+        region_chunks = _chunk_regions_by_chrom( regions )
+    else:
+        region_chunks = _chunk_regions_by_bases( regions, chunks or processes * 4 )
+
+    pool = multiprocessing.Pool( processes )
+    try:
+        parts = pool.imap( _depth_chunk, [ (bam_file, chunk, block, bins) for chunk in region_chunks ] )
+        bgzf.join_files( parts, outfile, index=_depth_file_index( single_base=not block ), delete=True )
+    finally:
+        pool.terminate()
 
     return outfile
 
 
+def _chunk_regions_by_bases( regions, chunks ):
+    """splits regions, in order, into chunks with about the same number of bases
 
-def index_depth_file( filename, single_base=False ):
-    """indexes a compressed depth tab file
-    
-    prev existing index files will be overwritten
+    Args:
+        regions(list): (chrom, start, end) tuples
+        chunks(int): number of chunks wanted
+
+    Returns:
+        list of lists of regions
+    """
+
+    total = sum([ end - start + 1 for chrom, start, end in regions ])
+    target = max( 1, total // max( 1, chunks ))
+
+    region_chunks = [[]]
+    bases = 0
+    for region in regions:
+        if ( bases >= target ):
+            region_chunks.append( [] )
+            bases = 0
+
+        region_chunks[-1].append( region )
+        bases += region[2] - region[1] + 1
+
+    return region_chunks
+
+
+def _chunk_regions_by_chrom( regions ):
+    """splits regions, in order, into runs of regions on the same chromosome
 
     Args:
-        filename (str): file to index
-        single_base (bool): the file contains single base resolution data
+        regions(list): (chrom, start, end) tuples
 
     Returns:
-        None
+        list of lists of regions
+    """
 
-    
+    region_chunks = []
+    for region in regions:
+        if ( not region_chunks or region_chunks[-1][-1][0] != region[0] ):
+            region_chunks.append( [] )
+
+        region_chunks[-1].append( region )
+
+    return region_chunks
+
+
+def _depth_chunk( chunk ):
+    """writes the depths of a chunk of regions to a temporary BGZF part, run in a worker process
+
+    Args:
+        chunk(tuple): bamfile name, list of (chrom, start, end), the block flag and bins
+
+    Returns:
+        name of the part file (str) and its tabix index (bgzf.TabixIndex)
     """
 
-    if ( single_base ):
-        pysam.tabix_index(filename, force=True , seq_col=0,start_col=1, end_col=1)
-    else:
-        pysam.tabix_index(filename, force=True , seq_col=0,start_col=1, end_col=2)
+    bam_file, regions, block, bins = chunk
 
-    return None
+    bamfile = pysam.Samfile( bam_file, 'rb' )
 
+    fd, chunk_file = tempfile.mkstemp( suffix=".depth.gz" )
+    os.close( fd )
 
+    index = _depth_file_index( single_base=not block )
+    fh = bgzf.BgzfWriter( chunk_file, index=index, eof=False )
+    for chrom, start, end in regions:
+        region_fh = StringIO()
+        if ( block ):
+            make_region_in_blocks( bamfile, chrom, start, end, region_fh, bins )
+        else:
+            make_region( bamfile, chrom, start, end, region_fh, bins )
 
+        for line in region_fh.getvalue().splitlines( True ):
+            fh.write_line( line )
+    fh.close()
 
+    bamfile.close()
 
-# =============== reporting functions ====================
+    return chunk_file, index
 
 
-def view_region( depth_file, chrom=None, start=None, end=None):
-    """reports the depths for, optionally a region, in a depth-file. Region is defined by chrom, start and end
-    
-    
+def _read_bed_by_chrom( bedfile ):
+    """reads the regions of a bedfile grouped by chromosome
+
+    Args:
+        bedfile(str): name of the bedfile to read regions from
+
+    Returns:
+        list of (chrom, regions), chromosomes in the order they are first seen and
+        regions as sorted (start, end) tuples, 1-based and inclusive
+    """
+
+    chroms  = []
+    regions = {}
+
+    bed_fh = open( bedfile, 'r')
+    for line in bed_fh.readlines():
+        line = line.strip("\n")
+
+        fields = line.split("\t")
+
+        chrom, start, end =  fields[:3]
+
+        if ( chrom not in regions ):
+            chroms.append( chrom )
+            regions[ chrom ] = []
+
+        regions[ chrom ].append(( int( start ) + 1, int( end )))
+
+    bed_fh.close()
+
+    return [ (chrom, sorted( regions[ chrom ] )) for chrom in chroms ]
+
+
+def _sweep_chromosome( bamfile, chrom, regions, block=False, fh=None, bins=None ):
+    """Calculates the depths of all the regions on a chromosome from one pass over its reads
+
     Args:
-        depth_file: name of file to read from
+        bamfile: pysam bamfile handle
         chrom (str): chromosome
-        start (int): start position (included)
-        end (int): end position (included)
+        regions (list): sorted (start, end) tuples, 1-based and inclusive
+        block(bool): report as blocks or single base resolution, default false
+        fh(file-handle): filehandle to write to, otherwise stdout
+        bins(list of int): bin floors to report depths as, default unbinned
 
     Returns:
-        print depths to stdout, but returns nothing
+        None
+    """
+
+    if ( block ):
+        writer = _write_depth_blocks
+    else:
+        writer = _write_depths
+
+    for region, depths in _sweep_depths( bamfile, chrom, regions ):
+        writer( chrom, region[0], bin_depths( depths, bins ), fh )
+
+
+def _sweep_depths( bamfile, chrom, regions ):
+    """Counts the depths of all the regions on a chromosome from one pass over its reads
+
+    Reads are streamed in position order and their blocks handed to every
+    region they overlap. A region is yielded once the reads have moved past
+    its end.
+
+    Args:
+        bamfile: pysam bamfile handle
+        chrom (str): chromosome
+        regions (list): sorted tuples starting with start and end, 1-based and inclusive
+
+    Returns:
+        generator of (region, depths), regions in the order given
+    """
+
+    # region, block starts and block ends of the regions the reads have reached
+    active  = []
+    pending = list( reversed( regions ))
+
+    def region_depths( region ):
+        region, block_starts, block_ends = region
+        return region, _depths_from_blocks( block_starts, block_ends, region[0], region[1] )
+
+    for read in bamfile.fetch( chrom, regions[0][0] - 1, max([ region[1] for region in regions ])):
+        if ( read.flag & PILEUP_SKIP_FLAGS ):
+            continue
+
+        blocks = _reference_blocks( read )
+        if ( not blocks ):
+            continue
+
+        read_start = blocks[0][0]
+        read_end   = blocks[-1][1]
+
+        # no later read can reach these regions anymore
+        while ( active and active[0][0][1] <= read_start ):
+            yield region_depths( active.pop( 0 ))
+
+        while ( pending and pending[-1][0] - 1 < read_end ):
+            active.append(( pending.pop(), [], [] ))
+
+        for region, block_starts, block_ends in active:
+            if ( region[0] - 1 < read_end and read_start < region[1] ):
+                for block_start, block_end in blocks:
+                    block_starts.append( block_start )
+                    block_ends.append( block_end )
+
+    for region in active:
+        yield region_depths( region )
+
+    for region in reversed( pending ):
+        yield region_depths(( region, [], [] ))
+
+
+def make_region_outputs( bamfile, bedfile, bases_fh=None, blocks_fh=None, means_fh=None, thresholds_fh=None,
+                         thresholds=INTERVALS, bins=None, sweep=False ):
+    """Reads the depths of every region in a bedfile once and writes them to any of four outputs
+
+    The outputs are the per base depths (as make_region), the depth blocks
+    (as make_region_in_blocks), the mean depth per region in the region
+    coverage layout read by expected_depth_for_run.py (chrom, start, end,
+    name, mean) and the number of bases per region at or above each
+    threshold. Outputs without a filehandle are not made.
+
+    Args:
+        bamfile: pysam bamfile handle
+        bedfile(str): name of the bedfile to read regions from, the name is taken from the 4th column onwards
+        bases_fh(file-handle): filehandle for the per base depths, default none
+        blocks_fh(file-handle): filehandle for the depth blocks, default none
+        means_fh(file-handle): filehandle for the region mean depths, default none
+        thresholds_fh(file-handle): filehandle for the region threshold base counts, default none
+        thresholds(list of int): depths to count the bases at or above, default INTERVALS
+        bins(list of int): bin floors for the per base and block depths, default unbinned. Means and threshold counts use the depths as they are
+        sweep(bool): read the bamfile once per chromosome instead of once per region,
+                     regions are then reported sorted within each chromosome
+
+    Returns:
+        None
 
-    
     Raises:
         No exceptions are caught by the function
     """
 
-    depth_in = pysam.TabixFile( depth_file )
-   
+    if ( means_fh is not None ):
+        means_fh.write( "#chrom\tstart\tend\tname\tmean\n" )
 
-    if ( chrom is None):
-        iterator = depth_in.fetch()
-    else:
-        try:
-            iterator = depth_in.fetch(chrom, int(start)-1, int(end)-1)
-        except:
-            return
+    if ( thresholds_fh is not None ):
+        thresholds_fh.write( "#chrom\tstart\tend\tname\t{}\n".format( "\t".join([ "{}x".format( threshold ) for threshold in thresholds ])))
 
-    for row in iterator:
-        print( row )
+    chroms  = []
+    regions = {}
+
+    bed_fh = open( bedfile, 'r')
+    for line in bed_fh.readlines():
+        fields = line.strip("\n").split("\t")
 
+        chrom = fields[0]
+        start = int( fields[1] ) + 1
+        end   = int( fields[2] )
+        name  = "_".join( fields[3:] ) or "{}:{}-{}".format( chrom, start, end )
+
+        if ( chrom not in regions ):
+            chroms.append( chrom )
+            regions[ chrom ] = []
+
+        regions[ chrom ].append(( start, end, name ))
+    bed_fh.close()
+
+    for chrom in chroms:
+        if ( sweep ):
+            region_iterator = _sweep_depths( bamfile, chrom, sorted( regions[ chrom ] ))
+        else:
+            region_iterator = ( (region, region_depths( bamfile, chrom, region[0], region[1] )) for region in regions[ chrom ] )
+
+        for ( start, end, name ), depths in region_iterator:
+            _write_region_outputs( chrom, start, end, name, depths, bases_fh, blocks_fh, means_fh, thresholds_fh, thresholds, bins )
+
+    return None
+
+
+def _write_region_outputs( chrom, start, end, name, depths, bases_fh, blocks_fh, means_fh, thresholds_fh, thresholds, bins ):
+    """writes the depths of a region to the outputs of make_region_outputs
 
-def view_region_from_bedfile( depth_file, bed_file):
-    """reports the depths for, optionally a region, in a depth-file. Region is defined by chrom, start and end
-    
-    
     Args:
-        depth_file: name of file to read from
-        bedfile(str): name of the bedfile to read regions from
+        chrom (str): chromosome
+        start (int): start position (included)
+        end (int): end position (included)
+        name (str): region name
+        depths (numpy array): depth per base
+        bases_fh, blocks_fh, means_fh, thresholds_fh (file-handle): outputs, None to skip one
+        thresholds (list of int): depths to count the bases at or above
+        bins (list of int): bin floors for the per base and block depths, None for unbinned
+
+    Returns:
+        None
+    """
+
+    if ( bases_fh is not None or blocks_fh is not None ):
+        binned = bin_depths( depths, bins )
+
+        if ( bases_fh is not None ):
+            _write_depths( chrom, start, binned, bases_fh )
+
+        if ( blocks_fh is not None ):
+            _write_depth_blocks( chrom, start, binned, blocks_fh )
+
+    if ( means_fh is not None ):
+        mean = depths.mean() if len( depths ) else 0.0
+        means_fh.write( "{}\t{}\t{}\t{}\t{:.3f}\n".format( chrom, start, end, name, mean ))
+
+    if ( thresholds_fh is not None ):
+        counts = [ int( numpy.count_nonzero( depths >= threshold )) for threshold in thresholds ]
+        thresholds_fh.write( "{}\t{}\t{}\t{}\t{}\n".format( chrom, start, end, name, "\t".join( map( str, counts ))))
+
+    return None
+
+
+def compress_depth_file( filename, outfile=None, delete_file=True, processes=4, index=False, single_base=False ):
+    """compresses a tab file.
+
+    The file is bgzipped in a pool of threads. With index set the tabix
+    index is built while compressing, so index_depth_file is not needed.
+
+    Args:
+        filename (str): file to compress
+        outfile ( str): name of compressed file, default is [filename].gz
+        delete_file (bool): delete original file after compression, default is True
+        processes (int): compression threads, default 4
+        index (bool): write the tabix index, [outfile].tbi, as well, default is False
+        single_base (bool): the file contains single base resolution data, for the index
+
+    Returns:
+        filename (str): filename of compressed file
+
+    
+    """
+
+    if ( outfile is None):
+        outfile = "{}.gz".format( filename )
+
+    tabix_index = None
+    if ( index ):
+        tabix_index = _depth_file_index( single_base )
+
+    bgzf.compress_file( filename, outfile, index=tabix_index, processes=processes )
+
+    if ( delete_file ):
+        os.unlink( filename )
+
+    return outfile
+
+
+
+def index_depth_file( filename, single_base=False, summary=False, thresholds=None ):
+    """indexes a compressed depth tab file
+    
+    prev existing index files will be overwritten. Use compress_depth_file
+    with index set to index while compressing instead of reading the file again.
+
+    Args:
+        filename (str): file to index
+        single_base (bool): the file contains single base resolution data
+        summary (bool): build the summary index of a block file as well, see build_summary_index, default False
+        thresholds (list of int): depths the summary index counts the bases at or above, default SUMMARY_THRESHOLDS
+
+    Returns:
+        None
+
+    
+    """
+
+    if ( single_base ):
+        pysam.tabix_index(filename, force=True , seq_col=0,start_col=1, end_col=1)
+    else:
+        pysam.tabix_index(filename, force=True , seq_col=0,start_col=1, end_col=2)
+
+    if ( summary and not single_base ):
+        build_summary_index( filename, thresholds )
+
+    return None
+
+
+
+def build_summary_index( filename, thresholds=None ):
+    """builds the summary index of a block depth file, written to [filename].summary.npz
+
+    Per chromosome the index holds the blocks, with running sums of their
+    bases, of depth x length, and of the bases at or above each threshold.
+    summary_region answers mean depth and bases above the thresholds for
+    any region from these with two binary searches, without reading the
+    depth file. The size and mtime of the depth file are stored, so an
+    out of date index is not used.
+
+    summary_region answers from the index alone. coverage_region takes its
+    summed and mean depth and bases above thresholds from the index, but
+    still reads the blocks, as its report also holds the min and max depth
+    and the runs of bases in each depth bucket, which the running sums do
+    not give.
+
+    Args:
+        filename (str): block depth file, bgzipped or plain
+        thresholds (list of int): depths to count the bases at or above, default SUMMARY_THRESHOLDS
+
+    Returns:
+        name of the summary index (str)
+
+    Raises:
+        ValueError if the blocks are not sorted and non-overlapping within each chromosome, or a chromosome is split up
+    """
+
+    if ( thresholds is None ):
+        thresholds = SUMMARY_THRESHOLDS
+
+    thresholds = numpy.array( sorted( set( thresholds )), dtype=numpy.int64 )
+
+    chroms = []
+    chrom_rows = []
+    block_starts = []
+    block_ends = []
+    block_depths = []
+
+    def add_chrom( chrom, rows ):
+        if ( chrom in chroms ):
+            raise ValueError( "{} is split up in {}".format( chrom, filename ))
+
+        starts, ends, depths = _parse_depth_rows( rows )
+        if ( numpy.any( starts[1:] <= ends[:-1] ) or numpy.any( ends < starts )):
+            raise ValueError( "{} has unsorted or overlapping blocks on {}".format( filename, chrom ))
+
+        chroms.append( chrom )
+        chrom_rows.append( len( starts ))
+        block_starts.append( starts )
+        block_ends.append( ends )
+        block_depths.append( depths )
+
+    chrom = None
+    rows  = []
+    fh = toolbox.open_file( filename )
+    for line in fh:
+        if ( line.startswith( "#" ) or not line.strip()):
+            continue
+
+        line = line.rstrip( "\n" )
+        line_chrom = line[ :line.index( "\t" ) ]
+        if ( line_chrom != chrom ):
+            if ( rows ):
+                add_chrom( chrom, rows )
+            chrom, rows = line_chrom, []
+
+        rows.append( line )
+    fh.close()
+
+    if ( rows ):
+        add_chrom( chrom, rows )
+
+    starts  = numpy.concatenate( block_starts ) if chroms else numpy.zeros( 0, dtype=numpy.int64 )
+    ends    = numpy.concatenate( block_ends )   if chroms else numpy.zeros( 0, dtype=numpy.int64 )
+    depths  = numpy.concatenate( block_depths ) if chroms else numpy.zeros( 0, dtype=numpy.int64 )
+
+    sums = _block_sums( starts, ends, depths, thresholds )
+
+    stat = os.stat( filename )
+
+    summary_file = "{}.summary.npz".format( filename )
+    tmp_file = "{}.tmp".format( summary_file )
+    fh = open( tmp_file, 'wb' )
+    numpy.savez( fh,
+                 identity=numpy.array([ stat.st_size, stat.st_mtime ]),
+                 chroms=numpy.array( chroms ),
+                 chrom_offsets=_running_sum( chrom_rows ),
+                 starts=starts,
+                 ends=ends,
+                 depths=depths,
+                 thresholds=thresholds,
+                 bases=sums[ 'bases' ],
+                 summed_depth=sums[ 'summed_depth' ],
+                 bases_above=sums[ 'bases_above' ])
+    fh.close()
+
+    os.rename( tmp_file, summary_file )
+
+    return summary_file
+
+
+def _running_sum( values ):
+    """running sum of values, starting from 0, so the sum of values[i:j] is running_sum[j] - running_sum[i]
+
+    Args:
+        values (list/numpy array): values to sum
+
+    Returns:
+        numpy int64 array, one longer than values
+    """
+
+    return numpy.concatenate(( [0], numpy.cumsum( values, dtype=numpy.int64 )))
+
+
+def _block_sums( block_starts, block_ends, block_depths, thresholds ):
+    """running sums of the bases, depth x length, and bases at or above each threshold of sorted blocks
+
+    Args:
+        block_starts (numpy array): block starts
+        block_ends (numpy array): block ends (included)
+        block_depths (numpy array): block depths
+        thresholds (numpy array): depths to sum the bases at or above
+
+    Returns:
+        dict of 'bases', 'summed_depth' and 'bases_above', one row per threshold
+    """
+
+    lengths = block_ends - block_starts + 1
+
+    return { 'bases': _running_sum( lengths ),
+             'summed_depth': _running_sum( block_depths * lengths ),
+             'bases_above': numpy.array([ _running_sum( numpy.where( block_depths >= threshold, lengths, 0 )) for threshold in thresholds ]).reshape( len( thresholds ), len( block_starts ) + 1 ) }
+
+
+def _sum_regions( sums, block_starts, block_ends, block_depths, thresholds, region_starts, region_ends, first_row=0, last_row=None ):
+    """the bases, depth x length and bases at or above each threshold of regions, from the running sums of the blocks
+
+    Two binary searches per region find the blocks overlapping it, and the
+    parts of the first and last block outside it are taken off again.
+
+    Args:
+        sums (dict): running sums of the blocks, see _block_sums
+        block_starts (numpy array): block starts, sorted and not overlapping
+        block_ends (numpy array): block ends (included)
+        block_depths (numpy array): block depths
+        thresholds (numpy array): the thresholds of the sums
+        region_starts (numpy array): region starts (included)
+        region_ends (numpy array): region ends (included)
+        first_row (int): first block of the chromosome of the regions, default 0
+        last_row (int): block after the last one of the chromosome, default the last block
+
+    Returns:
+        bases, summed depth and bases at or above (one row per threshold) of the regions as numpy arrays
+    """
+
+    if ( last_row is None ):
+        last_row = len( block_starts )
+
+    region_starts = numpy.asarray( region_starts, dtype=numpy.int64 )
+    region_ends   = numpy.asarray( region_ends, dtype=numpy.int64 )
+
+    first = first_row + numpy.searchsorted( block_ends[ first_row:last_row ], region_starts, side='left' )
+    last  = first_row + numpy.searchsorted( block_starts[ first_row:last_row ], region_ends, side='right' )
+    last  = numpy.maximum( first, last )
+
+    bases        = sums[ 'bases' ][ last ] - sums[ 'bases' ][ first ]
+    summed_depth = sums[ 'summed_depth' ][ last ] - sums[ 'summed_depth' ][ first ]
+    bases_above  = sums[ 'bases_above' ][ :, last ] - sums[ 'bases_above' ][ :, first ]
+
+    if ( last_row > first_row ):
+        overlapping = last > first
+
+        # trim the first and last block back to the region
+        head_row = numpy.minimum( first, last_row - 1 )
+        tail_row = numpy.maximum( last - 1, first_row )
+        for rows, outside in [( head_row, region_starts - block_starts[ head_row ] ),
+                              ( tail_row, block_ends[ tail_row ] - region_ends )]:
+            outside = numpy.where( overlapping, numpy.maximum( outside, 0 ), 0 )
+            depths  = block_depths[ rows ]
+
+            bases        = bases - outside
+            summed_depth = summed_depth - depths * outside
+            bases_above  = bases_above - ( depths[ numpy.newaxis, : ] >= numpy.asarray( thresholds )[ :, numpy.newaxis ] ) * outside[ numpy.newaxis, : ]
+
+    return bases, summed_depth, bases_above
+
+
+def _depth_file_index( single_base=False ):
+    """an empty tabix index with the columns of a depth file
+
+    Args:
+        single_base (bool): the file contains single base resolution data
+
+    Returns:
+        bgzf.TabixIndex
+    """
+
+    if ( single_base ):
+        return bgzf.TabixIndex( seq_col=0, start_col=1, end_col=1 )
+
+    return bgzf.TabixIndex( seq_col=0, start_col=1, end_col=2 )
+
+
+
+
+
+# =============== reporting functions ====================
+
+# open tabix handles and the identity of their files by path, least recently used first, and the process that opened them
+_tabix_handles = collections.OrderedDict()
+_tabix_pid     = None
+
+
+def _tabix_file( depth_file ):
+    """returns an open tabix handle for a depth file, reusing the handles of earlier calls
+
+    Handles are kept in a pool of at most TABIX_POOL_SIZE, closing the least
+    recently used one when it is full. A handle is reopened if its file or
+    index has been rewritten since it was opened. After a fork the child
+    opens its own handles rather than sharing the parent's.
+
+    Args:
+        depth_file: name of file to read from, or an open pysam TabixFile that is returned as is
+
+    Returns:
+        pysam TabixFile
+    """
+
+    global _tabix_pid
+
+    if ( hasattr( depth_file, 'fetch' )):
+        return depth_file
+
+    if ( _tabix_pid != os.getpid() ):
+        # the handles belong to the parent, leave them to it
+        _tabix_handles.clear()
+        _tabix_pid = os.getpid()
+
+    path = os.path.abspath( depth_file )
+    identity = toolbox.tabix_identity( path )
+
+    depth_in, opened_identity = _tabix_handles.pop( path, (None, None) )
+    if ( depth_in is not None and opened_identity != identity ):
+        depth_in.close()
+        depth_in = None
+
+    if ( depth_in is None ):
+        depth_in = toolbox.open_tabix( depth_file )
+
+        while ( len( _tabix_handles ) >= max( 1, TABIX_POOL_SIZE )):
+            _tabix_handles.popitem( last=False )[1][0].close()
+
+    _tabix_handles[ path ] = ( depth_in, identity )
+
+    return depth_in
+
+
+def close_tabix_files():
+    """closes the tabix handles kept open by the reporting functions
+
+    Returns:
+        None
+    """
+
+    global _tabix_pid
+
+    if ( _tabix_pid == os.getpid() ):
+        for depth_in, identity in _tabix_handles.values():
+            depth_in.close()
+
+    _tabix_handles.clear()
+    _tabix_pid = None
+
+    return None
+
+
+
+def view_region( depth_file, chrom=None, start=None, end=None):
+    """reports the depths for, optionally a region, in a depth-file. Region is defined by chrom, start and end
+    
+    
+    Args:
+        depth_file: name of file to read from, or an open pysam TabixFile
+        chrom (str): chromosome
+        start (int): start position (included)
+        end (int): end position (included)
+
+    Returns:
+        print depths to stdout, but returns nothing
+
+    
+    Raises:
+        No exceptions are caught by the function
+    """
+
+    depth_in = _tabix_file( depth_file )
+   
+
+    if ( chrom is None):
+        iterator = depth_in.fetch()
+    else:
+        try:
+            iterator = depth_in.fetch(chrom, int(start)-1, int(end)-1)
+        except:
+            return
+
+    for row in iterator:
+        print( row )
+
+
+def view_region_from_bedfile( depth_file, bed_file):
+    """reports the depths for, optionally a region, in a depth-file. Region is defined by chrom, start and end
+    
+    
+    Args:
+        depth_file: name of file to read from, or an open pysam TabixFile
+        bedfile(str): name of the bedfile to read regions from
+
+    Returns:
+        print depths to stdout, but returns nothing
+
+    
+    Raises:
+        No exceptions are caught by the function
+    """
+
+    bed_fh = open( bed_file, 'r')
+    for line in bed_fh.readlines():
+        line = line.strip("\n")
+
+        fields = line.split("\t")
+
+        chrom, start, end =  fields[:3]
+
+        start = int( start )
+        end   = int( end   )
+
+        view_region( depth_file, chrom, start + 1, end)
+
+def view_regions( depth_file, regions):
+    """reports the depths for, regions
+    
+    
+    Args:
+        depth_file: name of file to read from, or an open pysam TabixFile
+        regions(list): list of list of regions consiting of chrom, start, end
+
+    Returns:
+        print depths to stdout, but returns nothing
+
+    
+    Raises:
+        No exceptions are caught by the function
+    """
+
+    for region in regions:
+        chrom, start, end = region
+
+        view_region( depth_file, chrom, int(start), int(end))
+
+
+
+
+def coverage_region( depth_file, chrom=None, start=None, end=None, min_coverage=1, vectorized=False, thresholds=None, cache=None):
+    """reports a full depths/coverage report for a depth-file, limited by region defined by chrom, start, and end
+
+    The blocks over the region are always read. When depth_file is a name
+    with an up to date summary index, counting all the thresholds asked
+    for, the summed and mean depth and the bases and percent above the
+    thresholds are taken from the index instead of the blocks; when only
+    these are needed, summary_region answers without reading the blocks.
+
+    Args:
+        depth_file: name of file to read from, or an open pysam TabixFile
+        chrom (str): chromosome
+        start (int): start position (included)
+        end (int): end position (included)
+        min_coverage(int): depth cutoff for percent coverage, default 1
+        vectorized(bool): parse the blocks into arrays and compute the report with numpy, default False
+        thresholds(list of int): depths to report the bases and percent at or above, under 'bases_above' and 'percent_above', default none
+        cache(CoverageCache): look the report up in, or add it to, this ccbg.coverage_cache cache, used when depth_file is a name, default none
+
+    Returns:
+        dict of values. 
+
+    
+    Raises:
+        No exceptions are caught by the function
+    """
+
+    if ( cache is not None and chrom is not None and not hasattr( depth_file, 'fetch' )):
+        region = ( chrom, int( start ), int( end ))
+        found = cache.lookup( depth_file, [ region ], min_coverage, thresholds )
+        if ( region not in found ):
+            found[ region ] = coverage_region( depth_file, chrom, start, end, min_coverage, vectorized, thresholds )
+            cache.store( depth_file, [ ( region, found[ region ] ) ], min_coverage, thresholds )
+
+        return found[ region ]
+
+    summary = None
+    if ( chrom is not None and not hasattr( depth_file, 'fetch' )):
+        summary = _indexed_summary( depth_file, chrom, start, end, thresholds )
+
+    depth_in = _tabix_file( depth_file )
+
+    try:
+        iterator = depth_in.fetch(chrom, int(start) - 1, int(end) )
+    except:
+        return None
+
+    block_thresholds = thresholds
+    if ( summary is not None ):
+        block_thresholds = None
+
+    if ( vectorized and chrom is not None ):
+        block_starts, block_ends, block_depths = _parse_depth_rows( list( iterator ))
+        coverage = _coverage_from_arrays( chrom, start, end, block_starts, block_ends, block_depths, min_coverage, block_thresholds )
+    else:
+        coverage = _coverage_from_rows( chrom, start, end, ( _parse_depth_row( row ) for row in iterator ), min_coverage, block_thresholds )
+
+    if ( summary is not None ):
+        coverage[ 'summed_depth' ] = summary[ 'summed_depth' ]
+        coverage[ 'mean_depth' ]   = summary[ 'mean_depth' ]
+        if ( thresholds is not None ):
+            coverage[ 'bases_above' ]   = dict([ (int( threshold ), summary[ 'bases_above' ][ int( threshold ) ]) for threshold in thresholds ])
+            coverage[ 'percent_above' ] = dict([ (int( threshold ), summary[ 'percent_above' ][ int( threshold ) ]) for threshold in thresholds ])
+
+    return coverage
+
+
+def _indexed_summary( depth_file, chrom, start, end, thresholds=None ):
+    """the summary_region report of a region, if the depth file has an up to date summary index counting the thresholds
+
+    Args:
+        depth_file (str): block depth file
+        chrom (str): chromosome
+        start (int): start position (included)
+        end (int): end position (included)
+        thresholds (list of int): thresholds the index must count, default none
+
+    Returns:
+        dict of values as summary_region, None without a usable index
+    """
+
+    try:
+        summary = summary_region( depth_file, chrom, start, end )
+    except ValueError:
+        return None
+
+    if ( summary is None ):
+        return None
+
+    for threshold in thresholds or []:
+        if ( int( threshold ) not in summary[ 'bases_above' ] ):
+            return None
+
+    return summary
+
+
+# loaded summary indexes by path, least recently used first
+_summary_indexes = collections.OrderedDict()
+
+
+def _summary_index( depth_file ):
+    """loads the summary index of a block depth file, keeping it for later calls
+
+    Args:
+        depth_file (str): block depth file
+
+    Returns:
+        dict of the summary index arrays, and 'chroms' as chrom: (first row, last row)
+
+    Raises:
+        ValueError if there is no summary index, or it is older than the depth file
+    """
+
+    path = os.path.abspath( depth_file )
+    stat = os.stat( depth_file )
+    identity = [ stat.st_size, stat.st_mtime ]
+
+    summary = _summary_indexes.pop( path, None )
+    if ( summary is None or summary[ 'identity' ] != identity ):
+        summary_file = "{}.summary.npz".format( depth_file )
+        if ( not os.path.isfile( summary_file )):
+            raise ValueError( "{} has no summary index, build it with build_summary_index".format( depth_file ))
+
+        data = numpy.load( summary_file )
+        summary = {}
+        for key in ['starts', 'ends', 'depths', 'thresholds', 'bases', 'summed_depth', 'bases_above']:
+            summary[ key ] = data[ key ]
+        summary[ 'identity' ] = data[ 'identity' ].tolist()
+        offsets = data[ 'chrom_offsets' ].tolist()
+        summary[ 'chroms' ] = dict([ (chrom, (offsets[ index ], offsets[ index + 1 ])) for index, chrom in enumerate( data[ 'chroms' ].tolist()) ])
+        data.close()
+
+        if ( summary[ 'identity' ] != identity ):
+            raise ValueError( "the summary index of {} is out of date, rebuild it with build_summary_index".format( depth_file ))
+
+        while ( len( _summary_indexes ) >= max( 1, SUMMARY_POOL_SIZE )):
+            _summary_indexes.popitem( last=False )
+
+    _summary_indexes[ path ] = summary
+
+    return summary
+
+
+def summary_region( depth_file, chrom, start, end ):
+    """reports the mean depth and bases at or above the summary thresholds of a region from the summary index
+
+    Two binary searches find the blocks overlapping the region, and the
+    running sums of the summary index give their totals, trimmed back for
+    the parts of the first and last block outside the region. The depth
+    file itself is not read. The mean depth and percents are over the
+    full region length, as in coverage_region.
+
+    This is the fast path for mean depth and bases above thresholds:
+    coverage_region takes these from the index too, but still reads the
+    blocks for the rest of its report, and coverage_regions* in batch mode
+    do not use the index.
+
+    Args:
+        depth_file (str): block depth file with a summary index, see build_summary_index
+        chrom (str): chromosome
+        start (int): start position (included)
+        end (int): end position (included)
+
+    Returns:
+        dict of values, None if the chromosome is not in the file
+
+    Raises:
+        ValueError if there is no up to date summary index
+    """
+
+    summary = _summary_index( depth_file )
+
+    if ( chrom not in summary[ 'chroms' ] ):
+        return None
+
+    start = int( start )
+    end   = int( end )
+
+    chrom_first, chrom_last = summary[ 'chroms' ][ chrom ]
+    bases, summed_depth, bases_above = _sum_regions( summary, summary[ 'starts' ], summary[ 'ends' ], summary[ 'depths' ], summary[ 'thresholds' ],
+                                                     [ start ], [ end ], chrom_first, chrom_last )
+    bases        = int( bases[0] )
+    summed_depth = int( summed_depth[0] )
+    bases_above  = bases_above[ :, 0 ]
+
+    length = end - start + 1
+
+    coverage = {}
+    coverage[ 'length' ]        = length
+    coverage[ 'N/A' ]           = length - bases
+    coverage[ 'summed_depth' ]  = summed_depth
+    coverage[ 'mean_depth' ]    = 1.0*summed_depth/length
+    coverage[ 'bases_above' ]   = dict( zip( summary[ 'thresholds' ].tolist(), bases_above.tolist()))
+    coverage[ 'percent_above' ] = dict([ (threshold, 1.0*bases/length) for threshold, bases in coverage[ 'bases_above' ].items() ])
+
+    return coverage
+
+
+def _parse_depth_row( row ):
+    """splits a depth block row and casts the positions and depth to int
+
+    Args:
+        row (str): chrom, start, end and depth, tab separated
+
+    Returns:
+        (chrom, start, end, depth)
+    """
+
+    block_chrom, block_start, block_end, block_depth = row.split("\t")
+
+    return block_chrom, int( block_start ), int( block_end ), int( block_depth )
+
+
+def _parse_depth_rows( rows ):
+    """parses depth block rows of one chromosome into arrays
+
+    Args:
+        rows (list of str): chrom, start, end and depth, tab separated
+
+    Returns:
+        block starts, block ends and depths as numpy int64 arrays
+
+    Raises:
+        ValueError if a row does not have four columns
+    """
+
+    fields = "\t".join( rows ).split("\t")
+    if ( len( fields ) != 4 * len( rows ) and rows ):
+        raise ValueError( "depth block rows must have four columns" )
+
+    return ( numpy.array( fields[1::4], dtype=numpy.int64 ),
+             numpy.array( fields[2::4], dtype=numpy.int64 ),
+             numpy.array( fields[3::4], dtype=numpy.int64 ))
+
+
+
+def _bucket_runs( chrom, block_starts, block_ends, buckets ):
+    """merges neighbouring blocks in the same bucket into intervals, as _merge_regions does
+
+    Args:
+        chrom (str): chromosome
+        block_starts (numpy array): block starts, in file order
+        block_ends (numpy array): block ends (included)
+        buckets (numpy array): bucket of every block
+
+    Returns:
+        merged intervals (IntervalList) per bucket
+    """
+
+    if ( len( block_starts ) == 0 ):
+        return [ intervals.IntervalList() for bucket in COVERAGE_BUCKETS ]
+
+    # group the blocks by bucket, keeping them in file order within a bucket
+    order = numpy.argsort( buckets, kind='mergesort' )
+    block_starts, block_ends, buckets = block_starts[ order ], block_ends[ order ], buckets[ order ]
+
+    breaks = numpy.flatnonzero(( block_starts[1:] != block_ends[:-1] + 1 ) | ( buckets[1:] != buckets[:-1] )) + 1
+
+    firsts = numpy.concatenate(( [0], breaks ))
+    lasts  = numpy.concatenate(( breaks - 1, [len( block_ends ) - 1] ))
+
+    # the runs are grouped by bucket, so each bucket is a slice of them
+    run_buckets = buckets[ firsts ]
+    bucket_firsts = numpy.searchsorted( run_buckets, numpy.arange( len( COVERAGE_BUCKETS ) + 1 ))
+
+    run_starts = block_starts[ firsts ]
+    run_ends   = block_ends[ lasts ]
+
+    return [ intervals.IntervalList.from_arrays( chrom, run_starts[ first:last ], run_ends[ first:last ] )
+             for first, last in zip( bucket_firsts[:-1], bucket_firsts[1:] ) ]
+
+
+def _add_threshold_coverage( coverage, block_depths, lengths, thresholds ):
+    """adds the bases and percent of a region at or above every threshold to its report
+
+    The bases are binned by depth once, and a cumulative sum from the
+    highest depth down gives the bases at or above any depth.
+
+    Args:
+        coverage (dict): report of the region, with its 'length'
+        block_depths (numpy array): depth of every block
+        lengths (numpy array): bases of every block in the region
+        thresholds (list of int): depths to report
+
+    Returns:
+        None
+    """
+
+    histogram = numpy.bincount( block_depths, weights=lengths ).astype( numpy.int64 )
+    at_or_above = numpy.cumsum( histogram[::-1] )[::-1].tolist() + [ 0 ]
+
+    coverage[ 'bases_above' ]   = {}
+    coverage[ 'percent_above' ] = {}
+    for threshold in thresholds:
+        threshold = int( threshold )
+        coverage[ 'bases_above' ][ threshold ]   = at_or_above[ min( max( threshold, 0 ), len( histogram )) ]
+        coverage[ 'percent_above' ][ threshold ] = 1.0*coverage[ 'bases_above' ][ threshold ]/coverage['length']
+
+    return None
+
+
+def _coverage_from_arrays( chrom, start, end, block_starts, block_ends, block_depths, min_coverage=1, thresholds=None ):
+    """the coverage report of a region from arrays of the depth blocks overlapping it
+
+    Computes the same report as _coverage_from_rows, with array operations
+    in place of the per block loop.
+
+    Args:
+        chrom (str): chromosome
+        start (int): start position (included)
+        end (int): end position (included)
+        block_starts (numpy array): starts of the blocks overlapping the region, in file order
+        block_ends (numpy array): block ends (included)
+        block_depths (numpy array): block depths
+        min_coverage(int): depth cutoff for percent coverage, default 1
+        thresholds(list of int): depths to report the bases and percent at or above, default none
+
+    Returns:
+        dict of values, as coverage_region
+    """
+
+    start        = int( start )
+    end          = int( end )
+    min_coverage = int( min_coverage )
 
-    Returns:
-        print depths to stdout, but returns nothing
+    # the row by row report has its own way of failing on these
+    if ( len( block_depths ) and block_depths.min() < 0 ):
+        return _coverage_from_rows( chrom, start, end,
+                                    [ (chrom, block_start, block_end, block_depth) for block_start, block_end, block_depth in
+                                      zip( block_starts.tolist(), block_ends.tolist(), block_depths.tolist()) ], min_coverage, thresholds )
 
-    
-    Raises:
-        No exceptions are caught by the function
-    """
+    block_starts = numpy.maximum( block_starts, start )
+    block_ends   = numpy.minimum( block_ends, end )
+    lengths      = block_ends - block_starts + 1
 
-    bed_fh = open( bed_file, 'r')
-    for line in bed_fh.readlines():
-        line = line.strip("\n")
+    coverage = {}
 
-        fields = line.split("\t")
+    coverage[ 'bases_above_min' ] = int( lengths[ block_depths >= min_coverage ].sum())
+    coverage[ 'min_depth' ]       = None
+    coverage[ 'max_depth' ]       = None
+    coverage[ 'summed_depth' ]    = int(( block_depths * lengths ).sum())
+    coverage[ 'length' ]          = end-start +1
 
-        chrom, start, end =  fields[:3]
+    if ( len( block_depths )):
+        coverage[ 'min_depth' ] = int( block_depths.min())
+        coverage[ 'max_depth' ] = int( block_depths.max())
 
-        start = int( start )
-        end   = int( end   )
+    floors  = numpy.array([ floor for name, floor, listed in COVERAGE_BUCKETS ])
+    buckets = numpy.searchsorted( floors, block_depths, side='right' ) - 1
 
-        view_region( depth_file, chrom, start + 1, end)
+    bucket_bases = numpy.bincount( buckets, weights=lengths, minlength=len( COVERAGE_BUCKETS )).astype( numpy.int64 ).tolist()
+    bucket_runs  = _bucket_runs( chrom, block_starts, block_ends, buckets )
 
-def view_regions( depth_file, regions):
-    """reports the depths for, regions
-    
-    
-    Args:
-        depth_file: name of file to read from
-        regions(list): list of list of regions consiting of chrom, start, end
+    coverage['blocks'] = {}
+    for bucket, ( name, floor, listed ) in enumerate( COVERAGE_BUCKETS ):
+        coverage[ name ] = bucket_bases[ bucket ]
+        if ( listed ):
+            coverage['blocks'][ name ] = bucket_runs[ bucket ]
 
-    Returns:
-        print depths to stdout, but returns nothing
+    coverage[ 'N/A' ] = 0
+    coverage['blocks'][ 'N/A' ] = intervals.IntervalList()
 
-    
-    Raises:
-        No exceptions are caught by the function
-    """
+    if ( len( block_starts ) == 0 ):
+        coverage[ 'N/A' ] += end - start + 1
+        coverage['blocks'][ 'N/A' ].add( chrom, start, end )
+    else:
+        # the region asked for is not available at the start, counted as the length of the first block as the row by row report does
+        if ( start < block_starts[0] ):
+            coverage[ 'N/A' ] += int( lengths[0] )
+            coverage['blocks'][ 'N/A' ].add( chrom, start, block_starts[0] - 1 )
 
-    for region in regions:
-        chrom, start, end = region
+        if ( end > block_ends[-1] ):
+            coverage[ 'N/A' ] += end - int( block_ends[-1] )
+            coverage['blocks'][ 'N/A' ].add( chrom, block_ends[-1] + 1, end )
 
-        view_region( depth_file, chrom, int(start), int(end))
+    coverage['mean_depth'] = 1.0*coverage['summed_depth']/coverage['length']
+    coverage['percent']    = 1.0*coverage['bases_above_min']/coverage['length']
 
+    if ( thresholds is not None ):
+        _add_threshold_coverage( coverage, block_depths, lengths, thresholds )
 
+    return coverage
 
 
-def coverage_region( depth_file, chrom=None, start=None, end=None, min_coverage=1):
-    """reports a full depths/coverage report for a depth-file, limited by region defined by chrom, start, and end
-        
+def _coverage_from_rows( chrom, start, end, rows, min_coverage=1, thresholds=None ):
+    """the coverage report of a region from the depth blocks overlapping it
+
     Args:
-        depth_file: name of file to read from
         chrom (str): chromosome
         start (int): start position (included)
         end (int): end position (included)
+        rows (iterable): (chrom, start, end, depth) of the blocks overlapping the region, in file order
         min_coverage(int): depth cutoff for percent coverage, default 1
+        thresholds(list of int): depths to report the bases and percent at or above, default none
 
     Returns:
-        dict of values. 
-
-    
-    Raises:
-        No exceptions are caught by the function
+        dict of values, as coverage_region
     """
 
-    depth_in = pysam.TabixFile( depth_file )
-
     start        = int( start )
     end          = int( end )
     min_coverage = int( min_coverage )
@@ -376,30 +1504,23 @@ def coverage_region( depth_file, chrom=None, start=None, end=None, min_coverage=
     coverage[ '0x' ]          = 0
     coverage[ 'N/A' ]         = 0
 
+    # start and end lists of the blocks in each bucket, made into intervals at the end
     coverage['blocks'] = {}
-    coverage['blocks'][ '10-19x' ]      = []
-    coverage['blocks'][ '6-9x' ]        = []
-    coverage['blocks'][ '1-5x' ]        = []
-    coverage['blocks'][ '0x' ]          = []
-    coverage['blocks'][ 'N/A' ]         = []
+    coverage['blocks'][ '10-19x' ]      = ([], [])
+    coverage['blocks'][ '6-9x' ]        = ([], [])
+    coverage['blocks'][ '1-5x' ]        = ([], [])
+    coverage['blocks'][ '0x' ]          = ([], [])
+    coverage['blocks'][ 'N/A' ]         = intervals.IntervalList()
 
     first_row = True
 
-    try:
-        iterator = depth_in.fetch(chrom, int(start) - 1, int(end) )
-    except:
-        return None
+    block_start, block_end = None, None
 
+    # depth and length of the blocks, for the thresholds
+    block_depths  = []
+    block_lengths = []
 
-    for row in iterator:
-
-#        print( row )
-        
-        # read in line, split and cast to int where appropriate
-        block_chrom, block_start, block_end, block_depth = row.split("\t")
-        block_start = int( block_start )
-        block_end   = int( block_end   )
-        block_depth = int( block_depth )
+    for block_chrom, block_start, block_end, block_depth in rows:
 
         # Asked for a defined region, and the returned block is outside the requested area, trim them back
         if ( chrom is not None):
@@ -413,7 +1534,7 @@ def coverage_region( depth_file, chrom=None, start=None, end=None, min_coverage=
             if (first_row and start < block_start ):
 #                print( "{} < {}".format( start, d_start ))
                 coverage[ 'N/A' ] += block_end - block_start +1
-                coverage['blocks'][ 'N/A' ].append( "{}:{}-{}".format(block_chrom, start, block_start - 1))
+                coverage['blocks'][ 'N/A' ].add( block_chrom, start, block_start - 1 )
 
             first_row = False
                 
@@ -432,64 +1553,167 @@ def coverage_region( depth_file, chrom=None, start=None, end=None, min_coverage=
 
             coverage[ 'summed_depth' ] +=  block_depth *(block_end - block_start + 1)
 
+            block_depths.append( block_depth )
+            block_lengths.append( block_end - block_start + 1 )
+
             if ( block_depth >= 20):
                 coverage[ '20x' ] += block_end  -  block_start  + 1
             elif( block_depth >= 10):
                 coverage[ '10-19x' ] += block_end -  block_start +1
-                coverage['blocks'][ '10-19x' ].append("{}:{}-{}".format(chrom, block_start, block_end))
+                coverage['blocks'][ '10-19x' ][0].append( block_start )
+                coverage['blocks'][ '10-19x' ][1].append( block_end )
             elif( block_depth >= 6):
                 coverage[ '6-9x' ] += block_end -  block_start +1
-                coverage['blocks'][ '6-9x' ].append("{}:{}-{}".format(chrom, block_start, block_end))
+                coverage['blocks'][ '6-9x' ][0].append( block_start )
+                coverage['blocks'][ '6-9x' ][1].append( block_end )
             elif( block_depth >= 1):
                 coverage[ '1-5x' ] += block_end -  block_start +1
-                coverage['blocks'][ '1-5x' ].append("{}:{}-{}".format(chrom, block_start, block_end))
+                coverage['blocks'][ '1-5x' ][0].append( block_start )
+                coverage['blocks'][ '1-5x' ][1].append( block_end )
             elif (block_depth == 0 ):
 #                print ("{}:{}-{}".format(chrom, d_start, d_end))
                 coverage[ '0x' ] += block_end -  block_start +1
-                coverage['blocks'][ '0x' ].append("{}:{}-{}".format(chrom, block_start, block_end))
+                coverage['blocks'][ '0x' ][0].append( block_start )
+                coverage['blocks'][ '0x' ][1].append( block_end )
             else:
                 print( "Unknown depth: {}".format( depth ))
                 exit()
 
-    coverage['blocks'][ '10-19x' ]      = _merge_regions( coverage['blocks'][ '10-19x' ])
-    coverage['blocks'][ '6-9x' ]        = _merge_regions( coverage['blocks'][ '6-9x' ]  )
-    coverage['blocks'][ '1-5x' ]        = _merge_regions( coverage['blocks'][ '1-5x' ]  )
-    coverage['blocks'][ '0x' ]          = _merge_regions( coverage['blocks'][ '0x' ]    )
+    coverage['blocks'][ '10-19x' ]      = intervals.IntervalList.from_arrays( chrom, *coverage['blocks'][ '10-19x' ], merge=True )
+    coverage['blocks'][ '6-9x' ]        = intervals.IntervalList.from_arrays( chrom, *coverage['blocks'][ '6-9x' ], merge=True )
+    coverage['blocks'][ '1-5x' ]        = intervals.IntervalList.from_arrays( chrom, *coverage['blocks'][ '1-5x' ], merge=True )
+    coverage['blocks'][ '0x' ]          = intervals.IntervalList.from_arrays( chrom, *coverage['blocks'][ '0x' ], merge=True )
     coverage['blocks'][ 'N/A' ]         = _merge_regions( coverage['blocks'][ 'N/A' ]   )
 
     if ( block_start is None and block_end is None):
         coverage[ 'N/A' ] += end - start + 1
-        coverage['blocks'][ 'N/A' ].append( "{}:{}-{}".format(chrom, start, end))
+        coverage['blocks'][ 'N/A' ].add( chrom, start, end )
 
     elif ( block_end is not None and end > block_end ):
         coverage[ 'N/A' ] += end - block_end
-        coverage['blocks'][ 'N/A' ].append( "{}:{}-{}".format(block_chrom, block_end + 1, end))
+        coverage['blocks'][ 'N/A' ].add( block_chrom, block_end + 1, end )
 
     coverage['mean_depth'] = 1.0*coverage['summed_depth']/coverage['length']
     coverage['percent']    = 1.0*coverage['bases_above_min']/coverage['length']
 
+    if ( thresholds is not None ):
+        _add_threshold_coverage( coverage, numpy.array( block_depths, dtype=numpy.int64 ), numpy.array( block_lengths, dtype=numpy.int64 ), thresholds )
+
 
 #    pp.pprint( coverage )
 
     return coverage
 
-def coverage_regions_from_bedfile( depth_file, bed_file, min_coverage=20):
-    """reports a full depths/coverage report for a depth-file, limited by regions in the bedfile
-    
-    
+def _coverage_regions_batch( depth_file, regions, min_coverage, vectorized=False, thresholds=None ):
+    """the coverage reports of many regions, reading the blocks of each chromosome once
+
+    The regions of a chromosome are sorted and the blocks over their span
+    streamed in a single fetch. A sweep line keeps the regions the blocks
+    have reached, and every block is handed to each of them it overlaps,
+    so the reports are the same as a coverage_region call per region.
+
+    Args:
+        depth_file: name of file to read from, or an open pysam TabixFile
+        regions(list): (chrom, start, end) tuples, start and end included
+        min_coverage(int): depth cutoff for coverage
+        vectorized(bool): parse the blocks of a chromosome into arrays, and find and report on the blocks of each region with numpy
+        thresholds(list of int): depths to report the bases and percent at or above, default none
+
+    Returns:
+        list of coverage dicts, or None where the chromosome is not in the file, in the order of regions
+    """
+
+    depth_in = _tabix_file( depth_file )
+
+    by_chrom = {}
+    for index, ( chrom, start, end ) in enumerate( regions ):
+        by_chrom.setdefault( chrom, [] ).append(( start, end, index ))
+
+    coverages = [ None ] * len( regions )
+
+    for chrom, chrom_regions in by_chrom.items():
+        chrom_regions.sort()
+
+        try:
+            iterator = depth_in.fetch( chrom, chrom_regions[0][0] - 1, max([ end for start, end, index in chrom_regions ]))
+        except:
+            continue
+
+        if ( vectorized ):
+            _coverage_regions_arrays( chrom, chrom_regions, list( iterator ), min_coverage, thresholds, coverages )
+            continue
+
+        # rows per region, the regions the blocks have reached, and the ones they have not
+        region_rows = [ [] for region in chrom_regions ]
+        active  = []
+        pending = 0
+
+        for row in iterator:
+            row = _parse_depth_row( row )
+            block_start, block_end = row[1], row[2]
+
+            while ( pending < len( chrom_regions ) and chrom_regions[ pending ][0] <= block_end ):
+                active.append( pending )
+                pending += 1
+
+            # blocks come sorted on start, so no later block reaches these regions
+            active = [ region for region in active if chrom_regions[ region ][1] >= block_start ]
+
+            for region in active:
+                if ( chrom_regions[ region ][0] <= block_end ):
+                    region_rows[ region ].append( row )
+
+        for ( start, end, index ), rows in zip( chrom_regions, region_rows ):
+            coverages[ index ] = _coverage_from_rows( chrom, start, end, rows, min_coverage, thresholds )
+
+    return coverages
+
+
+def _coverage_regions_arrays( chrom, chrom_regions, rows, min_coverage, thresholds, coverages ):
+    """reports on the regions of a chromosome from the blocks over their span, parsed into arrays once
+
     Args:
-        depth_file: name of file to read from
         chrom (str): chromosome
-        start (int): start position (included)
-        end (int): end position (included)
-        min_coverage(int): depth cutoff for coverage, default 20
+        chrom_regions(list): sorted (start, end, index) tuples
+        rows (list of str): the block rows over the span of the regions
+        min_coverage(int): depth cutoff for coverage
+        thresholds(list of int): depths to report the bases and percent at or above, None for none
+        coverages(list): where the report of each region is stored, by index
 
     Returns:
-        dict of values. 
+        None
+    """
 
-    
-    Raises:
-        No exceptions are caught by the function
+    block_starts, block_ends, block_depths = _parse_depth_rows( rows )
+
+    # blocks come sorted on start; the running maximum of the ends finds the first block that can reach a region
+    reach = numpy.maximum.accumulate( block_ends ) if len( block_ends ) else block_ends
+
+    for start, end, index in chrom_regions:
+        first = numpy.searchsorted( reach, start, side='left' )
+        last  = numpy.searchsorted( block_starts, end, side='right' )
+
+        overlapping = slice( first, max( first, last ))
+        starts, ends, depths = block_starts[ overlapping ], block_ends[ overlapping ], block_depths[ overlapping ]
+
+        # only blocks overlapping others can end before the region within the slice
+        reaching = ends >= start
+        if ( not reaching.all() ):
+            starts, ends, depths = starts[ reaching ], ends[ reaching ], depths[ reaching ]
+
+        coverages[ index ] = _coverage_from_arrays( chrom, start, end, starts, ends, depths, min_coverage, thresholds )
+
+    return None
+
+
+def _summarise_coverages( region_coverages ):
+    """collects the coverage reports of regions into one dict with the totals under 'stats'
+
+    Args:
+        region_coverages(list): (id, length, coverage) of the regions in the order asked for
+
+    Returns:
+        dict of id: coverage, and 'stats'
     """
 
     coverages = {}
@@ -499,28 +1723,21 @@ def coverage_regions_from_bedfile( depth_file, bed_file, min_coverage=20):
     total_summed_depth    = 0
     total_min_depth       = None
     total_max_depth       = None
+    total_bases_above     = None
 
+    for id, length, coverage in region_coverages:
 
-    bed_fh = open( bed_file, 'r')
-    for line in bed_fh.readlines():
-        line = line.strip("\n")
-
-        fields = line.split("\t")
-
-        chrom, start, end =  fields[:3]
-        start = int( start )
-        end   = int( end   )
-        id = "_".join(fields[3:])
-        if id is None or id == "":
-            id = "{}:{}-{}".format( chrom, start + 1, end)
-
-        coverage = coverage_region( depth_file, chrom, start + 1, end, min_coverage)
-        
-        total_length += end - start # as 0 indexed and non inclusive end, we dont have to add one this time!
+        total_length += length
         if ( coverage is not None ):
             total_bases_above_min += coverage[ 'bases_above_min' ]
             total_summed_depth += coverage[ 'summed_depth' ]
 
+            if ( 'bases_above' in coverage ):
+                if ( total_bases_above is None ):
+                    total_bases_above = dict.fromkeys( coverage[ 'bases_above' ], 0 )
+                for threshold, bases in coverage[ 'bases_above' ].items():
+                    total_bases_above[ threshold ] += bases
+
         
             if ( total_min_depth is None or total_min_depth > coverage['min_depth']):
                 total_min_depth = coverage['min_depth']
@@ -541,19 +1758,61 @@ def coverage_regions_from_bedfile( depth_file, bed_file, min_coverage=20):
     coverages[ 'stats'][ 'mean_depth']      = 1.0*total_summed_depth/total_length
     coverages[ 'stats'][ 'max_depth']       = total_max_depth
 
+    if ( total_bases_above is not None ):
+        coverages[ 'stats'][ 'bases_above']   = total_bases_above
+        coverages[ 'stats'][ 'percent_above'] = dict([ (threshold, 1.0*bases/total_length) for threshold, bases in total_bases_above.items() ])
 
     return coverages
 
 
+def _region_coverages( depth_file, regions, min_coverage, batch, vectorized=False, thresholds=None, cache=None ):
+    """the coverage reports of regions, one fetch per region or in a batch
 
-def coverage_regions( depth_file, regions, min_coverage=20):
-    """reports a full depths/coverage report for a depth-file, limited by regions
+    Args:
+        depth_file: name of file to read from, or an open pysam TabixFile
+        regions(list): (id, chrom, start, end) tuples, start and end included
+        min_coverage(int): depth cutoff for coverage
+        batch(bool): read each chromosome once with _coverage_regions_batch
+        vectorized(bool): compute the reports with numpy
+        thresholds(list of int): depths to report the bases and percent at or above, default none
+        cache(CoverageCache): cache to look the reports up in, and add the missing ones to, default none
+
+    Returns:
+        list of (id, length, coverage), in the order of regions
+    """
+
+    if ( cache is not None and not hasattr( depth_file, 'fetch' )):
+        found = cache.lookup( depth_file, [ (chrom, start, end) for id, chrom, start, end in regions ], min_coverage, thresholds )
+
+        missing = [ region for region in regions if region[1:] not in found ]
+        if ( missing ):
+            made = _region_coverages( depth_file, missing, min_coverage, batch, vectorized, thresholds )
+            reports = [ ( region[1:], coverage ) for region, ( id, length, coverage ) in zip( missing, made ) ]
+            cache.store( depth_file, reports, min_coverage, thresholds )
+            found.update( reports )
+
+        return [ (id, end - start + 1, found[( chrom, start, end )]) for id, chrom, start, end in regions ]
+
+    if ( batch ):
+        coverages = _coverage_regions_batch( depth_file, [ (chrom, start, end) for id, chrom, start, end in regions ], int( min_coverage ), vectorized, thresholds )
+    else:
+        coverages = [ coverage_region( depth_file, chrom, start, end, min_coverage, vectorized, thresholds) for id, chrom, start, end in regions ]
+
+    return [ (id, end - start + 1, coverage) for ( id, chrom, start, end ), coverage in zip( regions, coverages ) ]
+
+
+def coverage_regions_from_bedfile( depth_file, bed_file, min_coverage=20, batch=False, vectorized=False, thresholds=None, cache=None):
+    """reports a full depths/coverage report for a depth-file, limited by regions in the bedfile
     
     
     Args:
-        depth_file: name of file to read from
-        regions(list): list of list of regions consiting of chrom, start, end
+        depth_file: name of file to read from, or an open pysam TabixFile
+        bed_file(str): name of the bedfile to read regions from
         min_coverage(int): depth cutoff for coverage, default 20
+        batch(bool): read the blocks of each chromosome once for all its regions, rather than fetch per region, default False
+        vectorized(bool): compute the reports with numpy over arrays of the blocks, default False
+        thresholds(list of int): depths to report the bases and percent at or above, per region and in the stats, default none
+        cache(CoverageCache): look the region reports up in, or add them to, this ccbg.coverage_cache cache, used when depth_file is a name, default none
 
     Returns:
         dict of values. 
@@ -563,14 +1822,66 @@ def coverage_regions( depth_file, regions, min_coverage=20):
         No exceptions are caught by the function
     """
 
-    coverages = {}
+    regions = _read_bed_regions( bed_file )
 
-    total_length          = 0
-    total_bases_above_min = 0
-    total_summed_depth    = 0
-    total_min_depth       = None
-    total_max_depth       = None
+    return _summarise_coverages( _region_coverages( depth_file, regions, min_coverage, batch, vectorized, thresholds, cache ))
+
+
+def _read_bed_regions( bed_file ):
+    """reads the regions of a bedfile, named by the 4th column onwards or by their position
+
+    Args:
+        bed_file(str): name of the bedfile to read regions from
+
+    Returns:
+        list of (id, chrom, start, end), start and end included
+    """
+
+    regions = []
+
+    bed_fh = open( bed_file, 'r')
+    for line in bed_fh.readlines():
+        line = line.strip("\n")
+
+        fields = line.split("\t")
+
+        chrom, start, end =  fields[:3]
+        start = int( start )
+        end   = int( end   )
+        id = "_".join(fields[3:])
+        if id is None or id == "":
+            id = "{}:{}-{}".format( chrom, start + 1, end)
+
+        regions.append(( id, chrom, start + 1, end ))
+
+    bed_fh.close()
+
+    return regions
+
+
+
+def coverage_regions( depth_file, regions, min_coverage=20, batch=False, vectorized=False, thresholds=None, cache=None):
+    """reports a full depths/coverage report for a depth-file, limited by regions
+    
+    
+    Args:
+        depth_file: name of file to read from, or an open pysam TabixFile
+        regions(list): list of list of regions consiting of chrom, start, end
+        min_coverage(int): depth cutoff for coverage, default 20
+        batch(bool): read the blocks of each chromosome once for all its regions, rather than fetch per region, default False
+        vectorized(bool): compute the reports with numpy over arrays of the blocks, default False
+        thresholds(list of int): depths to report the bases and percent at or above, per region and in the stats, default none
+        cache(CoverageCache): look the region reports up in, or add them to, this ccbg.coverage_cache cache, used when depth_file is a name, default none
+
+    Returns:
+        dict of values. 
+
+    
+    Raises:
+        No exceptions are caught by the function
+    """
 
+    region_list = []
 
     for region in regions:
         chrom, start, end =  region[:3]
@@ -580,73 +1891,201 @@ def coverage_regions( depth_file, regions, min_coverage=20):
         if id is None or id == "":
             id = "{}:{}-{}".format( chrom, start, end)
 
-        coverage = coverage_region( depth_file, chrom, start, end, min_coverage)
-        
-        total_length += end - start + 1
-        if coverage is not None:
-            total_bases_above_min += coverage[ 'bases_above_min' ]
-            total_summed_depth += coverage[ 'summed_depth' ]
-        
-            if ( total_min_depth is None or total_min_depth > coverage['min_depth']):
-                total_min_depth = coverage['min_depth']
-                
-                if ( total_max_depth is None or total_max_depth < coverage['max_depth']):
-                    total_max_depth = coverage['max_depth']
-                    
-        coverages[ id ] = coverage
+        region_list.append(( id, chrom, start, end ))
 
-#    return { 'percent': 1.0*bases_above_min/total_length, 'length': total_length, 'bases_above_min': bases_above_min }
+    return _summarise_coverages( _region_coverages( depth_file, region_list, min_coverage, batch, vectorized, thresholds, cache ))
 
-    coverages[ 'stats' ] = {}
-    coverages[ 'stats' ][ 'length']          = total_length
-    coverages[ 'stats' ][ 'bases_above_min'] = total_bases_above_min
-    coverages[ 'stats' ][ 'min_depth']       = total_min_depth
-    coverages[ 'stats' ][ 'mean_depth']      = 1.0*total_summed_depth/total_length
-    coverages[ 'stats' ][ 'max_depth']       = total_max_depth
 
 
-    return coverages
+def coverage_matrix( depth_files, bed_file, thresholds=None, processes=None ):
+    """reports the mean depth and percent at or above thresholds of every region in a bedfile for many samples
+
+    The bedfile is read once and the block depth files are spread over a
+    pool of processes. For each sample the blocks over the regions of a
+    chromosome are read in one fetch and the regions are summed from
+    running sums of the blocks, see _sum_regions. Means and percents are
+    over the full region length, as in coverage_region.
+
+    Args:
+        depth_files(list of str): block depth files, one per sample
+        bed_file(str): name of the bedfile to read regions from
+        thresholds(list of int): depths to report the percent of bases at or above, default [20]
+        processes(int): size of the process pool, default one per core
+
+    Returns:
+        dict with 'regions', (id, chrom, start, end) tuples, 'samples', 'thresholds', the
+        regions x samples 'mean_depth' matrix and threshold: regions x samples 'percent_above' matrices.
+        Regions on chromosomes missing from a depth file are NaN
+
+    Raises:
+        No exceptions are caught by the function
+    """
+
+    if ( thresholds is None ):
+        thresholds = [20]
+
+    thresholds = [ int( threshold ) for threshold in thresholds ]
+
+    regions = _read_bed_regions( bed_file )
+
+    chrom_regions = {}
+    for index, ( id, chrom, start, end ) in enumerate( regions ):
+        chrom_regions.setdefault( chrom, [] ).append(( index, start, end ))
+
+    for chrom in chrom_regions:
+        chrom_regions[ chrom ] = numpy.array( chrom_regions[ chrom ], dtype=numpy.int64 ).reshape( -1, 3 ).T
+
+    if ( processes is None ):
+        processes = multiprocessing.cpu_count()
+
+    pool = multiprocessing.Pool( processes )
+    try:
+        results = pool.map( _sample_coverage, [ (depth_file, chrom_regions, thresholds, len( regions )) for depth_file in depth_files ] )
+    finally:
+        pool.terminate()
+
+    matrix = {}
+    matrix[ 'regions' ]       = regions
+    matrix[ 'samples' ]       = [ toolbox.get_sample_name( depth_file ) or os.path.basename( depth_file ) for depth_file in depth_files ]
+    matrix[ 'thresholds' ]    = thresholds
+    matrix[ 'mean_depth' ]    = numpy.column_stack([ means for means, percents in results ]) if results else numpy.zeros(( len( regions ), 0 ))
+    matrix[ 'percent_above' ] = {}
+    for index, threshold in enumerate( thresholds ):
+        matrix[ 'percent_above' ][ threshold ] = numpy.column_stack([ percents[ index ] for means, percents in results ]) if results else numpy.zeros(( len( regions ), 0 ))
+
+    return matrix
+
+
+def _sample_coverage( task ):
+    """the mean depth and percents at or above the thresholds of the regions of one sample, run in a worker process
+
+    Args:
+        task(tuple): block depth file, chrom: (indexes, starts, ends) arrays of the regions, thresholds and the number of regions
+
+    Returns:
+        means (numpy array) and percents (numpy array, one row per threshold) in region order
+    """
 
+    depth_file, chrom_regions, thresholds, n_regions = task
+
+    means    = numpy.empty( n_regions )
+    percents = numpy.empty(( len( thresholds ), n_regions ))
+    means.fill( numpy.nan )
+    percents.fill( numpy.nan )
+
+    depth_in = _tabix_file( depth_file )
+
+    for chrom, ( indexes, starts, ends ) in chrom_regions.items():
+        try:
+            iterator = depth_in.fetch( chrom, int( starts.min()) - 1, int( ends.max()))
+        except:
+            continue
+
+        block_starts, block_ends, block_depths = _parse_depth_rows( list( iterator ))
+        lengths = ends - starts + 1
+
+        if ( numpy.any( block_starts[1:] <= block_ends[:-1] )):
+            # overlapping blocks cannot be summed, report on each region instead
+            coverages = [ None ] * len( indexes )
+            _coverage_regions_arrays( chrom, sorted( zip( starts.tolist(), ends.tolist(), range( len( indexes ))) ),
+                                      [ "{}\t{}\t{}\t{}".format( chrom, block_start, block_end, block_depth )
+                                        for block_start, block_end, block_depth in zip( block_starts.tolist(), block_ends.tolist(), block_depths.tolist()) ],
+                                      1, thresholds, coverages )
+            means[ indexes ] = [ coverage[ 'mean_depth' ] for coverage in coverages ]
+            for row, threshold in enumerate( thresholds ):
+                percents[ row, indexes ] = [ coverage[ 'percent_above' ][ threshold ] for coverage in coverages ]
+            continue
+
+        sums = _block_sums( block_starts, block_ends, block_depths, thresholds )
+        bases, summed_depth, bases_above = _sum_regions( sums, block_starts, block_ends, block_depths, thresholds, starts, ends )
+
+        means[ indexes ] = 1.0 * summed_depth / lengths
+        percents[ :, indexes ] = 1.0 * bases_above / lengths
+
+    return means, percents
+
+
+def write_coverage_matrix( matrix, outfile, binary=False ):
+    """writes a coverage matrix as a tsv, or as a numpy npz table
+
+    The tsv has a row per region: chrom, start, end and name, then the mean
+    depth of every sample, then the percent at or above each threshold for
+    every sample. Missing values are written as NA.
+
+    Args:
+        matrix(dict): coverage matrix, as made by coverage_matrix
+        outfile(str): file to write
+        binary(bool): write a numpy npz table instead of a tsv, default False
+
+    Returns:
+        None
+    """
+
+    if ( binary ):
+        tmp_file = "{}.tmp".format( outfile )
+        fh = open( tmp_file, 'wb' )
+        numpy.savez( fh,
+                     names=numpy.array([ region[0] for region in matrix[ 'regions' ]]),
+                     chroms=numpy.array([ region[1] for region in matrix[ 'regions' ]]),
+                     starts=numpy.array([ region[2] for region in matrix[ 'regions' ]], dtype=numpy.int64 ),
+                     ends=numpy.array([ region[3] for region in matrix[ 'regions' ]], dtype=numpy.int64 ),
+                     samples=numpy.array( matrix[ 'samples' ] ),
+                     thresholds=numpy.array( matrix[ 'thresholds' ], dtype=numpy.int64 ),
+                     mean_depth=matrix[ 'mean_depth' ],
+                     percent_above=numpy.array([ matrix[ 'percent_above' ][ threshold ] for threshold in matrix[ 'thresholds' ]]))
+        fh.close()
+
+        os.rename( tmp_file, outfile )
+        return None
+
+    def format_values( values, value_format ):
+        return [ "NA" if numpy.isnan( value ) else value_format.format( value ) for value in values ]
+
+    header = [ "#chrom", "start", "end", "name" ]
+    header += [ "{}_mean".format( sample ) for sample in matrix[ 'samples' ]]
+    for threshold in matrix[ 'thresholds' ]:
+        header += [ "{}_{}x".format( sample, threshold ) for sample in matrix[ 'samples' ]]
+
+    fh = open( outfile, 'w' )
+    fh.write( "\t".join( header ) + "\n" )
+    for row, ( id, chrom, start, end ) in enumerate( matrix[ 'regions' ] ):
+        fields = [ chrom, str( start ), str( end ), id ]
+        fields += format_values( matrix[ 'mean_depth' ][ row ].tolist(), "{:.2f}" )
+        for threshold in matrix[ 'thresholds' ]:
+            fields += format_values( matrix[ 'percent_above' ][ threshold ][ row ].tolist(), "{:.4f}" )
+
+        fh.write( "\t".join( fields ) + "\n" )
+    fh.close()
+
+    return None
 
 
 def _merge_regions( regions ):
     """ merges neighbouring regions 
 
     Args:
-      regions(list): list of region strings
+      regions(list/IntervalList): list of region strings, or intervals
 
     Returns:
-        list of merged region strings
+        list of merged region strings, or the merged IntervalList if given one
 
     Raises:
         No exceptions are caught by the function
     """
 
-    merged_list = []
+    if ( isinstance( regions, intervals.IntervalList )):
+        return regions.merged()
 
-    prev_chrom, prev_start, prev_end = None, None, None
+    chroms, starts, ends = [], [], []
     for region in regions:
-        region_chrom, region_start, region_end = re.split(r'[:-]', region)
-        region_start = int(region_start)
-        region_end   = int(region_end  )
-
-        # This is the first entry, so set the prev-vars for tracking
-        if ( prev_chrom is None):
-            prev_chrom, prev_start, prev_end = region_chrom, region_start, region_end
-
-        # This is part of the block we are currently growing, important check is the chromosome
-        elif ( prev_end + 1  == region_start and prev_chrom == region_chrom ):
-            prev_end = region_end
+        region_chrom, region_start, region_end = intervals.parse_region( region )
 
+        # part of the block we are currently growing, important check is the chromosome
+        if ( ends and ends[-1] + 1 == region_start and chroms[-1] == region_chrom ):
+            ends[-1] = region_end
         else:
-            # Append block, and start the next one
-            merged_list.append("{}:{}-{}".format( prev_chrom, prev_start, prev_end))
-            prev_chrom, prev_start, prev_end = region_chrom, region_start, region_end
-
-    
-    # append the last entry, if prev_chrom is not none. This only happens if the input is an empty list
-    if ( prev_chrom is not None ):
-        merged_list.append("{}:{}-{}".format( prev_chrom, prev_start, prev_end))
-                               
+            chroms.append( region_chrom )
+            starts.append( region_start )
+            ends.append( region_end )
 
-    return merged_list
+    return [ "{}:{}-{}".format( chrom, start, end ) for chrom, start, end in zip( chroms, starts, ends ) ]
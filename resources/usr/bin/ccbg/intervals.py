@@ -0,0 +1,240 @@
+#!/usr/bin/python
+#
+# Compact lists of genomic intervals: chromosome ids, starts and ends in
+# typed arrays. They act as lists of "chrom:start-end" strings, but the
+# strings are only made when asked for, and merging works on integers.
+#
+#
+
+
+from __future__ import print_function
+import array
+
+
+
+def parse_region( region ):
+    """ splits a "chrom:start-end" string
+
+    Args:
+      region (str): region string, the chromosome may itself contain ':'
+
+    Returns:
+      chrom (str), start (int), end (int)
+
+    """
+
+    chrom, span = region.rsplit( ':', 1 )
+    start, end = span.split( '-' )
+
+    return chrom, int( start ), int( end )
+
+
+
+class IntervalList( object ):
+    """ A list of 1-based, inclusive intervals stored as arrays of chromosome ids, starts and ends
+
+    Iterating, indexing and comparing with a list treat it as the list of
+    "chrom:start-end" strings it stands for. Use strings() for a real list
+    of strings, eg before serialising it.
+    """
+
+    __slots__ = ( 'chroms', 'chrom_ids', 'starts', 'ends', '_chrom_index' )
+
+
+    def __init__( self, regions=None ):
+        """
+        Args:
+          regions (iterable): "chrom:start-end" strings or (chrom, start, end) tuples to start with, default empty
+        """
+
+        self.chroms       = []
+        self._chrom_index = {}
+        self.chrom_ids    = array.array( 'i' )
+        self.starts       = array.array( 'l' )
+        self.ends         = array.array( 'l' )
+
+        for region in regions or []:
+            self.append( region )
+
+
+    @classmethod
+    def from_arrays( cls, chrom, starts, ends, merge=False ):
+        """ makes a list of intervals on one chromosome
+
+        Args:
+          chrom (str): chromosome
+          starts (list/array of int): interval starts
+          ends (list/array of int): interval ends (included)
+          merge (bool): merge neighbouring intervals, as merged() does, default False
+
+        Returns:
+          IntervalList
+
+        """
+
+        if ( hasattr( starts, 'tolist' )):
+            starts, ends = starts.tolist(), ends.tolist()
+
+        if ( merge and starts ):
+            merged_starts, merged_ends = [ starts[0] ], [ ends[0] ]
+            for start, end in zip( starts[1:], ends[1:] ):
+                if ( merged_ends[-1] + 1 == start ):
+                    merged_ends[-1] = end
+                else:
+                    merged_starts.append( start )
+                    merged_ends.append( end )
+
+            starts, ends = merged_starts, merged_ends
+
+        intervals = cls()
+        if ( starts ):
+            intervals.chrom_ids.extend( array.array( 'i', [ intervals._chrom_id( chrom ) ] ) * len( starts ))
+            intervals.starts.extend( starts )
+            intervals.ends.extend( ends )
+
+        return intervals
+
+
+    def _chrom_id( self, chrom ):
+        """ id of a chromosome, adding it if it is new """
+
+        chrom_id = self._chrom_index.get( chrom )
+        if ( chrom_id is None ):
+            chrom_id = len( self.chroms )
+            self._chrom_index[ chrom ] = chrom_id
+            self.chroms.append( chrom )
+
+        return chrom_id
+
+
+    def add( self, chrom, start, end ):
+        """ adds an interval
+
+        Args:
+          chrom (str): chromosome
+          start (int): start position (included)
+          end (int): end position (included)
+
+        Returns:
+          None
+
+        """
+
+        self.chrom_ids.append( self._chrom_id( chrom ))
+        self.starts.append( int( start ))
+        self.ends.append( int( end ))
+
+        return None
+
+
+    def append( self, region ):
+        """ adds an interval given as a "chrom:start-end" string or a (chrom, start, end) tuple
+
+        Args:
+          region (str/tuple): interval
+
+        Returns:
+          None
+
+        """
+
+        if ( isinstance( region, tuple )):
+            self.add( *region )
+        else:
+            self.add( *parse_region( region ))
+
+        return None
+
+
+    def merged( self ):
+        """ merges neighbouring intervals, where one starts on the base after the one before it ends
+
+        Returns:
+          IntervalList
+
+        """
+
+        merged = IntervalList()
+        merged.chroms       = list( self.chroms )
+        merged._chrom_index = dict( self._chrom_index )
+
+        for chrom_id, start, end in zip( self.chrom_ids, self.starts, self.ends ):
+            if ( merged.ends and merged.ends[-1] + 1 == start and merged.chrom_ids[-1] == chrom_id ):
+                merged.ends[-1] = end
+            else:
+                merged.chrom_ids.append( chrom_id )
+                merged.starts.append( start )
+                merged.ends.append( end )
+
+        return merged
+
+
+    def intervals( self ):
+        """ the intervals as (chrom, start, end) tuples
+
+        Returns:
+          list of tuples
+
+        """
+
+        return [ (self.chroms[ chrom_id ], start, end) for chrom_id, start, end in zip( self.chrom_ids, self.starts, self.ends ) ]
+
+
+    def strings( self ):
+        """ the intervals as "chrom:start-end" strings
+
+        Returns:
+          list of str
+
+        """
+
+        return [ "{}:{}-{}".format( self.chroms[ chrom_id ], start, end ) for chrom_id, start, end in zip( self.chrom_ids, self.starts, self.ends ) ]
+
+
+    def __len__( self ):
+        return len( self.starts )
+
+
+    def __iter__( self ):
+        return iter( self.strings())
+
+
+    def __getitem__( self, index ):
+        if ( isinstance( index, slice )):
+            return self.strings()[ index ]
+
+        return "{}:{}-{}".format( self.chroms[ self.chrom_ids[ index ]], self.starts[ index ], self.ends[ index ] )
+
+
+    def __eq__( self, other ):
+        if ( isinstance( other, IntervalList )):
+            return self.intervals() == other.intervals()
+
+        if ( isinstance( other, list )):
+            return self.strings() == other
+
+        return NotImplemented
+
+
+    def __ne__( self, other ):
+        equal = self.__eq__( other )
+        if ( equal is NotImplemented ):
+            return equal
+
+        return not equal
+
+
+    __hash__ = None
+
+
+    def __repr__( self ):
+        return repr( self.strings())
+
+
+    def __getstate__( self ):
+        return ( self.chroms, self.chrom_ids, self.starts, self.ends )
+
+
+    def __setstate__( self, state ):
+        self.chroms, self.chrom_ids, self.starts, self.ends = state
+        self._chrom_index = dict([ (chrom, chrom_id) for chrom_id, chrom in enumerate( self.chroms ) ])
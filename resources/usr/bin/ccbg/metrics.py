@@ -0,0 +1,258 @@
+#!/usr/bin/python
+#
+# Reading of per sample read metrics: samtools flagstat text and json
+# (-O json) output, or a tsv of precomputed usable reads.
+#
+# Parsed files can be cached on disk keyed by path, size and mtime, so
+# re-running over the same run folder does not parse them again.
+#
+
+
+from __future__ import print_function
+import json
+import os
+import re
+from multiprocessing.pool import ThreadPool
+
+import ccbg.toolbox as toolbox
+
+
+# flagstat lines we keep, and the key they are stored under. Newer
+# samtools also report primary counts after the totals, when present
+# those are the ones kept, as the last matching line wins.
+FLAGSTAT_LINE = re.compile(r'^(\d+) (?:\+ \d+ )?(?:primary )?(in total|duplicates|mapped \(|properly paired|singletons)')
+
+FLAGSTAT_KEYS = { 'in total'        : 'total_reads',
+                  'duplicates'      : 'dups_reads',
+                  'mapped ('        : 'mapped_reads',
+                  'properly paired' : 'properly paired',
+                  'singletons'      : 'singletons' }
+
+FLAGSTAT_JSON_KEYS = { 'total'           : 'total_reads',
+                       'duplicates'      : 'dups_reads',
+                       'mapped'          : 'mapped_reads',
+                       'properly paired' : 'properly paired',
+                       'singletons'      : 'singletons' }
+
+# version of the parsed results, bump if the parsing changes so old caches are ignored
+CACHE_VERSION = 1
+
+
+
+def parse_flagstat_text( lines ):
+    """ parses samtools flagstat text output in a single pass
+
+    Args:
+      lines (iterable of str): lines of the flagstat file
+
+    Returns:
+      metrics (dict), counts as ints
+
+    """
+
+    metrics = {}
+    for line in lines:
+        match = FLAGSTAT_LINE.match( line )
+        if ( match ):
+            metrics[ FLAGSTAT_KEYS[ match.group( 2 ) ]] = int( match.group( 1 ))
+
+    return metrics
+
+
+def parse_flagstat_json( text ):
+    """ parses samtools flagstat -O json output
+
+    The primary counts are used where present, to match the text parser.
+
+    Args:
+      text (str): content of the flagstat file
+
+    Returns:
+      metrics (dict), counts as ints
+
+    """
+
+    passed = json.loads( text )[ 'QC-passed reads' ]
+
+    metrics = {}
+    for json_key, key in FLAGSTAT_JSON_KEYS.items():
+        if ( "primary {}".format( json_key ) in passed ):
+            json_key = "primary {}".format( json_key )
+
+        if ( json_key in passed ):
+            metrics[ key ] = int( passed[ json_key ] )
+
+    return metrics
+
+
+def parse_usable_reads_tsv( lines ):
+    """ parses a tsv of sample names and usable reads
+
+    A header line, or any line where the second column is not a number, is skipped.
+
+    Args:
+      lines (iterable of str): lines of the tsv file
+
+    Returns:
+      dict of sample name: metrics (dict)
+
+    """
+
+    samples = {}
+    for line in lines:
+        fields = line.rstrip("\n").split("\t")
+        if ( len( fields ) < 2 or not fields[1].isdigit()):
+            continue
+
+        samples[ fields[0] ] = { 'usable_reads': int( fields[1] ) }
+
+    return samples
+
+
+def parse_metrics_file( filename ):
+    """ parses a flagstat (text or json) or usable reads tsv file
+
+    The format is detected from the content.
+
+    Args:
+      filename (str): file to parse
+
+    Returns:
+      dict of sample name: metrics (dict)
+
+    Raises:
+      ValueError if a flagstat file lacks mapped or duplicate counts
+    """
+
+    fh = open( filename, 'r' )
+    text = fh.read()
+    fh.close()
+
+    if ( text.lstrip().startswith( '{' )):
+        metrics = parse_flagstat_json( text )
+    elif ( 'in total' in text ):
+        metrics = parse_flagstat_text( text.splitlines())
+    else:
+        return parse_usable_reads_tsv( text.splitlines())
+
+    if ( 'mapped_reads' not in metrics or 'dups_reads' not in metrics ):
+        raise ValueError( "{} has no mapped or duplicate read counts".format( filename ))
+
+    metrics[ 'usable_reads' ] = metrics[ 'mapped_reads' ] - metrics[ 'dups_reads' ]
+
+    return { toolbox.get_sample_name( filename ): metrics }
+
+
+def _file_identity( filename ):
+    """ size and mtime of a file, used to tell if a cached parse is still valid
+
+    Args:
+      filename (str): file
+
+    Returns:
+      [size, mtime] (list)
+
+    """
+
+    stat = os.stat( filename )
+    return [ stat.st_size, stat.st_mtime ]
+
+
+def _load_cache( cache_file ):
+    """ loads the metrics cache, an unreadable or outdated cache is treated as empty
+
+    Args:
+      cache_file (str): cache file
+
+    Returns:
+      dict of path: cache entry
+
+    """
+
+    if ( cache_file is None or not os.path.isfile( cache_file )):
+        return {}
+
+    try:
+        fh = open( cache_file, 'r' )
+        cache = json.load( fh )
+        fh.close()
+    except ValueError:
+        return {}
+
+    if ( cache.get( 'version' ) != CACHE_VERSION ):
+        return {}
+
+    return cache[ 'files' ]
+
+
+def _save_cache( cache_file, entries ):
+    """ saves the metrics cache, through a temporary file so a crash never leaves half a cache
+
+    Args:
+      cache_file (str): cache file
+      entries (dict): path: cache entry
+
+    Returns:
+      None
+
+    """
+
+    tmp_file = "{}.tmp".format( cache_file )
+    fh = open( tmp_file, 'w' )
+    json.dump( { 'version': CACHE_VERSION, 'files': entries }, fh )
+    fh.close()
+
+    os.rename( tmp_file, cache_file )
+
+    return None
+
+
+def read_metrics( filenames, processes=4, cache_file=None ):
+    """ reads the metrics of a set of flagstat and usable reads files
+
+    Files not in the cache, or changed since they were cached, are
+    parsed in a pool of threads.
+
+    Args:
+      filenames (list of str): flagstat (text or json) and usable reads tsv files
+      processes (int): number of files read in parallel, default 4
+      cache_file (str): file to cache parsed results in, default no cache
+
+    Returns:
+      dict of sample name: metrics (dict), every sample has 'usable_reads'
+
+    """
+
+    cache = _load_cache( cache_file )
+
+    paths = [ os.path.abspath( filename ) for filename in filenames ]
+    identities = {}
+    parsed = {}
+    to_parse = []
+    for path in paths:
+        identities[ path ] = _file_identity( path )
+
+        entry = cache.get( path )
+        if ( entry is not None and entry[ 'identity' ] == identities[ path ] ):
+            parsed[ path ] = entry[ 'samples' ]
+        else:
+            to_parse.append( path )
+
+    if ( to_parse ):
+        pool = ThreadPool( processes )
+        try:
+            for path, samples in zip( to_parse, pool.map( parse_metrics_file, to_parse )):
+                parsed[ path ] = samples
+        finally:
+            pool.close()
+
+        if ( cache_file is not None ):
+            for path in to_parse:
+                cache[ path ] = { 'identity': identities[ path ], 'samples': parsed[ path ] }
+            _save_cache( cache_file, cache )
+
+    res = {}
+    for path in paths:
+        res.update( parsed[ path ] )
+
+    return res
@@ -0,0 +1,177 @@
+#!/usr/bin/python
+#
+# Light weight run profiling: wall and cpu time per stage, bytes and
+# lines read per input file, throughput, peak memory and periodic
+# progress on stderr. Written out as a json sidecar.
+#
+#
+
+
+from __future__ import print_function
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+
+
+def _cpu_time():
+    """ cpu time used by this process and its finished children
+
+    Returns:
+      seconds (float)
+
+    """
+
+    own      = resource.getrusage( resource.RUSAGE_SELF )
+    children = resource.getrusage( resource.RUSAGE_CHILDREN )
+
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+
+class NullProfile( object ):
+    """ Does nothing, used when profiling is switched off """
+
+    @contextmanager
+    def stage( self, name ):
+        yield
+
+    def count_file( self, filename, lines, bytes_read ):
+        pass
+
+    def add_regions( self, regions ):
+        pass
+
+
+
+class Profile( object ):
+    """ Collects the timings and counters of a run """
+
+    def __init__( self, progress_interval=30, stream=None ):
+        """
+        Args:
+          progress_interval (int): seconds between progress reports, None for no reports
+          stream (file-handle): where progress goes, default stderr
+        """
+
+        self.progress_interval = progress_interval
+        self.stream            = stream or sys.stderr
+
+        self.stages  = {}
+        self.files   = {}
+        self.regions = 0
+
+        self._start         = time.time()
+        self._cpu_start     = _cpu_time()
+        self._last_progress = self._start
+
+
+    @contextmanager
+    def stage( self, name ):
+        """ times the enclosed block, repeated blocks of a stage add up
+
+        Args:
+          name (str): stage name
+
+        """
+
+        wall_start = time.time()
+        cpu_start  = _cpu_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault( name, { 'wall': 0.0, 'cpu': 0.0, 'calls': 0 })
+            stage[ 'wall' ]  += time.time() - wall_start
+            stage[ 'cpu' ]   += _cpu_time() - cpu_start
+            stage[ 'calls' ] += 1
+
+
+    def count_file( self, filename, lines, bytes_read ):
+        """ records what was read from an input file
+
+        Args:
+          filename (str): input file
+          lines (int): lines read
+          bytes_read (int): uncompressed bytes read
+
+        Returns:
+          None
+
+        """
+
+        counts = self.files.setdefault( filename, { 'lines': 0, 'bytes': 0 })
+        counts[ 'lines' ] += lines
+        counts[ 'bytes' ] += bytes_read
+
+        if ( os.path.isfile( filename )):
+            counts[ 'file_size' ] = os.path.getsize( filename )
+
+        return None
+
+
+    def add_regions( self, regions ):
+        """ counts processed regions, and reports progress if it is time to
+
+        Args:
+          regions (int): regions processed since the last call
+
+        Returns:
+          None
+
+        """
+
+        self.regions += regions
+
+        now = time.time()
+        if ( self.progress_interval is not None and now - self._last_progress >= self.progress_interval ):
+            elapsed = now - self._start
+            self.stream.write( "{:.1f}s: {} regions, {:.0f} regions/s\n".format( elapsed, self.regions, self.regions / elapsed ))
+            self.stream.flush()
+            self._last_progress = now
+
+        return None
+
+
+    def report( self ):
+        """ summary of the run so far
+
+        Returns:
+          dict
+
+        """
+
+        wall = time.time() - self._start
+
+        own      = resource.getrusage( resource.RUSAGE_SELF )
+        children = resource.getrusage( resource.RUSAGE_CHILDREN )
+
+        return { 'wall': wall,
+                 'cpu': _cpu_time() - self._cpu_start,
+                 'stages': self.stages,
+                 'files': self.files,
+                 'regions': self.regions,
+                 'regions_per_second': self.regions / wall if wall > 0 else None,
+                 # kilobytes on linux
+                 'peak_rss': own.ru_maxrss,
+                 'peak_rss_children': children.ru_maxrss }
+
+
+    def write( self, filename ):
+        """ writes the summary as json
+
+        Args:
+          filename (str): file to write
+
+        Returns:
+          None
+
+        """
+
+        fh = open( filename, 'w' )
+        json.dump( self.report(), fh, indent=2, sort_keys=True )
+        fh.close()
+
+        return None
@@ -0,0 +1,435 @@
+#!/usr/bin/python
+#
+# A local coverage query service: keeps depth files, their tabix and
+# summary indexes and expected depth files open between requests, and
+# answers region queries as json over http on localhost or a unix socket.
+#
+# Requests are GET with the parameters in the query string:
+#   /coverage  file, chrom, start, end, [min_coverage], [thresholds=20,30]
+#   /summary   file, chrom, start, end
+#   /view      file, chrom, start, end, [limit]
+#   /expected  file, chrom, start, end  (expected depth .gz or .bin file)
+#   /status
+#
+# Every request is served on its own thread. Open files are kept in a
+# least recently used pool of bounded size, and queries on the same file
+# take turns, as pysam handles are not thread safe.
+#
+
+
+from __future__ import print_function
+import collections
+import json
+import os
+import socket
+import sys
+import threading
+from contextlib import contextmanager
+
+try:
+    import BaseHTTPServer
+    import SocketServer
+    import httplib
+    from urllib import urlencode
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    import http.server as BaseHTTPServer
+    import socketserver as SocketServer
+    import http.client as httplib
+    from urllib.parse import urlencode, urlparse, parse_qs
+
+import ccbg.depth as depth
+import ccbg.binary_depth as binary_depth
+import ccbg.intervals as intervals
+import ccbg.toolbox as toolbox
+
+
+# most files kept open at once
+POOL_SIZE = 32
+
+# most rows a /view request returns by default
+VIEW_LIMIT = 10000
+
+
+
+class UnknownQuery( Exception ):
+    """ Raised for a query path the server does not answer """
+
+
+
+class FilePool( object ):
+    """ Open files by path, least recently used ones closed when the pool is full
+
+    A file is used by one thread at a time, and a file dropped from the
+    pool while in use is closed when its user is done with it. A file
+    rewritten since it was opened, or whose index was, is opened again.
+    """
+
+    def __init__( self, size=POOL_SIZE ):
+        """
+        Args:
+          size (int): most files kept open
+        """
+
+        self.size     = size
+        self._entries = collections.OrderedDict()
+        self._lock    = threading.Lock()
+
+
+    @contextmanager
+    def use( self, key, opener ):
+        """ the open file, opened if it is not in the pool, for the enclosed block
+
+        Args:
+          key (tuple): what the file is opened as, the path first
+          opener (callable): opens the file from its path
+
+        """
+
+        identity = toolbox.tabix_identity( key[0] )
+
+        with self._lock:
+            entry = self._entries.pop( key, None )
+            if ( entry is not None and entry[ 'identity' ] != identity ):
+                self._drop( entry )
+                entry = None
+
+            if ( entry is None ):
+                entry = { 'handle': opener( key[0] ), 'identity': identity, 'lock': threading.Lock(), 'users': 0, 'dropped': False }
+
+                while ( len( self._entries ) >= max( 1, self.size )):
+                    self._drop( self._entries.popitem( last=False )[1] )
+
+            self._entries[ key ] = entry
+            entry[ 'users' ] += 1
+
+        try:
+            with entry[ 'lock' ]:
+                yield entry[ 'handle' ]
+        finally:
+            with self._lock:
+                entry[ 'users' ] -= 1
+                if ( entry[ 'dropped' ] and entry[ 'users' ] == 0 ):
+                    self._close( entry )
+
+
+    def _drop( self, entry ):
+        """ closes a file taken out of the pool, or leaves it to its last user """
+
+        entry[ 'dropped' ] = True
+        if ( entry[ 'users' ] == 0 ):
+            self._close( entry )
+
+
+    def _close( self, entry ):
+        if ( hasattr( entry[ 'handle' ], 'close' )):
+            entry[ 'handle' ].close()
+
+
+    def close( self ):
+        """ closes every file in the pool, files in use when their users are done
+
+        Returns:
+          None
+
+        """
+
+        with self._lock:
+            while ( self._entries ):
+                self._drop( self._entries.popitem( last=False )[1] )
+
+        return None
+
+
+    def __len__( self ):
+        return len( self._entries )
+
+
+
+class QueryServer( object ):
+    """ Answers the queries, independent of how they arrive """
+
+    def __init__( self, pool_size=POOL_SIZE ):
+        """
+        Args:
+          pool_size (int): most files kept open
+        """
+
+        self.files = FilePool( pool_size )
+        self.requests = 0
+        self._requests_lock = threading.Lock()
+
+        # the summary indexes are loaded and cached by ccbg.depth
+        self._summary_lock = threading.Lock()
+
+
+    def query( self, path, params ):
+        """ answers a query
+
+        Args:
+          path (str): query type, eg /coverage
+          params (dict): query parameters, name: value
+
+        Returns:
+          json-able result
+
+        Raises:
+          UnknownQuery for an unknown query, ValueError for missing or bad parameters, IOError for missing files
+        """
+
+        with self._requests_lock:
+            self.requests += 1
+
+        handlers = { '/coverage': self.coverage,
+                     '/summary': self.summary,
+                     '/view': self.view,
+                     '/expected': self.expected,
+                     '/status': self.status }
+
+        if ( path not in handlers ):
+            raise UnknownQuery( "unknown query {}".format( path ))
+
+        return handlers[ path ]( params )
+
+
+    def _region( self, params ):
+        """ the file and region of a query """
+
+        for name in [ 'file', 'chrom', 'start', 'end' ]:
+            if ( name not in params ):
+                raise ValueError( "{} is missing".format( name ))
+
+        if ( not os.path.isfile( params[ 'file' ] )):
+            raise IOError( "{} does not exist".format( params[ 'file' ] ))
+
+        return os.path.abspath( params[ 'file' ] ), params[ 'chrom' ], int( params[ 'start' ] ), int( params[ 'end' ] )
+
+
+    def _tabix( self, filename ):
+        return self.files.use(( filename, 'tabix' ), toolbox.open_tabix )
+
+
+    def coverage( self, params ):
+        """ coverage_region report of a block depth file """
+
+        filename, chrom, start, end = self._region( params )
+
+        thresholds = None
+        if ( params.get( 'thresholds' )):
+            thresholds = [ int( threshold ) for threshold in params[ 'thresholds' ].split( ',' ) ]
+
+        with self._tabix( filename ) as depth_in:
+            return depth.coverage_region( depth_in, chrom, start, end, int( params.get( 'min_coverage', 1 )), vectorized=True, thresholds=thresholds )
+
+
+    def summary( self, params ):
+        """ summary_region report of a block depth file with a summary index """
+
+        filename, chrom, start, end = self._region( params )
+
+        with self._summary_lock:
+            return depth.summary_region( filename, chrom, start, end )
+
+
+    def view( self, params ):
+        """ the rows of a tabix indexed file over a region """
+
+        filename, chrom, start, end = self._region( params )
+        limit = int( params.get( 'limit', VIEW_LIMIT ))
+
+        rows = []
+        with self._tabix( filename ) as depth_in:
+            try:
+                for row in depth_in.fetch( chrom, start - 1, end ):
+                    if ( len( rows ) == limit ):
+                        break
+                    rows.append( row.split( "\t" ))
+            except ValueError:
+                pass
+
+        return rows
+
+
+    def expected( self, params ):
+        """ the expected depth rows over a region, from a bgzipped and indexed or a binary expected depth file """
+
+        filename, chrom, start, end = self._region( params )
+
+        if ( filename.endswith( ".bin" )):
+            with self.files.use(( filename, 'binary' ), binary_depth.open_binary_depth ) as table:
+                found = binary_depth.lookup_binary_depth( table, chrom, start, end )
+                if ( found is None ):
+                    return []
+
+                return [ [chrom] + list( row ) for row in zip( found[ 'starts' ].tolist(), found[ 'ends' ].tolist(),
+                                                               found[ 'means' ].tolist(), found[ 'stddevs' ].tolist()) ]
+
+        rows = []
+        for fields in self.view( params ):
+            rows.append([ fields[0], int( fields[1] ), int( fields[2] ), float( fields[3] ), float( fields[4] ) ])
+
+        return rows
+
+
+    def status( self, params ):
+        """ what the server holds """
+
+        return { 'requests': self.requests,
+                 'open_files': len( self.files ),
+                 'summary_indexes': len( depth._summary_indexes ),
+                 'pid': os.getpid() }
+
+
+    def close( self ):
+        """ closes all open files
+
+        Returns:
+          None
+
+        """
+
+        self.files.close()
+
+        return None
+
+
+
+def _json_default( value ):
+    """ json encodes the non standard types in the results """
+
+    if ( isinstance( value, intervals.IntervalList )):
+        return value.strings()
+
+    if ( hasattr( value, 'tolist' )):
+        return value.tolist()
+
+    raise TypeError( "{} is not json serialisable".format( type( value )))
+
+
+
+class QueryHandler( BaseHTTPServer.BaseHTTPRequestHandler ):
+    """ Turns http requests into queries and the results into json """
+
+    def do_GET( self ):
+        url = urlparse( self.path )
+        params = dict([ (name, values[-1]) for name, values in parse_qs( url.query ).items() ])
+
+        try:
+            code, result = 200, self.server.queries.query( url.path, params )
+        except UnknownQuery as error:
+            code, result = 404, { 'error': str( error ) }
+        except ( IOError, OSError ) as error:
+            code, result = 404, { 'error': str( error ) }
+        except ValueError as error:
+            code, result = 400, { 'error': str( error ) }
+        except Exception as error:
+            code, result = 500, { 'error': str( error ) }
+
+        body = json.dumps( result, default=_json_default ).encode( 'utf-8' )
+
+        self.send_response( code )
+        self.send_header( "Content-Type", "application/json" )
+        self.send_header( "Content-Length", str( len( body )))
+        self.end_headers()
+        self.wfile.write( body )
+
+
+    def address_string( self ):
+        # unix socket clients have no address
+        if ( isinstance( self.client_address, tuple )):
+            return self.client_address[0]
+
+        return "local"
+
+
+    def log_message( self, format, *args ):
+        if ( self.server.verbose ):
+            sys.stderr.write( "{} - - [{}] {}\n".format( self.address_string(), self.log_date_time_string(), format % args ))
+
+
+
+class ThreadingHTTPServer( SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer ):
+    daemon_threads     = True
+    request_queue_size = 128
+
+
+
+class ThreadingUnixHTTPServer( SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer ):
+    daemon_threads     = True
+    request_queue_size = 128
+
+    def server_bind( self ):
+        SocketServer.UnixStreamServer.server_bind( self )
+        # what BaseHTTPServer.HTTPServer sets for tcp servers
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+
+def make_server( host='127.0.0.1', port=8765, unix_socket=None, pool_size=POOL_SIZE, verbose=False ):
+    """ makes a query server, call serve_forever on it to start serving
+
+    Args:
+      host (str): address to listen on, default localhost only
+      port (int): port to listen on, 0 for any free port
+      unix_socket (str): listen on this unix socket instead of tcp, default None
+      pool_size (int): most files kept open
+      verbose (bool): log every request to stderr
+
+    Returns:
+      server, with the queries answered by its QueryServer as .queries
+
+    """
+
+    if ( unix_socket is not None ):
+        if ( os.path.exists( unix_socket )):
+            os.unlink( unix_socket )
+        server = ThreadingUnixHTTPServer( unix_socket, QueryHandler )
+    else:
+        server = ThreadingHTTPServer(( host, port ), QueryHandler )
+
+    server.queries = QueryServer( pool_size )
+    server.verbose = verbose
+
+    return server
+
+
+
+class UnixHTTPConnection( httplib.HTTPConnection ):
+    """ http connection over a unix socket """
+
+    def __init__( self, unix_socket, timeout=60 ):
+        httplib.HTTPConnection.__init__( self, "localhost", timeout=timeout )
+        self.unix_socket = unix_socket
+
+    def connect( self ):
+        self.sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        self.sock.settimeout( self.timeout )
+        self.sock.connect( self.unix_socket )
+
+
+
+def query( address, path, **params ):
+    """ sends a query to a running server
+
+    Args:
+      address (str/tuple): unix socket path, or (host, port)
+      path (str): query type, eg /coverage
+      params: query parameters
+
+    Returns:
+      http status (int), result (decoded json)
+
+    """
+
+    if ( isinstance( address, tuple )):
+        connection = httplib.HTTPConnection( *address )
+    else:
+        connection = UnixHTTPConnection( address )
+
+    try:
+        connection.request( "GET", "{}?{}".format( path, urlencode( params )))
+        response = connection.getresponse()
+        return response.status, json.loads( response.read().decode( 'utf-8' ))
+    finally:
+        connection.close()
@@ -13,6 +13,8 @@ import os
 import re
 import gzip
 
+import pysam
+
 
 
 
@@ -41,6 +43,56 @@ def open_file( filename ):
 
 
 
+def open_tabix( filename ):
+    """ opens a bgzipped and tabix indexed file
+
+     pysam before 0.8 names the class Tabixfile, later versions TabixFile,
+     and the app installs pysam 0.7.6
+
+    Args:
+      filename (str): file to open, the .tbi index next to it
+
+    Returns:
+      pysam Tabixfile/TabixFile
+
+    """
+
+    tabix_class = getattr( pysam, 'TabixFile', None ) or pysam.Tabixfile
+
+    return tabix_class( filename )
+
+
+
+
+def tabix_identity( filename ):
+    """ what tells a bgzipped file and its tabix index apart from a rewritten one
+
+     size, mtime and inode of the file, and of its .tbi index if it has one,
+     so a file replaced at the same path, or re-indexed, is noticed
+
+    Args:
+      filename (str): bgzipped file
+
+    Returns:
+      identity (tuple)
+
+    """
+
+    identity = []
+    for name in [ filename, "{}.tbi".format( filename ) ]:
+        try:
+            stat = os.stat( name )
+        except OSError:
+            identity.append( None )
+            continue
+
+        identity.append(( stat.st_size, stat.st_mtime, stat.st_ino ))
+
+    return tuple( identity )
+
+
+
+
 def print_stdout_or_file(line, fh=None):
     ''' wrapping function giving the option to either print to a file handle or stdout
 
@@ -0,0 +1,56 @@
+#!/usr/bin/python
+#
+# Runs the ccbg coverage query server, see ccbg/query_server.py for the queries.
+#
+#
+
+
+from __future__ import print_function
+import argparse
+import os
+import signal
+import sys
+
+import ccbg.depth as depth
+import ccbg.query_server as query_server
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Answers coverage and expected depth queries on local files as json over http')
+
+    parser.add_argument('--socket', help="listen on this unix socket instead of tcp")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on, default 127.0.0.1")
+    parser.add_argument('--port', type=int, default=8765, help="port to listen on, default 8765")
+    parser.add_argument('--open-files', type=int, default=query_server.POOL_SIZE, help="most files kept open, default {}".format(query_server.POOL_SIZE))
+    parser.add_argument('--summary-indexes', type=int, default=depth.SUMMARY_POOL_SIZE, help="most summary indexes kept in memory, default {}".format(depth.SUMMARY_POOL_SIZE))
+    parser.add_argument('-v', '--verbose', action="store_true", default=False, help="log every request on stderr")
+
+    args = parser.parse_args()
+
+    depth.SUMMARY_POOL_SIZE = args.summary_indexes
+
+    try:
+        server = query_server.make_server(args.host, args.port, args.socket, args.open_files, args.verbose)
+    except ( IOError, OSError ) as error:
+        print("Error could not listen: {}".format(error))
+        exit(-10)
+
+    if (args.socket is not None):
+        print("Listening on {}".format(args.socket))
+    else:
+        print("Listening on http://{}:{}".format(*server.server_address))
+
+    # stopped with a kill as well as ctrl-c, so the socket is removed either way
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.queries.close()
+        if (args.socket is not None and os.path.exists(args.socket)):
+            os.unlink(args.socket)
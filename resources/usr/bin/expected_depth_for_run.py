@@ -7,14 +7,24 @@
 # Pavlos Antoniou (14 Aug 2018), contact: pavlos.antoniou@addenbrookes.nhs.uk
 
 
-import sys
 import os
-import re
 import gzip
+import hashlib
+import random
 import argparse
+import cProfile
+import tempfile
+import threading
+import multiprocessing
+import Queue
+from itertools import islice, izip, izip_longest
 from math import sqrt
-import pysam
+import numpy
 import ccbg.toolbox as toolbox
+import ccbg.bgzf as bgzf
+import ccbg.binary_depth as binary_depth
+import ccbg.metrics as metrics
+import ccbg.profiling as profiling
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
 
@@ -22,60 +32,390 @@ pp = pprint.PrettyPrinter(indent=4)
 # Expected depths in ouput will be normalised represent a sample with 100M reads
 NORMAL_READS = 100000000
 
+# Number of regions held in memory at a time by the numpy engine
+CHUNK_SIZE = 10000
 
-def readin_flagstats(filenames):
+# Records per batch, and batches queued per file, for the concurrent readers
+READER_BATCH_SIZE = 1000
+READER_QUEUE_SIZE = 16
 
-    res = {}
-    for filename in filenames:
+# Regions checked per file by the quick validation
+VALIDATION_SAMPLE_SIZE = 100
 
-        sample_name = toolbox.get_sample_name(filename)
+# Replaced by a profiling.Profile when run with --profile
+PROFILE = profiling.NullProfile()
 
-        res[ sample_name ] = {}
 
-        fh = open (filename, 'Ur')
-        for line in fh.readlines():
-            line = line.strip("\n")
+def readin_flagstats(filenames, processes=4, cache_file=None):
+    """ Reads the usable reads of the samples
 
-            if re.search('total', line):
-                res[sample_name]['total_reads'] = re.sub(r'^(\d+) .*reads.*', r'\1', line)
+    Args:
+      filenames (list of str): flagstat files, text or json, or tsv files of usable reads
+      processes (int): number of files read in parallel
+      cache_file (str): cache of parsed files, default None
 
-            elif re.search(r'duplicates', line):
-                res[sample_name]['dups_reads'] = re.sub(r'^(\d+) .*duplicates', r'\1', line)
+    Returns:
+      dict of sample name: metrics (dict)
 
-            elif re.search(r'mapped \(', line):
-                res[sample_name]['mapped_reads']= re.sub(r'^(\d+) .*mapped.*', r'\1', line)
+    """
 
-            elif re.search(r'properly paired', line):
-                res[sample_name]['properly paired']= re.sub(r'^(\d+) .*properly paired .*', r'\1', line)
+    return metrics.read_metrics(filenames, processes, cache_file)
 
-            elif re.search(r'singletons', line):
-                res[sample_name]['singletons']= re.sub(r'^(\d+) .*singletons .*', r'\1', line)
 
-        res[sample_name]['usable_reads'] = int(res[sample_name]['mapped_reads']) - int(res[sample_name]['dups_reads'])
+def read_coverage_file(filename, profile=None):
+    """ Reads the regions and mean depths from a region coverage file
 
-        fh.close()
+    Comment lines are skipped, so files with headers of different
+    lengths still line up on their first region.
+
+    Args:
+      filename (str): gzipped region coverage file
+      profile (Profile): where the lines and bytes read are counted, default PROFILE
 
-    return res
+    Returns:
+      generator of (chrom, start, end, mean_depth) tuples, the
+      coordinates are kept as strings
 
+    """
 
-def calculate_exp_depth(flagstats, filenames, outfile, force=False ):
-    
-    fhs = {}
+    lines = 0
+    bytes_read = 0
+
+    fh = gzip.open(filename)
+    for line in fh:
+        lines += 1
+        bytes_read += len(line)
+
+        if ('#' in line):
+            continue
+
+        record = _parse_coverage_line(line)
+        if (record is not None):
+            yield record
+
+    fh.close()
+
+    (profile or PROFILE).count_file(filename, lines, bytes_read)
+
+
+def fetch_coverage_records(filename, chrom, profile=None):
+    """ Reads the regions and mean depths on one chromosome using the tabix index
+
+    Args:
+      filename (str): bgzipped and tabix indexed region coverage file
+      chrom (str): chromosome to fetch
+      profile (Profile): where the lines and bytes read are counted, default PROFILE
+
+    Returns:
+      generator of (chrom, start, end, mean_depth) tuples
+
+    """
+
+    lines = 0
+    bytes_read = 0
+
+    tabix_file = toolbox.open_tabix(filename)
+    for line in tabix_file.fetch(chrom):
+        lines += 1
+        # tabix strips the newline
+        bytes_read += len(line) + 1
+
+        record = _parse_coverage_line(line)
+        if (record is not None):
+            yield record
+
+    tabix_file.close()
+
+    (profile or PROFILE).count_file(filename, lines, bytes_read)
+
+
+def _count_files(files):
+    """ Adds the file counts a worker process made to PROFILE
+
+    Args:
+      files (dict): filename: lines and bytes read, as in Profile.files
+
+    Returns:
+      None
+
+    """
+
+    for filename, counts in files.items():
+        PROFILE.count_file(filename, counts['lines'], counts['bytes'])
+
+
+def _parse_coverage_line(line):
+    """ Splits a coverage line into (chrom, start, end, mean_depth)
+
+    Args:
+      line (str): line from a region coverage file
+
+    Returns:
+      (chrom, start, end, mean_depth), None for a malformed line
+
+    """
+
+    line = line.rstrip("\n")
+    fields = line.split("\t")
+    if (len(fields) < 5):
+        print "Error line: '{}'".format(line)
+        return None
+
+    return fields[0], fields[1], fields[2], float(fields[4])
+
+
+def _reader_worker(filename, record_queue, batch_size):
+    """ Parses a coverage file and pushes batches of records onto a queue
+
+    The lines and bytes read are queued once the file is exhausted, so
+    they reach the profile of the parent from a process as well, or the
+    exception if reading fails, so the consumer never waits on a dead
+    worker.
+
+    Args:
+      filename (str): gzipped region coverage file
+      record_queue (Queue): bounded queue to put batches on
+      batch_size (int): records per batch
+
+    Returns:
+      None
+
+    """
+
+    try:
+        profile = profiling.Profile(progress_interval=None)
+
+        batch = []
+        for record in read_coverage_file(filename, profile):
+            batch.append(record)
+            if (len(batch) >= batch_size):
+                record_queue.put(batch)
+                batch = []
+
+        if (len(batch) > 0):
+            record_queue.put(batch)
+
+        record_queue.put(profile.files)
+
+    except Exception as error:
+        record_queue.put(error)
+
+
+def _queued_records(record_queue):
+    """ Yields the records a reader worker puts on its queue
+
+    Args:
+      record_queue (Queue): queue filled by _reader_worker
+
+    Returns:
+      generator of (chrom, start, end, mean_depth) tuples
+
+    """
+
+    while(True):
+        batch = record_queue.get()
+        if (isinstance(batch, dict)):
+            _count_files(batch)
+            return
+
+        if (isinstance(batch, Exception)):
+            raise batch
+
+        for record in batch:
+            yield record
+
+
+def open_coverage_readers(filenames, mode='serial', batch_size=READER_BATCH_SIZE, queue_size=READER_QUEUE_SIZE):
+    """ Opens a record reader for every coverage file
+
+    In thread and process mode every file is decompressed and parsed
+    by its own worker, so gzip inflate for the samples overlaps. The
+    queues are bounded, so a worker never gets more than queue_size
+    batches ahead of the aggregator.
+
+    Args:
+      filenames (list of str): gzipped region coverage files
+      mode (str): 'serial', 'thread' or 'process'
+      batch_size (int): records per queued batch
+      queue_size (int): batches queued per file
 
+    Returns:
+      list of generators of (chrom, start, end, mean_depth) tuples
+
+    """
+
+    if (mode == 'serial'):
+        return [read_coverage_file(filename) for filename in filenames]
+
+    readers = []
     for filename in filenames:
+        if (mode == 'thread'):
+            record_queue = Queue.Queue(queue_size)
+            worker = threading.Thread(target=_reader_worker, args=(filename, record_queue, batch_size))
+        elif (mode == 'process'):
+            record_queue = multiprocessing.Queue(queue_size)
+            worker = multiprocessing.Process(target=_reader_worker, args=(filename, record_queue, batch_size))
+        else:
+            raise ValueError("Unknown reader mode: {}".format(mode))
 
-        sample_name = toolbox.get_sample_name(filename)
-        fhs[sample_name] = gzip.open(filename)
+        worker.daemon = True
+        worker.start()
+        readers.append(_queued_records(record_queue))
+
+    return readers
+
+
+def calculate_exp_depth(flagstats, filenames, outfile, force=False, engine='numpy', chunk_size=CHUNK_SIZE, readers='serial', processes=None, binary=False):
+    """ Calculates the normalised mean depth and standard deviation per region
 
-    fh = None
-    if (outfile is not None):
-        fh = open(outfile, 'w')
-        fh.write("# File generated by expected_depth_for_run.py\n")
-        fh.write("# Args: {}\n".format(", ".join(filenames)))
+    Args:
+      flagstats (dict): usable reads per sample, from readin_flagstats
+      filenames (list of str): region coverage files, one per sample
+      outfile (str): name to write [outfile].gz and its tabix index to. Stdout if None
+      force (bool): overwrite existing output files
+      engine (str): 'numpy' aggregates chunks of regions as a regions x samples
+                    matrix, 'python' walks the files one line and sample at a time,
+                    'sharded' runs the numpy engine per chromosome in a process pool
+      chunk_size (int): number of regions per matrix chunk
+      readers (str): how the numpy engine reads the files, 'serial',
+                     or one 'thread' or 'process' per file
+      processes (int): size of the sharded process pool, default one per core
+      binary (bool): also write a memory mappable [outfile].bin
+
+    Returns:
+      None
+
+    """
+
+    if (engine == 'numpy'):
+        rows = _matrix_rows(flagstats, filenames, chunk_size, readers)
+    elif (engine == 'sharded'):
+        rows = _sharded_rows(flagstats, filenames, chunk_size, processes)
     else:
+        rows = _lockstep_rows(flagstats, filenames)
+
+    write_exp_depth(rows, filenames, outfile, force, binary)
+
+
+def write_exp_depth(rows, args, outfile, force=False, binary=False):
+    """ Writes expected depth rows to stdout or a bgzipped and indexed file
+
+    Args:
+      rows (iterable): (chrom, start, end, mean, stddev) tuples
+      args (list of str): the inputs, listed in the header
+      outfile (str): name to write [outfile].gz and its tabix index to. Stdout if None
+      force (bool): overwrite existing output files
+      binary (bool): also write the rows to [outfile].bin, see ccbg.binary_depth
+
+    Returns:
+      None
+
+    """
+
+    if (outfile is None):
         print("# File generated by expected_depth_for_run.py")
-        print("# Args: {}".format(", ".join(filenames)))
+        print("# Args: {}".format(", ".join(args)))
 
+        for chunk in _row_chunks(rows):
+            with PROFILE.stage('write'):
+                for row in chunk:
+                    print("{}\t{}\t{}\t{}\t{}".format(*row))
+
+        return
+
+    outfile = "{}.gz".format(outfile)
+    if (os.path.isfile(outfile) and not force):
+        raise IOError("Filename {} already exists, use force to overwrite".format(outfile))
+
+    # compressed and indexed as the rows are produced, so no uncompressed copy is ever written
+    fh = bgzf.BgzfWriter(outfile, index=bgzf.TabixIndex(seq_col=0, start_col=1, end_col=2))
+    fh.write("# File generated by expected_depth_for_run.py\n")
+    fh.write("# Args: {}\n".format(", ".join(args)))
+
+    binary_fh = None
+    if (binary):
+        binary_fh = binary_depth.BinaryDepthWriter("{}.bin".format(outfile[:-len(".gz")]))
+
+    for chunk in _row_chunks(rows):
+        with PROFILE.stage('write'):
+            for row in chunk:
+                fh.write_line("{}\t{}\t{}\t{}\t{}\n".format(*row))
+
+                if (binary_fh is not None):
+                    binary_fh.add(*row)
+
+    with PROFILE.stage('index'):
+        fh.close()
+
+        if (binary_fh is not None):
+            binary_fh.close()
+
+
+def _row_chunks(rows, chunk_size=CHUNK_SIZE):
+    """ Groups rows into chunks, timing how long the rows take to produce
+
+    Args:
+      rows (iterable): (chrom, start, end, mean, stddev) tuples
+      chunk_size (int): rows per chunk
+
+    Returns:
+      generator of lists of rows
+
+    """
+
+    rows = iter(rows)
+    while(True):
+        with PROFILE.stage('rows'):
+            chunk = list(islice(rows, chunk_size))
+
+        if (len(chunk) == 0):
+            return
+
+        PROFILE.add_regions(len(chunk))
+        yield chunk
+
+
+def _open_coverage_files(filenames):
+    """ Opens the coverage files keyed on sample name
+
+    The dict iteration order is the order samples are summed in, both
+    engines use it so they add the depths up in the same order.
+
+    Args:
+      filenames (list of str): region coverage files
+
+    Returns:
+      dict of sample name: filename
+
+    """
+
+    samples = {}
+    for filename in filenames:
+        sample_name = toolbox.get_sample_name(filename)
+        samples[sample_name] = filename
+
+    return samples
+
+
+def _lockstep_rows(flagstats, filenames):
+    """ Reads the coverage files one line and one sample at a time
+
+    Args:
+      flagstats (dict): usable reads per sample
+      filenames (list of str): region coverage files
+
+    Returns:
+      generator of (chrom, start, end, mean, stddev) tuples
+
+    """
+
+    fhs = {}
+
+    sample_files = _open_coverage_files(filenames)
+    for sample_name, filename in sample_files.items():
+        fhs[sample_name] = gzip.open(filename)
+
+    lines = dict.fromkeys(fhs, 0)
 
     while(True):
         depths = []
@@ -85,6 +425,8 @@ def calculate_exp_depth(flagstats, filenames, outfile, force=False ):
         comment_line = False
         for sample_name in fhs:
             depth = fhs[sample_name].readline()
+            if (depth):
+                lines[sample_name] += 1
 
             # we dont have flagstats infor for this sample, so skip it
             if sample_name not in flagstats:
@@ -105,9 +447,9 @@ def calculate_exp_depth(flagstats, filenames, outfile, force=False ):
                 start = fields[1]
                 end   = fields[2]
 
-            if ( chrom != fields[0] and start != fields[1] and end != fields[2]):
-                region = "{chrom}:{start}-{end}"
-                print("Files out of sync region {}: does not match region {}".format(region.format(chrom, start, end), 
+            if ( chrom != fields[0] or start != fields[1] or end != fields[2]):
+                region = "{}:{}-{}"
+                print("Files out of sync region {}: does not match region {}".format(region.format(chrom, start, end),
                                                                                       region.format(fields[0], fields[1], fields[2])))
                 exit(-10)
 
@@ -123,15 +465,409 @@ def calculate_exp_depth(flagstats, filenames, outfile, force=False ):
             print "Breaking on missing depths"
             break
 
-        if (fh is not None):
-            fh.write("{}\t{}\t{}\t{}\t{}\n".format(chrom, start, end, sum(depths)/len(depths), standard_deviation(depths)))
-        else:
-            print "{}\t{}\t{}\t{}\t{}".format(chrom, start, end, sum(depths)/len(depths), standard_deviation(depths))
+        yield chrom, start, end, sum(depths)/len(depths), standard_deviation(depths)
+
+    for sample_name in fhs:
+        # tell is the uncompressed offset, the bytes read
+        PROFILE.count_file(sample_files[sample_name], lines[sample_name], fhs[sample_name].tell())
+        fhs[sample_name].close()
+
+
+def _matrix_rows(flagstats, filenames, chunk_size=CHUNK_SIZE, readers='serial'):
+    """ Reads the coverage files in chunks of regions into a regions x samples matrix
+
+    Depths are normalised a column at a time and the sums are built
+    one sample column after the other, in the same order as the
+    lockstep reader, so the output formats to the same text.
+
+    Args:
+      flagstats (dict): usable reads per sample
+      filenames (list of str): region coverage files
+      chunk_size (int): number of regions per chunk
+      readers (str): reader mode, see open_coverage_readers
+
+    Returns:
+      generator of (chrom, start, end, mean, stddev) tuples
+
+    """
+
+    samples, sample_files = _samples_with_flagstats(flagstats, filenames)
+    if (len(samples) == 0):
+        return
+
+    for row in _aggregate_records(flagstats, samples, open_coverage_readers(sample_files, readers), chunk_size):
+        yield row
+
+
+def _samples_with_flagstats(flagstats, filenames):
+    """ Finds the samples, in summing order, that have flagstats
+
+    Args:
+      flagstats (dict): usable reads per sample
+      filenames (list of str): region coverage files
+
+    Returns:
+      sample names (list of str)
+      coverage files (list of str)
+
+    """
+
+    samples = []
+    sample_files = []
+    for sample_name, filename in _open_coverage_files(filenames).items():
+        # we dont have flagstats infor for this sample, so skip it
+        if sample_name not in flagstats:
+            continue
+
+        samples.append(sample_name)
+        sample_files.append(filename)
+
+    return samples, sample_files
+
+
+def _aggregate_records(flagstats, samples, readers, chunk_size=CHUNK_SIZE):
+    """ Aggregates the records of the samples a chunk of regions at a time
+
+    Args:
+      flagstats (dict): usable reads per sample
+      samples (list of str): sample names
+      readers (list of generators): (chrom, start, end, mean_depth) records, one per sample
+      chunk_size (int): number of regions per chunk
+
+    Returns:
+      generator of (chrom, start, end, mean, stddev) tuples
+
+    """
+
+    usable_reads = numpy.array([flagstats[sample_name]['usable_reads'] for sample_name in samples], dtype=numpy.float64)
+
+    while(True):
+        with PROFILE.stage('rows.read'):
+            regions = list(islice(readers[0], chunk_size))
+            if (len(regions) == 0):
+                _check_readers_exhausted(readers[1:])
+                break
+
+            depths = numpy.empty((len(regions), len(samples)), dtype=numpy.float64)
+            depths[:, 0] = [region[3] for region in regions]
+
+            for column in range(1, len(samples)):
+                sample_regions = list(islice(readers[column], chunk_size))
+                _check_regions_in_sync(regions, sample_regions)
+                depths[:, column] = [region[3] for region in sample_regions]
+
+        with PROFILE.stage('rows.aggregate'):
+            depths = depths * NORMAL_READS / usable_reads
+
+            means, std_devs = matrix_mean_and_standard_deviation(depths)
+
+        for region, mean, std_dev in izip(regions, means, std_devs):
+            yield region[0], region[1], region[2], mean, std_dev
+
+
+def _sharded_rows(flagstats, filenames, chunk_size=CHUNK_SIZE, processes=None):
+    """ Calculates the expected depths one chromosome per process
+
+    The chromosomes are taken, in file order, from the tabix index of
+    the first coverage file. Every shard fetches only its chromosome
+    from each sample and writes its rows to a temporary file, and the
+    shards are read back in chromosome order.
+
+    Args:
+      flagstats (dict): usable reads per sample
+      filenames (list of str): tabix indexed region coverage files
+      chunk_size (int): number of regions per chunk
+      processes (int): size of the process pool, default one per core
+
+    Returns:
+      generator of (chrom, start, end, mean, stddev) tuples
+
+    """
+
+    samples, sample_files = _samples_with_flagstats(flagstats, filenames)
+    if (len(samples) == 0):
+        return
+
+    tabix_file = toolbox.open_tabix(sample_files[0])
+    chroms = list(tabix_file.contigs)
+    tabix_file.close()
+
+    shards = [(flagstats, samples, sample_files, chrom, chunk_size) for chrom in chroms]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for shard_file, files in pool.imap(_calculate_shard, shards):
+            _count_files(files)
+
+            fh = open(shard_file)
+            for line in fh:
+                yield line.rstrip("\n").split("\t")
+            fh.close()
+            os.unlink(shard_file)
+
+    except RuntimeError as error:
+        print(error)
+        exit(-10)
+
+    finally:
+        pool.terminate()
+
+
+def _calculate_shard(shard):
+    """ Calculates the expected depths for a single chromosome
 
-    if (outfile is not None):
+    Args:
+      shard (tuple): flagstats, samples, sample files, chromosome and chunk size
+
+    Returns:
+      name of the temporary file holding the rows (str)
+      lines and bytes read per file (dict), for the profile of the parent
+
+    """
+
+    flagstats, samples, sample_files, chrom, chunk_size = shard
+
+    profile = profiling.Profile(progress_interval=None)
+    readers = [fetch_coverage_records(filename, chrom, profile) for filename in sample_files]
+
+    fd, shard_file = tempfile.mkstemp(suffix=".tsv")
+    fh = os.fdopen(fd, 'w')
+    try:
+        for row in _aggregate_records(flagstats, samples, readers, chunk_size):
+            fh.write("{}\t{}\t{}\t{}\t{}\n".format(*row))
+
+    # an exit inside a pool worker would leave the pool waiting for the shard forever
+    except SystemExit:
+        os.unlink(shard_file)
+        raise RuntimeError("Shard {} failed, coverage files out of sync".format(chrom))
+
+    finally:
         fh.close()
-        pysam.tabix_index(outfile, seq_col=0, start_col=1, end_col=2, force=force)
 
+    return shard_file, profile.files
+
+
+def _check_regions_in_sync(regions, sample_regions):
+    """ Exits if a sample does not have the same regions as the first sample
+
+    Args:
+      regions (list): (chrom, start, end, depth) of the first sample
+      sample_regions (list): (chrom, start, end, depth) of the sample to check
+
+    Returns:
+      None
+
+    """
+
+    for region, sample_region in izip(regions, sample_regions):
+        if (region[:3] != sample_region[:3]):
+            name = "{}:{}-{}"
+            print("Files out of sync region {}: does not match region {}".format(name.format(*region[:3]),
+                                                                                  name.format(*sample_region[:3])))
+            exit(-10)
+
+    if (len(regions) != len(sample_regions)):
+        print("Files out of sync, they contain a different number of regions")
+        exit(-10)
+
+
+def _check_readers_exhausted(readers):
+    """ Exits if any of the readers still has records left
+
+    Args:
+      readers (list of generators): coverage records of the other samples
+
+    Returns:
+      None
+
+    """
+
+    for reader in readers:
+        for record in reader:
+            print("Files out of sync, they contain a different number of regions")
+            exit(-10)
+
+
+def validate_coverage_files(filenames, mode='full', processes=None):
+    """ Checks that all coverage files hold the same regions, before any aggregation
+
+    'full' compares a digest of the region columns of every file, read
+    in parallel, and for the files that differ finds the first region
+    that does not match the first file. 'quick' only compares the
+    chromosomes in the tabix indexes, and looks up a sample of the
+    first file's regions in every other file.
+
+    Args:
+      filenames (list of str): region coverage files
+      mode (str): 'full' or 'quick'
+      processes (int): size of the process pool, default one per core
+
+    Returns:
+      dict of filename: description of the first difference, empty if all files match
+
+    """
+
+    if (len(filenames) < 2):
+        return {}
+
+    reference = filenames[0]
+    pool = multiprocessing.Pool(processes)
+    try:
+        if (mode == 'quick'):
+            # the files are counted in the profile as they are aggregated, not as they are validated
+            regions = list(read_coverage_file(reference, profiling.NullProfile()))
+            sampled = random.Random(len(regions)).sample(regions, min(VALIDATION_SAMPLE_SIZE, len(regions)))
+            differences = pool.map(_sampled_difference, [(reference, filename, sampled) for filename in filenames[1:]])
+
+        else:
+            digests = pool.map(_region_digest, filenames)
+            differing = [filename for filename, digest in izip(filenames[1:], digests[1:]) if digest != digests[0]]
+            differences = pool.map(_first_difference, [(reference, filename) for filename in differing])
+            filenames = [reference] + differing
+
+    finally:
+        pool.terminate()
+
+    return dict((filename, difference) for filename, difference in izip(filenames[1:], differences) if difference is not None)
+
+
+def _region_digest(filename):
+    """ md5 digest of the region columns of a coverage file
+
+    Args:
+      filename (str): region coverage file
+
+    Returns:
+      hex digest (str)
+
+    """
+
+    digest = hashlib.md5()
+    for region in read_coverage_file(filename):
+        digest.update("{}\t{}\t{}\n".format(*region[:3]))
+
+    return digest.hexdigest()
+
+
+def _first_difference(files):
+    """ Finds the first region where two coverage files differ
+
+    Args:
+      files (tuple): reference and coverage file to compare
+
+    Returns:
+      description of the difference (str), None if they hold the same regions
+
+    """
+
+    reference, filename = files
+
+    name = "{}:{}-{}"
+    region_number = 0
+    for region, other in izip_longest(read_coverage_file(reference), read_coverage_file(filename)):
+        region_number += 1
+        if (other is None):
+            return "ends before region {}, {} still has {}".format(region_number, reference, name.format(*region[:3]))
+
+        if (region is None):
+            return "has extra region {} {}".format(region_number, name.format(*other[:3]))
+
+        if (region[:3] != other[:3]):
+            return "region {} is {}, expected {}".format(region_number, name.format(*other[:3]), name.format(*region[:3]))
+
+    return None
+
+
+def _sampled_difference(files):
+    """ Compares the tabix chromosomes, and looks up sampled regions, of a coverage file
+
+    Args:
+      files (tuple): reference, coverage file to check and the sampled reference regions
+
+    Returns:
+      description of the first difference (str), None if none was found
+
+    """
+
+    reference, filename, regions = files
+
+    reference_tabix = toolbox.open_tabix(reference)
+    tabix_file = toolbox.open_tabix(filename)
+    try:
+        if (list(reference_tabix.contigs) != list(tabix_file.contigs)):
+            return "chromosomes {} differ from {}".format(", ".join(tabix_file.contigs), ", ".join(reference_tabix.contigs))
+
+        for chrom, start, end, depth in regions:
+            found = False
+            for line in tabix_file.fetch(chrom, int(start) - 1, int(end)):
+                if (line.split("\t")[:3] == [chrom, start, end]):
+                    found = True
+                    break
+
+            if (not found):
+                return "region {}:{}-{} is missing".format(chrom, start, end)
+
+    finally:
+        reference_tabix.close()
+        tabix_file.close()
+
+    return None
+
+
+def matrix_mean_and_standard_deviation(depths):
+    """ Calculates the mean and standard deviation of every row in a matrix
+
+    Uses the same sum of squares formula as standard_deviation, with the
+    columns added up left to right, so each row gets the same value as
+    calling standard_deviation on it. Rounding that would give a
+    negative variance is clamped to 0 rather than failing in sqrt.
+
+    Args:
+      depths (numpy array): regions x samples matrix of depths
+
+    Returns:
+      means (list of float)
+      standard deviations (list of float), 0 (int) for a single sample
+
+    """
+
+    n_regions, n_samples = depths.shape
+
+    value_sum = numpy.zeros(n_regions, dtype=numpy.float64)
+    sqr_sum = numpy.zeros(n_regions, dtype=numpy.float64)
+    for column in range(n_samples):
+        value_sum += depths[:, column]
+        sqr_sum += depths[:, column]**2
+
+    return sums_mean_and_standard_deviation(value_sum, sqr_sum, n_samples)
+
+
+def sums_mean_and_standard_deviation(value_sum, sqr_sum, n_samples):
+    """ Calculates means and standard deviations from sums and sums of squares
+
+    Args:
+      value_sum (numpy array): summed depths per region
+      sqr_sum (numpy array): summed squared depths per region
+      n_samples (int or numpy array): samples summed per region
+
+    Returns:
+      means (list of float)
+      standard deviations (list of float), 0 (int) where there is a single sample
+
+    """
+
+    n_samples = numpy.asarray(n_samples, dtype=numpy.float64)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        means = (value_sum / n_samples).tolist()
+        variance = (n_samples*sqr_sum - value_sum*value_sum)/(n_samples*(n_samples - 1))
+        std_devs = numpy.sqrt(numpy.maximum(variance, 0)).tolist()
+
+    single_sample = numpy.broadcast_to(n_samples <= 1, value_sum.shape)
+    for index in numpy.flatnonzero(single_sample):
+        std_devs[index] = 0
+
+    return means, std_devs
 
 
 def standard_deviation(values):
@@ -159,6 +895,221 @@ def standard_deviation(values):
     return std_dev
 
 
+def new_depth_store():
+    """ Creates an empty expected depth store
+
+    The store keeps, per region, the number of samples and the sums of
+    their normalised depths and squared depths. Samples can be folded
+    in or subtracted out without touching the other samples' files.
+
+    Returns:
+      store (dict)
+
+    """
+
+    return {'chroms': None,
+            'starts': None,
+            'ends': None,
+            'counts': None,
+            'sums': None,
+            'sqr_sums': None,
+            'samples': {}}
+
+
+def load_depth_store(filename):
+    """ Loads an expected depth store, or creates a new one if the file does not exist
+
+    Args:
+      filename (str): store file, as written by save_depth_store
+
+    Returns:
+      store (dict)
+
+    """
+
+    if (not os.path.isfile(filename)):
+        return new_depth_store()
+
+    data = numpy.load(filename)
+
+    store = new_depth_store()
+    for key in ['chroms', 'starts', 'ends', 'counts', 'sums', 'sqr_sums']:
+        store[key] = data[key]
+
+    for sample_name, usable_reads in izip(data['sample_names'].tolist(), data['sample_usable_reads'].tolist()):
+        store['samples'][sample_name] = usable_reads
+
+    data.close()
+
+    return store
+
+
+def save_depth_store(store, filename):
+    """ Saves an expected depth store
+
+    The store is written to a temporary file that is then renamed, so
+    a failed save leaves the old store in place.
+
+    Args:
+      store (dict): expected depth store
+      filename (str): store file
+
+    Returns:
+      None
+
+    """
+
+    sample_names = sorted(store['samples'])
+
+    tmp_file = "{}.tmp".format(filename)
+    fh = open(tmp_file, 'wb')
+    numpy.savez(fh,
+                chroms=store['chroms'],
+                starts=store['starts'],
+                ends=store['ends'],
+                counts=store['counts'],
+                sums=store['sums'],
+                sqr_sums=store['sqr_sums'],
+                sample_names=numpy.array(sample_names),
+                sample_usable_reads=numpy.array([store['samples'][sample_name] for sample_name in sample_names], dtype=numpy.int64))
+    fh.close()
+
+    os.rename(tmp_file, filename)
+
+
+def add_to_depth_store(store, flagstats, filenames, chunk_size=CHUNK_SIZE):
+    """ Folds the normalised depths of samples into the store
+
+    Samples already in the store are skipped.
+
+    Args:
+      store (dict): expected depth store
+      flagstats (dict): usable reads per sample
+      filenames (list of str): region coverage files of the samples to add
+      chunk_size (int): number of regions read at a time
+
+    Returns:
+      store (dict)
+
+    """
+
+    for sample_name, filename in _open_coverage_files(filenames).items():
+        if sample_name not in flagstats:
+            continue
+
+        if sample_name in store['samples']:
+            print("Sample {} already in the store, skipping it".format(sample_name))
+            continue
+
+        usable_reads = flagstats[sample_name]['usable_reads']
+        _fold_sample(store, filename, usable_reads, 1, chunk_size)
+        store['samples'][sample_name] = usable_reads
+
+    return store
+
+
+def remove_from_depth_store(store, filenames, chunk_size=CHUNK_SIZE):
+    """ Subtracts the normalised depths of samples out of the store
+
+    The depths are normalised with the usable reads recorded when the
+    sample was added, so no flagstats are needed.
+
+    Args:
+      store (dict): expected depth store
+      filenames (list of str): region coverage files of the samples to remove
+      chunk_size (int): number of regions read at a time
+
+    Returns:
+      store (dict)
+
+    """
+
+    for sample_name, filename in _open_coverage_files(filenames).items():
+        if sample_name not in store['samples']:
+            print("Sample {} is not in the store, cannot remove it".format(sample_name))
+            continue
+
+        _fold_sample(store, filename, store['samples'][sample_name], -1, chunk_size)
+        del store['samples'][sample_name]
+
+    return store
+
+
+def _fold_sample(store, filename, usable_reads, sign, chunk_size=CHUNK_SIZE):
+    """ Adds (sign 1) or subtracts (sign -1) the depths of a coverage file to the store
+
+    The first sample added to an empty store sets its regions.
+
+    Args:
+      store (dict): expected depth store
+      filename (str): region coverage file
+      usable_reads (int): usable reads of the sample
+      sign (int): 1 to add, -1 to subtract
+      chunk_size (int): number of regions read at a time
+
+    Returns:
+      None
+
+    """
+
+    if (store['chroms'] is None):
+        regions = list(read_coverage_file(filename))
+
+        store['chroms'] = numpy.array([region[0] for region in regions])
+        store['starts'] = numpy.array([region[1] for region in regions])
+        store['ends'] = numpy.array([region[2] for region in regions])
+        store['counts'] = numpy.zeros(len(regions), dtype=numpy.int64)
+        store['sums'] = numpy.zeros(len(regions), dtype=numpy.float64)
+        store['sqr_sums'] = numpy.zeros(len(regions), dtype=numpy.float64)
+
+    reader = read_coverage_file(filename)
+    offset = 0
+    while(True):
+        regions = list(islice(reader, chunk_size))
+        if (len(regions) == 0):
+            break
+
+        chunk = slice(offset, offset + len(regions))
+        stored_regions = izip(store['chroms'][chunk].tolist(), store['starts'][chunk].tolist(), store['ends'][chunk].tolist())
+        _check_regions_in_sync(list(stored_regions), regions)
+
+        depths = numpy.array([region[3] for region in regions], dtype=numpy.float64)
+        depths = depths * NORMAL_READS / usable_reads
+
+        store['counts'][chunk] += sign
+        store['sums'][chunk] += sign * depths
+        store['sqr_sums'][chunk] += sign * depths**2
+
+        offset += len(regions)
+
+    if (offset != len(store['chroms'])):
+        print("Files out of sync, {} does not contain the regions in the store".format(filename))
+        exit(-10)
+
+
+def depth_store_rows(store, chunk_size=CHUNK_SIZE):
+    """ Derives the expected depth rows from the store in one pass
+
+    Args:
+      store (dict): expected depth store
+      chunk_size (int): number of regions per chunk
+
+    Returns:
+      generator of (chrom, start, end, mean, stddev) tuples
+
+    """
+
+    if (store['chroms'] is None):
+        return
+
+    for offset in range(0, len(store['chroms']), chunk_size):
+        chunk = slice(offset, offset + chunk_size)
+        means, std_devs = sums_mean_and_standard_deviation(store['sums'][chunk], store['sqr_sums'][chunk], store['counts'][chunk])
+
+        for row in izip(store['chroms'][chunk].tolist(), store['starts'][chunk].tolist(), store['ends'][chunk].tolist(), means, std_devs):
+            yield row
+
+
 if __name__ == "__main__":
     
     parser = argparse.ArgumentParser()
@@ -166,9 +1117,21 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Calculates the expected depth for regions ')
     
     parser.add_argument('--depths',    nargs='+')
-    parser.add_argument('--flagstats', nargs='+')
+    parser.add_argument('--flagstats', nargs='+', help="samtools flagstat files, text or json, or tsv files of sample and usable reads")
+    parser.add_argument('--metrics-cache', help="cache parsed flagstats in this file, and reuse them if the files are unchanged")
     parser.add_argument('-o','--outfile', help='File to write to, if done it will be compressed and indexed as well')
     parser.add_argument('-F', '--force-overwrite', action="store_true", default=False,  help="overwrite old file if present")
+    parser.add_argument('--engine', choices=['numpy', 'python', 'sharded'], default='numpy', help="aggregate regions as numpy matrices, one line at a time or as numpy matrices per chromosome in a process pool, default numpy")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="regions per numpy chunk, default {}".format(CHUNK_SIZE))
+    parser.add_argument('--readers', choices=['serial', 'thread', 'process'], default='serial', help="read the coverage files serially or with a worker per file, default serial")
+    parser.add_argument('--processes', type=int, default=None, help="processes for the sharded engine, default one per core")
+    parser.add_argument('--binary', action="store_true", default=False, help="also write the expected depths to a memory mappable [outfile].bin")
+    parser.add_argument('--store', help="accumulate the samples in this store and write the expected depth of all its samples")
+    parser.add_argument('--remove-samples', nargs='+', help="coverage files of samples to subtract from the store")
+    parser.add_argument('--validate', choices=['full', 'quick'], help="check that all coverage files hold the same regions before starting, 'quick' samples regions through the tabix indexes")
+    parser.add_argument('--profile', action="store_true", default=False, help="write time per stage, input file counts and memory use to [outfile].profile.json")
+    parser.add_argument('--progress-interval', type=int, default=30, help="seconds between progress reports on stderr when profiling, default 30")
+    parser.add_argument('--cprofile', action="store_true", default=False, help="with --profile, also dump cProfile stats to [outfile].cprofile")
 
 
     args = parser.parse_args()
@@ -178,9 +1141,58 @@ if __name__ == "__main__":
         print("Error file already exists, to overwrite use the -f flag")
         exit(-10)
 
-    if (args.flagstats is None or args.depths is None):
+    if (args.store is None and (args.flagstats is None or args.depths is None)):
         parser.parse_args(['-h'])
         exit()
 
-    flagstats = readin_flagstats(args.flagstats)
-    calculate_exp_depth(flagstats, args.depths, args.outfile, args.force_overwrite)
\ No newline at end of file
+    profiler = None
+    if (args.profile):
+        PROFILE = profiling.Profile(args.progress_interval)
+
+        if (args.cprofile):
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+    if (args.validate is not None and args.depths is not None):
+        with PROFILE.stage('validate'):
+            differences = validate_coverage_files(args.depths, args.validate, args.processes)
+
+        for filename in sorted(differences):
+            print("{} does not match {}: {}".format(filename, args.depths[0], differences[filename]))
+
+        if (differences):
+            exit(-10)
+
+    if (args.store is not None):
+        store = load_depth_store(args.store)
+
+        if (args.depths is not None and args.flagstats is not None):
+            with PROFILE.stage('flagstats'):
+                flagstats = readin_flagstats(args.flagstats, cache_file=args.metrics_cache)
+
+            with PROFILE.stage('store'):
+                add_to_depth_store(store, flagstats, args.depths, args.chunk_size)
+
+        if (args.remove_samples is not None):
+            with PROFILE.stage('store'):
+                remove_from_depth_store(store, args.remove_samples, args.chunk_size)
+
+        with PROFILE.stage('store'):
+            save_depth_store(store, args.store)
+
+        write_exp_depth(depth_store_rows(store, args.chunk_size), sorted(store['samples']), args.outfile, args.force_overwrite, args.binary)
+
+    else:
+        with PROFILE.stage('flagstats'):
+            flagstats = readin_flagstats(args.flagstats, cache_file=args.metrics_cache)
+
+        calculate_exp_depth(flagstats, args.depths, args.outfile, args.force_overwrite, args.engine, args.chunk_size, args.readers, args.processes, args.binary)
+
+    if (args.profile):
+        sidecar = args.outfile or "expected_depth_for_run"
+
+        if (profiler is not None):
+            profiler.disable()
+            profiler.dump_stats("{}.cprofile".format(sidecar))
+
+        PROFILE.write("{}.profile.json".format(sidecar))
@@ -24,6 +24,7 @@ main() {
     echo "installing dependencies"
     pip install pip-20.3.3.tar.gz
     pip install pysam-0.7.6.tar.gz
+    pip install numpy-1.16.6-cp27-cp27mu-manylinux1_x86_64.whl
 
 
     # The following line(s) use the dx command-line tool to download your file
@@ -53,7 +54,7 @@ main() {
 
     # Run expected_depth script.
     echo "Running analysis"
-    expected_depth_for_run.py --depths *5bp.gz --flagstats *flagstat -o $project_name.refseq_nirvana_5bp
+    expected_depth_for_run.py --validate full --depths *5bp.gz --flagstats *flagstat -o $project_name.refseq_nirvana_5bp
 
     # The following line(s) use the dx command-line tool to upload your file
     # outputs after you have created them on the local file system.  It assumes
@@ -0,0 +1,236 @@
+#!/usr/bin/python
+#
+# Files written and indexed by ccbg.bgzf must fetch the same rows as the
+# same data bgzipped and indexed by pysam.tabix_index.
+#
+#   python -m unittest discover tests
+#
+
+
+from __future__ import print_function
+import gzip
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "resources", "usr", "bin"))
+
+import pysam
+
+import ccbg.bgzf as bgzf
+import ccbg.toolbox as toolbox
+
+
+
+def make_lines(seed=1, single_base=False):
+    """ sorted depth rows over a few contigs, with gaps, a lone row and a row longer than a block """
+
+    rand = random.Random(seed)
+    lines = ["#chrom\tstart\tend\tdepth\n"]
+
+    for chrom, rows, step in [("1", 6000, 7), ("2", 3000, 900), ("3", 1, 1), ("X", 2000, 40)]:
+        pos = rand.randint(1, 1000)
+        for i in range(rows):
+            # a jump leaves linear index windows and bins without rows
+            if (i == rows // 2):
+                pos += 3 * 1024 * 1024
+
+            end = pos if single_base else pos + rand.randint(0, 60)
+            lines.append("{}\t{}\t{}\t{}\n".format(chrom, pos, end, rand.randint(0, 300)))
+            pos = end + rand.randint(1, step)
+
+    # a row spanning more than one block
+    fields = lines[-1].rstrip("\n").split("\t")
+    lines.append("{}\t{}\t{}\t{}\n".format(fields[0], int(fields[2]) + 5, int(fields[2]) + 5, "7" * (bgzf.BLOCK_SIZE + 1000)))
+
+    return lines
+
+
+def query_regions(lines, count=400, seed=1):
+    """ random regions around the rows, and regions on and off the contigs without rows """
+
+    rand = random.Random(seed)
+    rows = [line.split("\t") for line in lines if not line.startswith("#")]
+
+    regions = []
+    for i in range(count):
+        row = rand.choice(rows)
+        start = max(0, int(row[1]) - rand.randint(0, 50000))
+        regions.append((row[0], start, int(row[1]) + rand.randint(0, 50000)))
+
+    # a gap inside a contig, past its last row, a contig without rows and a whole contig
+    last = max(int(row[2]) for row in rows if row[0] == "1")
+    regions += [("1", last + 10, last + 100000), ("2", 0, 1), ("4", 0, 1000000), ("3", 0, 10 ** 9)]
+
+    return regions
+
+
+
+class BgzfTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="ccbg_test_")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+
+    def path(self, name):
+        return os.path.join(self.workdir, name)
+
+
+    def reference(self, lines, single_base=False):
+        """ the lines bgzipped and indexed by pysam """
+
+        plain_file = self.path("reference.txt")
+        fh = open(plain_file, 'w')
+        fh.writelines(lines)
+        fh.close()
+
+        end_col = 1 if single_base else 2
+        return pysam.tabix_index(plain_file, force=True, seq_col=0, start_col=1, end_col=end_col)
+
+
+    def fetch(self, filename, regions):
+        tabix = toolbox.open_tabix(filename)
+
+        results = []
+        for chrom, start, end in regions:
+            try:
+                results.append(list(tabix.fetch(chrom, start, end)))
+            except ValueError:
+                results.append("no contig {}".format(chrom))
+
+        return results
+
+
+    def assertSameFetches(self, filename, reference, lines):
+        self.assertEqual(gzip.open(reference).read(), gzip.open(filename).read())
+
+        regions = query_regions(lines)
+        fetched = self.fetch(filename, regions)
+        self.assertEqual(self.fetch(reference, regions), fetched)
+
+        # the regions without rows are answered as well
+        self.assertEqual([[], [], "no contig 4"], fetched[-4:-1])
+
+
+    def write(self, filename, lines, single_base=False):
+        end_col = 1 if single_base else 2
+        fh = bgzf.BgzfWriter(filename, index=bgzf.TabixIndex(seq_col=0, start_col=1, end_col=end_col))
+        for line in lines:
+            fh.write_line(line)
+        fh.close()
+
+
+    def test_writer(self):
+        lines = make_lines()
+        self.write(self.path("written.gz"), lines)
+
+        self.assertSameFetches(self.path("written.gz"), self.reference(lines), lines)
+
+
+    def test_writer_single_base(self):
+        lines = make_lines(single_base=True)
+        self.write(self.path("written.gz"), lines, single_base=True)
+
+        self.assertSameFetches(self.path("written.gz"), self.reference(lines, single_base=True), lines)
+
+
+    def test_tell(self):
+        fh = bgzf.BgzfWriter(self.path("tell.gz"))
+        self.assertEqual(0, fh.tell())
+
+        data = b"a" * (bgzf.BLOCK_SIZE + 10)
+        fh.write(data[:100])
+        self.assertEqual(100, fh.tell())
+
+        fh.write(data[100:])
+        first_block = bgzf.compress_block(data[:bgzf.BLOCK_SIZE])
+        self.assertEqual((len(first_block) << 16) | 10, fh.tell())
+        fh.close()
+
+        self.assertEqual(data, gzip.open(self.path("tell.gz")).read())
+
+
+    def test_to_bytes(self):
+        lines = make_lines()
+        self.write(self.path("written.gz"), lines)
+
+        index = bgzf.TabixIndex(seq_col=0, start_col=1, end_col=2)
+        fh = bgzf.BgzfWriter(self.path("other.gz"), index=index)
+        for line in lines:
+            fh.write_line(line)
+        fh.close()
+
+        # the .tbi is the serialised index, bgzipped
+        self.assertEqual(index.to_bytes(), gzip.open(self.path("written.gz.tbi")).read())
+        self.assertTrue(index.to_bytes().startswith(b"TBI\1"))
+
+
+    def test_index_lines(self):
+        # the last line without its newline
+        lines = make_lines()
+        lines[-1] = lines[-1].rstrip("\n")
+        data = "".join(lines).encode('ascii')
+
+        written = bgzf.TabixIndex(seq_col=0, start_col=1, end_col=2)
+        fh = bgzf.BgzfWriter(self.path("written.gz"), index=written)
+        for line in lines:
+            fh.write_line(line)
+        fh.close()
+
+        # the offsets of the blocks BgzfWriter wrote
+        block_offsets = [0]
+        for block_start in range(0, len(data), bgzf.BLOCK_SIZE):
+            block_offsets.append(block_offsets[-1] + len(bgzf.compress_block(data[block_start:block_start + bgzf.BLOCK_SIZE])))
+
+        # fed in pieces that end inside lines
+        index = bgzf.TabixIndex(seq_col=0, start_col=1, end_col=2)
+        position, pending = 0, b""
+        for piece_start in range(0, len(data), 50000):
+            pending += data[piece_start:piece_start + 50000]
+            position, pending = bgzf._index_lines(index, pending, position, block_offsets)
+        bgzf._index_lines(index, pending, position, block_offsets, final=True)
+
+        self.assertEqual(written.to_bytes(), index.to_bytes())
+
+
+    def test_compress_file(self):
+        lines = make_lines()
+        plain_file = self.path("plain.txt")
+        fh = open(plain_file, 'w')
+        fh.writelines(lines)
+        fh.close()
+
+        bgzf.compress_file(plain_file, self.path("compressed.gz"), index=bgzf.TabixIndex(seq_col=0, start_col=1, end_col=2),
+                           processes=3, batch_blocks=2)
+
+        self.assertSameFetches(self.path("compressed.gz"), self.reference(lines), lines)
+
+
+    def test_join_files(self):
+        lines = make_lines()
+
+        parts = []
+        for part, part_lines in enumerate([lines[:2000], lines[2000:7000], [], lines[7000:]]):
+            part_file = self.path("part{}.gz".format(part))
+            index = bgzf.TabixIndex(seq_col=0, start_col=1, end_col=2)
+            fh = bgzf.BgzfWriter(part_file, index=index, eof=False)
+            for line in part_lines:
+                fh.write_line(line)
+            fh.close()
+            parts.append((part_file, index))
+
+        bgzf.join_files(parts, self.path("joined.gz"), index=bgzf.TabixIndex(seq_col=0, start_col=1, end_col=2))
+
+        self.assertSameFetches(self.path("joined.gz"), self.reference(lines), lines)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+#
+# A depth file rewritten under a live coverage cache must have its
+# reports made again from the new file, not from a stale tabix handle.
+#
+#   python -m unittest discover tests
+#
+
+
+from __future__ import print_function
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "resources", "usr", "bin"))
+
+import ccbg.depth as depth
+from ccbg.coverage_cache import CoverageCache
+
+import synthetic
+
+
+
+class RewrittenDepthFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="ccbg_test_")
+        self.depth_file = os.path.join(self.workdir, "blocks.gz")
+        self.cache = CoverageCache(os.path.join(self.workdir, "cache.sqlite"))
+
+        self.regions = synthetic.make_regions(2000, seed=1)
+
+
+    def tearDown(self):
+        self.cache.close()
+        depth.close_tabix_files()
+        shutil.rmtree(self.workdir)
+
+
+    def reports(self, regions, **kwargs):
+        return [depth.coverage_region(self.depth_file, chrom, start, end, 20, **kwargs) for chrom, start, end in regions]
+
+
+    def test_rewritten_file(self):
+        queried = self.regions[::50]
+
+        synthetic.write_block_depth_file(self.regions, self.depth_file, seed=1)
+        first = self.reports(queried, cache=self.cache)
+        self.assertEqual(first, self.reports(queried, cache=self.cache))
+
+        # every other region, with other depths, at the same path
+        synthetic.write_block_depth_file(self.regions[::2], self.depth_file, seed=2)
+        cached = self.reports(queried, cache=self.cache)
+
+        depth.close_tabix_files()
+        expected = self.reports(queried)
+
+        self.assertNotEqual(first, expected)
+        self.assertEqual(expected, cached)
+        self.assertEqual(expected, self.reports(queried, cache=self.cache))
+
+
+    def test_rewritten_file_batch(self):
+        bed_file = synthetic.write_bed(self.regions[::50], os.path.join(self.workdir, "regions.bed"))
+
+        synthetic.write_block_depth_file(self.regions, self.depth_file, seed=1)
+        first = depth.coverage_regions_from_bedfile(self.depth_file, bed_file, batch=True, cache=self.cache)
+
+        synthetic.write_block_depth_file(self.regions[::2], self.depth_file, seed=2)
+        cached = depth.coverage_regions_from_bedfile(self.depth_file, bed_file, batch=True, cache=self.cache)
+
+        depth.close_tabix_files()
+        expected = depth.coverage_regions_from_bedfile(self.depth_file, bed_file, batch=True)
+
+        self.assertNotEqual(first, expected)
+        self.assertEqual(expected, cached)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+#
+# Coverage files whose regions do not line up must be reported and
+# stopped on, rather than aggregated or crashed on.
+#
+#   python -m unittest discover tests
+#
+
+
+from __future__ import print_function
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "resources", "usr", "bin"))
+
+import pysam
+
+import expected_depth_for_run
+import synthetic
+
+
+
+class MisalignedCoverageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="ccbg_test_")
+
+        regions = synthetic.make_regions(300, seed=1)
+        self.coverage_files, flagstat_files = synthetic.write_coverage_files(regions, 3, self.workdir, seed=1)
+        self.flagstats = expected_depth_for_run.readin_flagstats(flagstat_files)
+
+        # the last sample is missing a region
+        misaligned = self.coverage_files[-1]
+        fh = gzip.open(misaligned)
+        lines = fh.readlines()
+        fh.close()
+
+        plain_file = misaligned[:-len(".gz")]
+        fh = open(plain_file, 'w')
+        fh.writelines(lines[:19] + lines[20:])
+        fh.close()
+        pysam.tabix_index(plain_file, seq_col=0, start_col=1, end_col=2, force=True)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+
+    def test_lockstep_rows_exit(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            with self.assertRaises(SystemExit):
+                list(expected_depth_for_run._lockstep_rows(self.flagstats, self.coverage_files))
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        self.assertIn("Files out of sync region", output)
+
+
+    def test_full_validation(self):
+        differences = expected_depth_for_run.validate_coverage_files(self.coverage_files, 'full', processes=2)
+
+        self.assertEqual([self.coverage_files[-1]], list(differences))
+        self.assertTrue(differences[self.coverage_files[-1]].startswith("region "))
+
+
+
+if __name__ == '__main__':
+    unittest.main()